@@ -0,0 +1,303 @@
+import threading
+import time
+import os
+import cv2 as cv
+from collections import deque, namedtuple
+from classes.metrics_classes import METRICS
+
+# One camera frame: frame_id counts up from 1, timestamp is when it was read
+Frame = namedtuple('Frame', ['frame_id', 'timestamp', 'image'])
+
+# Files Replay_Source plays from an image directory
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+def open_source(source, realtime = True, loop = False):
+    """
+    Purpose: Open a camera or a recording through the same interface
+        - source (int or str): Camera index (e.g. 0 or '1'), or the path of a
+        video file or a directory of images to play back
+        - realtime (bool): Play recordings at their own frame rate (False plays
+        them as fast as they can be read)
+        - loop (bool): Start a recording over when it ends
+    Returns: cv.VideoCapture or Replay_Source
+    """
+    if isinstance(source, int) or str(source).isdigit():
+        return cv.VideoCapture(int(source))
+    return Replay_Source(source, realtime, loop = loop)
+
+def parse_keys(text):
+    """
+    Purpose: Read a key script like '30:s,32:y' (press s on the 30th waitKey
+        call, then y on the 32nd) for Scripted_Display
+        - text (str): Comma separated call:key pairs
+    Returns: List of (call number, key) tuples
+    """
+    keys = []
+    for item in text.split(','):
+        if item.strip():
+            call, key = item.split(':')
+            keys.append((int(call), key))
+    return keys
+
+class Frame_Grabber:
+    """
+    Purpose: Read camera frames on a background thread into a small ring
+        buffer, so camera latency never holds up the UI loop or vision code.
+        Consumers always get the newest frame and can tell how many they
+        skipped.
+    Instance Variables:
+        self.capture (obj): Camera to read from (cv.VideoCapture or anything
+            with read(), isOpened() and release())
+        self.frames (deque of Frame): Ring buffer of the newest frames
+        self.frames_read (int): Frames read from the camera so far
+        self.frames_dropped (int): Frames read() skipped because a newer frame
+            was already waiting
+        self.last_timestamp (float): When the frame last returned by read()
+            came off the camera (for measuring latency)
+    Methods:
+        start(self)
+            Starts the capture thread (returns self)
+        stop(self) / release(self)
+            Stops the thread. release() also releases the camera
+        latest(self)
+            Returns the newest Frame without blocking (None if there isn't one)
+        wait_newer(self, frame_id, timeout)
+            Blocks until a frame newer than frame_id arrives and returns it
+            (None on timeout)
+        read(self)
+            Same as cv.VideoCapture.read(): returns (ret, image) of the newest
+            frame not returned by read() yet, so it can replace the camera in
+            existing loops
+        isOpened(self)
+            True while the camera is open
+        fps(self)
+            Frames per second read from the camera over the ring buffer
+    """
+
+    def __init__(self, capture, buffer_size = 4, read_timeout = 1.0):
+        self.capture = capture
+        self.frames = deque(maxlen = buffer_size)
+        self.read_timeout = read_timeout
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.last_timestamp = None
+        self._last_read_id = 0
+        self._new_frame = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._grab_loop, name = 'frame-grabber', daemon = True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def release(self):
+        self.stop()
+        self.capture.release()
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def _grab_loop(self):
+        while not self._stop.is_set():
+            with METRICS.span('capture'):
+                ret, image = self.capture.read()
+            if not ret:
+                # Camera stopped giving frames: wake anybody waiting
+                with self._new_frame:
+                    self._stop.set()
+                    self._new_frame.notify_all()
+                break
+            with self._new_frame:
+                self.frames_read += 1
+                self.frames.append(Frame(self.frames_read, time.time(), image))
+                self._new_frame.notify_all()
+
+    def latest(self):
+        with self._new_frame:
+            return self.frames[-1] if self.frames else None
+
+    def wait_newer(self, frame_id = 0, timeout = None):
+        if timeout is None:
+            timeout = self.read_timeout
+        with self._new_frame:
+            self._new_frame.wait_for(lambda: (self.frames and self.frames[-1].frame_id > frame_id) or self._stop.is_set(), timeout)
+            if self.frames and self.frames[-1].frame_id > frame_id:
+                return self.frames[-1]
+            return None
+
+    def read(self):
+        frame = self.wait_newer(self._last_read_id)
+        if frame is None:
+            return False, None
+        if self._last_read_id > 0:
+            self.frames_dropped += frame.frame_id - self._last_read_id - 1
+        self._last_read_id = frame.frame_id
+        self.last_timestamp = frame.timestamp
+        return True, frame.image
+
+    def fps(self):
+        with self._new_frame:
+            if len(self.frames) < 2:
+                return 0
+            first, last = self.frames[0], self.frames[-1]
+            return (last.frame_id - first.frame_id) / max(last.timestamp - first.timestamp, 1e-6)
+
+class Replay_Source:
+    """
+    Purpose: Play back a recorded video file or a directory of images as if it
+        were the camera, so the vision code can be run and timed repeatably
+        without a camera. Has the same read(), isOpened(), release() and get()
+        as cv.VideoCapture, so it also works inside a Frame_Grabber.
+    Instance Variables:
+        self.path (str): Video file or image directory played back
+        self.realtime (bool): Wait between frames to play at self.fps. If
+            False, frames come as fast as they can be read
+        self.fps (float): Playback frame rate (from the video, else 30)
+        self.loop (bool): Start over at the end instead of stopping
+        self.frames_played (int): Frames returned by read() so far
+    Methods:
+        read(self)
+            Returns (ret, image) of the next frame. ret is False at the end
+        isOpened(self) / release(self)
+            Same as cv.VideoCapture
+        get(self, prop)
+            Supports cv.CAP_PROP_FPS, CAP_PROP_FRAME_COUNT,
+            CAP_PROP_FRAME_WIDTH and CAP_PROP_FRAME_HEIGHT
+    """
+
+    def __init__(self, path, realtime = True, fps = None, loop = False):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.frames_played = 0
+        self._video = None
+        self._files = []
+        self._index = 0
+        self._size = (0, 0)
+        if os.path.isdir(path):
+            self._files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                                 if name.lower().endswith(IMAGE_EXTENSIONS))
+            self._count = len(self._files)
+            self.fps = fps or 30
+        else:
+            self._video = cv.VideoCapture(path)
+            self._count = int(self._video.get(cv.CAP_PROP_FRAME_COUNT))
+            self.fps = fps or self._video.get(cv.CAP_PROP_FPS) or 30
+        self._start_time = None
+
+    def isOpened(self):
+        if self._video is not None:
+            return self._video.isOpened()
+        return len(self._files) > 0
+
+    def release(self):
+        if self._video is not None:
+            self._video.release()
+        self._files = []
+
+    def get(self, prop):
+        if prop == cv.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv.CAP_PROP_FRAME_COUNT:
+            return self._count
+        if prop == cv.CAP_PROP_FRAME_WIDTH:
+            return self._size[0]
+        if prop == cv.CAP_PROP_FRAME_HEIGHT:
+            return self._size[1]
+        return 0
+
+    def _next_image(self):
+        if self._video is not None:
+            ret, image = self._video.read()
+            if not ret and self.loop and self.frames_played > 0:
+                self._video.set(cv.CAP_PROP_POS_FRAMES, 0)
+                ret, image = self._video.read()
+            return image if ret else None
+        if self._index >= len(self._files):
+            if not self.loop or not self._files:
+                return None
+            self._index = 0
+        image = cv.imread(self._files[self._index])
+        self._index += 1
+        return image
+
+    def read(self):
+        image = self._next_image()
+        if image is None:
+            return False, None
+        if self.realtime:
+            # Hold each frame back until it is due at the recording's frame rate
+            if self._start_time is None:
+                self._start_time = time.time()
+            delay = self._start_time + self.frames_played / self.fps - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        self.frames_played += 1
+        self._size = (image.shape[1], image.shape[0])
+        return True, image
+
+class Scripted_Display:
+    """
+    Purpose: Stand in for cv.imshow/cv.waitKey so the vision code can run with
+        key presses from a script and, optionally, no display at all. Pass it
+        as the display of Cookie_Vision (or call it in place of cv in a loop).
+    Instance Variables:
+        self.keys (dict): waitKey call number -> key to return on that call
+        self.show (bool): Also show the frames in real windows (and read real
+            key presses). False runs without a display
+        self.calls (int): Number of waitKey calls so far
+        self.frames_shown (int): Number of imshow calls so far
+    Methods:
+        waitKey(self, delay)
+            Returns the scripted key for this call (ord of it), or -1
+        imshow(self, name, image)
+            Counts the frame and shows it if self.show
+        namedWindow / destroyWindow / destroyAllWindows
+            Same as cv's (nothing happens without a display)
+        done(self)
+            True once every scripted key was pressed
+    """
+
+    def __init__(self, keys = (), show = False):
+        self.keys = {call: key for call, key in keys}
+        self.show = show
+        self.calls = 0
+        self.frames_shown = 0
+
+    def waitKey(self, delay = 0):
+        self.calls += 1
+        key = -1
+        if self.show:
+            key = cv.waitKey(delay)
+        if self.calls in self.keys:
+            key = ord(self.keys[self.calls])
+        return key
+
+    def imshow(self, name, image):
+        self.frames_shown += 1
+        if self.show:
+            cv.imshow(name, image)
+
+    def namedWindow(self, name, flags = cv.WINDOW_AUTOSIZE):
+        if self.show:
+            cv.namedWindow(name, flags)
+
+    def destroyWindow(self, name):
+        if self.show:
+            cv.destroyWindow(name)
+
+    def destroyAllWindows(self):
+        if self.show:
+            cv.destroyAllWindows()
+
+    def done(self):
+        return self.calls >= max(self.keys, default = 0)
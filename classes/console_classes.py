@@ -0,0 +1,659 @@
+import threading
+import queue
+import time
+import os
+import logging
+import tkinter as tk
+from tkinter import ttk
+import numpy as np
+import cv2 as cv
+from classes.metrics_classes import METRICS
+from classes.sim_classes import Job_Simulator
+from classes.design_classes import DESIGN_DIR
+from classes.g_code_classes import SCAN_POS_FILE, HOME_FILE
+from classes.job_classes import Job_Failed
+from classes.stream_classes import Job_Checkpoint
+
+log = logging.getLogger(__name__)
+
+def frame_to_ppm(image, width):
+    """
+    Purpose: Turn a camera frame into PPM data for a tk.PhotoImage (Tk reads
+        PPM itself, so no image library is needed)
+        - image (img): BGR camera frame
+        - width (int): Largest preview width (pixels). Bigger frames are shrunk
+    Returns: (data, scale)
+        - data (bytes): PPM image (imencode writes it as RGB)
+        - scale (float): Preview pixels per frame pixel
+    """
+    scale = min(1.0, width / image.shape[1])
+    if scale < 1.0:
+        image = cv.resize(image, None, fx = scale, fy = scale, interpolation = cv.INTER_AREA)
+    ok, data = cv.imencode('.ppm', image)
+    return data.tobytes(), scale
+
+class Operator_Console:
+    """
+    Purpose: Tk window to run the cookie robot from. The camera preview is
+        updated by after() callbacks from the frames the Frame_Grabber thread
+        reads, and the machine mode, job progress, machine status and metrics
+        are widgets instead of text drawn into every frame. Calibrating,
+        scanning and planning prints run on a vision thread and the robot jobs
+        on the Robot_Worker, so the window never waits on either. Every button
+        also has the key main.py used for it.
+    Instance Variables:
+        self.root (tk.Tk): Window of the console
+        self.capture (Frame_Grabber): Camera frames
+        self.vision (Cookie_Vision): Calibration and cookie scanning
+        self.worker (Robot_Worker): Runs the robot's jobs
+        self.poller (Status_Poller): grbl status reports (None without one)
+        self.toolpaths (Toolpath_Cache): Design fills
+        self.z_capacity (float): Syringe travel a print may use (mm)
+        self.checkpoint_file (str): Prints are checkpointed here (see
+            GCode_EX.resume)
+        self.preview_width (int): Largest width of the camera preview (pixels)
+        self.preview_ms (int): Time between preview updates (ms)
+        self.mode (str): Machine mode (main.py's numbered modes)
+            - 'home': Waiting to calibrate, scan, batch scan, repeat the last
+              design or resume an aborted print from its checkpoint
+            - 'calibrate': Robot at the scan position, finds the red square
+              and platform, and saves them once they look right
+            - 'scan': Learns the empty platform, then finds the cookie (every
+              cookie for a batch) when Scan is pressed
+            - 'confirm': Shows the scanned outline(s) to accept or scan again
+            - 'design': Cycles through the designs previewed on the cookie
+            - 'print': The robot is frosting (pause and abort work in every
+              mode while the worker is busy)
+        self.task (str): Name of the vision task that is running (None if idle)
+        self.print_job (Robot_Job): Print the robot is running (None if none)
+        self.repeat_design (str): Design of the last cookie ('outline' if
+            outline only, None before the first print)
+    Methods:
+        set_mode(self, mode)
+            Switches mode: updates the buttons, the overlay and the platform
+            watching (the background is learned and kept up to date while
+            waiting for a cookie in 'scan' mode)
+        run_task(self, name, function, done)
+            Runs function() on a thread. done(result) is then called on the Tk
+            thread (errors are printed). Only one task runs at a time
+        message(self, text)
+            Shows text in the status line (and logs it)
+        check_calibration(self)
+            Loads the last calibration and checks (on a thread, at the scan
+            position) that the red square hasn't moved since. If it moved, the
+            calibration is forgotten: scanning stays off until the platform
+            is calibrated again
+        close(self)
+            Homes the robot after the queued jobs and closes the window
+    """
+
+    def __init__(self, root, capture, vision, worker, toolpaths, poller = None, z_capacity = 60,
+                 checkpoint_file = None, preview_width = 800, preview_ms = 30):
+        self.root = root
+        self.capture = capture
+        self.vision = vision
+        self.worker = worker
+        self.poller = poller
+        self.toolpaths = toolpaths
+        self.z_capacity = z_capacity
+        self.checkpoint_file = checkpoint_file
+        self.preview_width = preview_width
+        self.preview_ms = preview_ms
+        self.mode = 'home'
+        self.task = None
+        self.print_job = None
+        self.repeat_design = None
+        self.calibrated = False
+        self._batch = False # Scan every cookie on the platform
+        self._repeat = False # Print repeat_design on the next cookie without choosing
+        self._cookies = [] # Contours of the last scan
+        self._designs = [None]
+        self._design_index = 0
+        self._design_strokes = []
+        self._results = queue.Queue() # (name, done, result, error) of finished tasks
+        self._vision_lock = threading.Lock() # Background model and scans
+        self._watch_platform = threading.Event()
+        self._closing = False
+        self._frame_id = 0
+        self._scale = None
+        self._homed = threading.Event() # Set once the robot is home after close()
+        self._photo = None
+        self._last_preview = None
+        self._last_labels = 0
+        self._build()
+        self._watcher = threading.Thread(target = self._watch_loop, name = 'platform-watch', daemon = True)
+        self._watcher.start()
+        self.set_mode('home')
+        self.root.after(self.preview_ms, self._tick)
+
+    def _build(self):
+        self.root.title('Cookie Robot v1.1')
+        self.root.protocol('WM_DELETE_WINDOW', self.close)
+        self.canvas = tk.Canvas(self.root, width = self.preview_width, height = self.preview_width * 3 // 4,
+                                background = 'black', highlightthickness = 0)
+        self.canvas.grid(row = 0, column = 0, rowspan = 2, sticky = 'nw')
+        self._image_item = self.canvas.create_image(0, 0, anchor = 'nw')
+
+        side = ttk.Frame(self.root, padding = 8)
+        side.grid(row = 0, column = 1, sticky = 'new')
+        self.mode_text = tk.StringVar()
+        self.status_text = tk.StringVar()
+        self.design_text = tk.StringVar()
+        self.job_text = tk.StringVar(value = 'Robot idle')
+        self.machine_text = tk.StringVar(value = 'No status reports')
+        self.metrics_text = tk.StringVar()
+        ttk.Label(side, textvariable = self.mode_text, font = ('TkDefaultFont', 14, 'bold')).pack(anchor = 'w')
+        ttk.Label(side, textvariable = self.status_text, wraplength = 260).pack(anchor = 'w', pady = (4, 8))
+        ttk.Label(side, textvariable = self.design_text).pack(anchor = 'w')
+        ttk.Separator(side).pack(fill = 'x', pady = 6)
+        ttk.Label(side, textvariable = self.job_text).pack(anchor = 'w')
+        self.progress = ttk.Progressbar(side, length = 260, maximum = 1.0)
+        self.progress.pack(anchor = 'w', pady = 4)
+        ttk.Label(side, textvariable = self.machine_text).pack(anchor = 'w')
+        ttk.Separator(side).pack(fill = 'x', pady = 6)
+        ttk.Label(side, textvariable = self.metrics_text, font = ('TkFixedFont', 9), justify = 'left').pack(anchor = 'w')
+
+        # (label, key, modes the action is available in, action). Keys are the ones main.py used
+        self.actions = [
+            ('Calibrate', 'c', ('home', 'calibrate'), self._calibrate),
+            ('Scan', 's', ('home', 'calibrate', 'scan'), self._scan),
+            ('Batch scan', 'b', ('home',), self._batch_scan),
+            ('Repeat', 'r', ('home',), self._repeat_scan),
+            ('Relearn background', 'r', ('scan',), self._relearn),
+            ('Resume print', 'u', ('home',), self._resume),
+            ('Save calibration', 'y', ('calibrate',), self._save_calibration),
+            ('Cookie correct', 'y', ('confirm',), self._accept),
+            ('Scan again', 'n', ('confirm',), self._rescan),
+            ('Next design', 'n', ('design',), self._next_design),
+            ('Print', 'y', ('design',), self._print_design),
+            ('Outline only', 'o', ('design',), self._print_outline),
+            ('Home', 'h', ('home', 'calibrate', 'scan', 'confirm', 'design'), self._home),
+            ('Pause/Resume', 'p', None, self._pause),
+            ('Abort', 'a', None, self._abort),
+            ('Quit', 'q', None, self.close),
+        ]
+        buttons = ttk.Frame(self.root, padding = 8)
+        buttons.grid(row = 1, column = 1, sticky = 'sew')
+        self.buttons = []
+        for i, (label, key, modes, action) in enumerate(self.actions):
+            button = ttk.Button(buttons, text = '%s (%s)' % (label, key), command = action)
+            button.grid(row = i // 2, column = i % 2, sticky = 'ew', padx = 2, pady = 2)
+            self.buttons.append(button)
+        self.root.bind('<Key>', self._key)
+
+    def _available(self, index):
+        label, key, modes, action = self.actions[index]
+        if action in (self._pause, self._abort):
+            return self.worker.busy()
+        if action == self.close:
+            return not self._closing
+        if self.task is not None or self._closing or self.mode not in modes:
+            return False
+        if action in (self._scan, self._batch_scan, self._repeat_scan) and self.vision.square_rect is None:
+            return False # Not calibrated (or the loaded calibration failed its check)
+        if action == self._repeat_scan:
+            return self.repeat_design is not None
+        if action == self._save_calibration:
+            return self.calibrated
+        return True
+
+    def _refresh_buttons(self):
+        for i, button in enumerate(self.buttons):
+            button.state(['!disabled'] if self._available(i) else ['disabled'])
+
+    def _key(self, event):
+        for i, (label, key, modes, action) in enumerate(self.actions):
+            if event.char == key and self._available(i):
+                action()
+                return
+
+    def message(self, text):
+        log.info(text)
+        self.status_text.set(text)
+
+    def set_mode(self, mode):
+        self.mode = mode
+        self.mode_text.set({'home': 'Home', 'calibrate': 'Calibration', 'scan': 'Cookie scan', 'confirm': 'Check scan',
+                            'design': 'Design selection', 'print': 'Printing'}[mode])
+        self._watch()
+        if mode != 'design':
+            self.design_text.set('')
+        self._refresh_buttons()
+        self._draw_overlay()
+
+    def run_task(self, name, function, done = None):
+        if self.task is not None:
+            return False
+        self.task = name
+        self._watch() # Off until the task is done (see _finish_tasks)
+        self._refresh_buttons()
+
+        def target():
+            try:
+                self._results.put((name, done, function(), None))
+            except Exception as e:
+                self._results.put((name, done, None, e))
+
+        threading.Thread(target = target, name = 'console-' + name, daemon = True).start()
+        return True
+
+    def _finish_tasks(self):
+        while True:
+            try:
+                name, done, result, error = self._results.get_nowait()
+            except queue.Empty:
+                return
+            if name is not None:
+                self.task = None
+            if error is not None:
+                print(error)
+                print("Error occured while running " + name)
+                self.message(name + " failed: " + str(error))
+            elif done is not None:
+                done(result)
+            # A scan stops the platform watching while it runs: back on whether it worked or not
+            self._watch()
+            self._refresh_buttons()
+
+    def _watch(self):
+        # The background is learned and kept up to date while waiting for a cookie
+        if self.mode == 'scan' and self.task is None and not self._closing:
+            self._watch_platform.set()
+        else:
+            self._watch_platform.clear()
+
+    # ---------- Camera preview and widgets (Tk thread) ----------
+
+    def _tick(self):
+        if self._homed.is_set():
+            self.root.destroy()
+            return
+        self._finish_tasks()
+        frame = self.capture.latest()
+        if frame is not None and frame.frame_id != self._frame_id:
+            self._frame_id = frame.frame_id
+            with METRICS.span('preview'):
+                data, scale = frame_to_ppm(frame.image, self.preview_width)
+                self._photo = tk.PhotoImage(data = data, format = 'PPM')
+                self.canvas.itemconfigure(self._image_item, image = self._photo)
+            if scale != self._scale:
+                self._scale = scale
+                self.canvas.configure(width = self._photo.width(), height = self._photo.height())
+                self._draw_overlay()
+            now = time.perf_counter()
+            if self._last_preview is not None:
+                METRICS.observe('preview_loop', now - self._last_preview)
+            self._last_preview = now
+            METRICS.gauge('frame_latency_ms', (time.time() - frame.timestamp) * 1000)
+        # Text only changes a few times a second
+        if time.time() - self._last_labels > 0.2:
+            self._last_labels = time.time()
+            self._update_labels()
+        self.root.after(self.preview_ms, self._tick)
+
+    def _update_labels(self):
+        self._refresh_buttons()
+        if self.mode == 'scan' and not self.vision.background.ready():
+            self.status_text.set("Learning the empty platform: %d/%d frames" % (
+                len(self.vision.background._learning), self.vision.background.learn_frames))
+
+        current = self.worker.current
+        if current is not None:
+            progress = current.progress()
+            # Lines the machine finished if grbl reports its planner, else lines accepted
+            done = progress['acked'] if progress.get('executed') is None else progress['executed']
+            status = '%s: %d/%s lines' % (progress['name'], done, progress['total'] or '?')
+            if progress['eta'] is not None:
+                status += '  ETA %ds' % progress['eta']
+            if self.worker.paused:
+                status += '  (paused)'
+            self.job_text.set(status)
+            self.progress['value'] = min(done / progress['total'], 1.0) if progress['total'] else 0
+        else:
+            self.job_text.set('Robot idle' if not self.worker.busy() else 'Jobs waiting')
+            self.progress['value'] = 0
+
+        if self.mode == 'print' and self.print_job is not None and self.print_job.done():
+            error = None if self.print_job.cancelled() else self.print_job.exception()
+            if self.print_job.cancelled() or error is not None:
+                # grbl rejecting lines (Job_Failed, e.g. locked in an alarm) is shown: nothing may have moved
+                reason = ' (' + str(error) + ')' if isinstance(error, Job_Failed) else ''
+                problem = self._resume_problem()
+                if problem is None:
+                    self.message("Cookie was not finished%s: press Resume print to carry on (leave it on the platform)" % reason)
+                else:
+                    self.message("Cookie was not finished%s. %s" % (reason, problem))
+            else:
+                self.message(self.print_job.name + " finished in %.1f s" % self.print_job.result()['elapsed'])
+            self.print_job = None
+            self.set_mode('home')
+
+        if self.poller is not None:
+            status = self.poller.latest()
+            if status is not None and status['mpos'] is not None:
+                x, y, z = self.poller.position()
+                machine = '%s  X%.1f Y%.1f Z%.2f' % (status['state'], x, y, z)
+                if status['planner_free'] is not None:
+                    machine += '  planner %d/%d free' % (status['planner_free'], self.worker.robot.streamer.planner_blocks)
+                self.machine_text.set(machine)
+
+        METRICS.gauge('camera_fps', self.capture.fps())
+        stats = METRICS.snapshot()
+        lines = ['Preview %.1f FPS   camera %.1f FPS' % (METRICS.fps('preview_loop'), self.capture.fps()),
+                 'Frame latency %d ms' % stats['gauges'].get('frame_latency_ms', 0)]
+        for stage in ('preview', 'background', 'morphology', 'find_contours', 'outline', 'generate', 'stream_ack'):
+            if stage in stats['histograms']:
+                lines.append('%-13s %6.2f ms' % (stage, stats['histograms'][stage]['recent_mean'] * 1000))
+        self.metrics_text.set('\n'.join(lines))
+
+    def _draw_overlay(self):
+        # Calibration, scanned contours and the design preview are canvas items:
+        # drawn once when they change instead of into every frame
+        self.canvas.delete('overlay')
+        scale = self._scale or 1.0
+
+        def polyline(points, color, closed = False, width = 2):
+            points = np.asarray(points, dtype = float).reshape(-1, 2) * scale
+            if len(points) < 2:
+                return
+            if closed:
+                points = np.vstack((points, points[:1]))
+            self.canvas.create_line(*points.ravel().tolist(), fill = color, width = width, tags = 'overlay')
+
+        if self.mode == 'calibrate' and self.calibrated:
+            polyline(cv.boxPoints(self.vision.square_rect), 'red', True)
+            polyline(self.vision.box_platform, 'lime', True)
+        elif self.mode == 'confirm':
+            for contour in self._cookies:
+                polyline(contour, 'lime', True, 3)
+        elif self.mode == 'design' and self.vision.pixel_to_mm is not None:
+            polyline(self.vision.pixel_to_mm.to_pixels(self.vision.Xt_mm), 'lime', True)
+            for stroke in self._design_strokes:
+                polyline(self.vision.pixel_to_mm.to_pixels(stroke), 'magenta', False, 1)
+
+    # ---------- Platform watching (own thread) ----------
+
+    def _watch_loop(self):
+        # Learns the empty platform, then keeps it up to date, while waiting for a cookie
+        frame_id = 0
+        while True:
+            self._watch_platform.wait()
+            frame = self.capture.wait_newer(frame_id)
+            if frame is None:
+                time.sleep(0.05) # Camera stopped
+                continue
+            if not self._watch_platform.is_set():
+                continue
+            frame_id = frame.frame_id
+            with self._vision_lock:
+                background = self.vision.background
+                if not background.ready():
+                    if background.learn(frame.image):
+                        background.save(self.vision.background_file)
+                        # Not a task: only shows the message on the Tk thread
+                        self._results.put((None, lambda result: self.message("Place the cookie on the platform and press Scan"), None, None))
+                else:
+                    background.update(frame.image)
+
+    def _latest_image(self):
+        frame = self.capture.latest()
+        if frame is None:
+            raise RuntimeError("No camera frame")
+        return frame.image.copy()
+
+    # ---------- Actions (Tk thread) ----------
+
+    def check_calibration(self):
+        # Uses the last calibration if the red square hasn't moved since then
+        if not self.vision.load_calibration():
+            self.message("Platform needs to be calibrated: press Calibrate")
+            return
+
+        def check():
+            self.worker.submit_file('Scan position', SCAN_POS_FILE).result() # Wait for robot to be in position
+            frames = []
+            frame_id = 0
+            for i in range(5):
+                frame = self.capture.wait_newer(frame_id)
+                if frame is None:
+                    break
+                frame_id = frame.frame_id
+                frames.append(frame.image)
+            return len(frames) == 5 and self.vision.check_calibration(frames)
+
+        def done(good):
+            if good:
+                self.message("Calibration is still good: no need to calibrate")
+                return
+            # Scanning is disabled until the platform is calibrated again
+            with self._vision_lock:
+                self.vision.clear_calibration()
+            self.message("Platform needs to be calibrated: press Calibrate")
+
+        self.run_task('calibration check', check, done)
+
+    def _calibrate(self):
+        if self.mode == 'home':
+            self.worker.submit_file('Scan position', SCAN_POS_FILE)
+            self.calibrated = False
+            self.set_mode('calibrate')
+            self.message("Put the empty platform with the red square under the camera and press Calibrate")
+            return
+
+        def calibrate():
+            with self._vision_lock:
+                # The last calibration is kept if the red square isn't found
+                last = (self.vision.square_rect, self.vision.resolution)
+                self.vision.square_rect = None
+                self.vision.calibrate(self._latest_image(), im_show = False)
+                if self.vision.square_rect is None:
+                    self.vision.square_rect, self.vision.resolution = last
+                    return False
+            return True
+
+        def done(found):
+            self.calibrated = found
+            self._draw_overlay()
+            self.message("Calibrated: save it if the boxes match the platform" if found else "Red square not found")
+
+        self.run_task('calibration', calibrate, done)
+
+    def _save_calibration(self):
+        self.vision.save_calibration()
+        self.message("Calibration saved")
+
+    def _scan(self):
+        if self.mode != 'scan':
+            self._batch = False
+            self._repeat = False
+            self._start_scan()
+            return
+        if not self.vision.background.ready():
+            self.message("Still learning the empty platform")
+            return
+
+        def scan():
+            with self._vision_lock:
+                start = time.time()
+                image = self._latest_image()
+                if self._batch:
+                    cookies = self.vision.scan_cookies(image)
+                else:
+                    cookie = self.vision.scan_cookie(image)
+                    cookies = [] if cookie is None else [cookie]
+                self.vision.scan_time = time.time() - start
+            return cookies
+
+        def done(cookies):
+            self._cookies = cookies
+            if len(cookies) == 0:
+                self.message("No cookie found: scan again")
+                self.set_mode('scan')
+                return
+            self.set_mode('confirm')
+            self.message("Found %d cookie%s in %.0f ms: correct?" % (len(cookies), 's' if len(cookies) > 1 else '', self.vision.scan_time * 1000))
+
+        self.run_task('scan', scan, done)
+
+    def _start_scan(self):
+        self.worker.submit_file('Scan position', SCAN_POS_FILE)
+        self.set_mode('scan')
+        if self.vision.background.ready():
+            self.message("Place the cookie on the platform and press Scan")
+
+    def _batch_scan(self):
+        self._batch = True
+        self._repeat = False
+        self._start_scan()
+
+    def _repeat_scan(self):
+        self._batch = False
+        self._repeat = True
+        self._start_scan()
+
+    def _relearn(self):
+        with self._vision_lock:
+            self.vision.background.reset()
+        self.message("Relearning the background: make sure the platform is empty")
+
+    def _rescan(self):
+        self._cookies = []
+        self.set_mode('scan')
+        self.message("Place the cookie on the platform and press Scan")
+
+    def _accept(self):
+        self.vision.contours = self._cookies[0]
+        self.vision.contour_list = self._cookies
+        if self._batch:
+            def outlines():
+                self.vision.gen_g_code_outlines()
+                return self.vision.Xt_mm_list, self.vision.arcs_list
+            self.run_task('outlines', outlines, lambda result: self._plan_print('Batch', result[0], result[1], 'Batch.txt'))
+            return
+
+        def outline():
+            self.vision.gen_g_code_outline()
+            designs = [None]
+            if os.path.isdir(DESIGN_DIR):
+                designs += sorted(os.listdir(DESIGN_DIR))
+            if self._repeat:
+                return designs, None
+            return designs, self.toolpaths.fill_cookie(self.vision.Xt_mm, designs[0])
+
+        def done(result):
+            self._designs, strokes = result
+            if self._repeat:
+                self._print(self.repeat_design)
+                return
+            self._design_index = 0
+            self._show_design(strokes)
+
+        self.run_task('outline', outline, done)
+
+    def _show_design(self, strokes):
+        self._design_strokes = strokes
+        self.set_mode('design')
+        self.design_text.set('Design: ' + str(self._designs[self._design_index] or 'Full'))
+        self.message("Next design, Print or Outline only")
+
+    def _next_design(self):
+        self._design_index = (self._design_index + 1) % len(self._designs)
+        design = self._designs[self._design_index]
+        self.run_task('design', lambda: self.toolpaths.fill_cookie(self.vision.Xt_mm, design), self._show_design)
+
+    def _print_design(self):
+        self._print(self._designs[self._design_index])
+
+    def _print_outline(self):
+        self._print('outline')
+
+    def _print(self, design):
+        def strokes():
+            design_strokes = []
+            if design != 'outline':
+                design_strokes = self.toolpaths.fill_cookie(self.vision.Xt_mm, design)
+            return [self.vision.Xt_mm] + design_strokes, [self.vision.arcs] + [None] * len(design_strokes)
+
+        def done(result):
+            self.repeat_design = design
+            self._plan_print('Cookie', result[0], result[1], 'Trial.txt')
+
+        self.run_task('design', strokes, done)
+
+    def _plan_print(self, name, strokes, arcs, archive):
+        # Dry run with sim_classes.Job_Simulator: only prints that stay on the
+        # platform and don't run the syringe empty go to the robot
+        def simulate():
+            simulator = Job_Simulator(bounds = self.vision.platform_mm(), z_capacity = self.z_capacity)
+            return simulator.simulate(self.worker.robot.iter_strokes(strokes, arcs = arcs))
+
+        def done(report):
+            if not report['ok']:
+                line_number, line, reason = report['errors'][0]
+                self.message("Print rejected: %d problems (line %d '%s': %s)" % (len(report['errors']), line_number, line, reason))
+                self.set_mode('home')
+                return
+            self.print_job = self.worker.submit_strokes(name, strokes, estimate = report['time'], archive = archive,
+                                                        arcs = arcs, checkpoint = self.checkpoint_file)
+            self.set_mode('print')
+            self.message("Printing: estimated %.0f s (queue %.0f s)" % (report['time'], self.worker.time_left()))
+
+        self.run_task('simulation', simulate, done)
+
+    def _resume_problem(self):
+        # Why the last print can't be resumed (None if it can). GCode_EX.resume checks the same
+        if self.checkpoint_file is None:
+            return "Prints aren't checkpointed, so it can't be resumed"
+        checkpoint = Job_Checkpoint(self.checkpoint_file)
+        if not checkpoint.load():
+            return "There is no print to resume"
+        if checkpoint.complete:
+            return "The last print finished: there is nothing to resume"
+        if checkpoint.lost:
+            return "The last print lost track of where it stopped: it can't be resumed, start the cookie over"
+        if checkpoint.program is None or not os.path.isfile(checkpoint.program):
+            return "The program of the last print is gone: it can't be resumed"
+        return None
+
+    def _resume(self):
+        problem = self._resume_problem()
+        if problem is not None:
+            self.message(problem)
+            return
+        self.print_job = self.worker.submit_resume('Resume', self.checkpoint_file)
+        self.set_mode('print')
+        self.message("Resuming the last print")
+
+    def _home(self):
+        self.worker.submit_file('Home', HOME_FILE)
+        self.set_mode('home')
+        self.message("Homing")
+
+    def _pause(self):
+        if self.worker.paused:
+            self.worker.resume()
+        else:
+            self.worker.pause()
+
+    def _abort(self):
+        self.message("Aborting robot jobs")
+        self.worker.abort()
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._watch_platform.clear()
+        self.message("Homing after the queued jobs, then closing")
+        self._refresh_buttons()
+
+        def home():
+            try:
+                self.worker.submit_file('Home', HOME_FILE).result() # Runs after any queued jobs
+            except Exception as e:
+                print(e)
+                print("Error occured while homing the robot")
+            self._homed.set()
+
+        # The window closes once the robot is home (see _tick)
+        threading.Thread(target = home, name = 'console-close', daemon = True).start()
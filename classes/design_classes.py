@@ -0,0 +1,419 @@
+import numpy as np
+import cv2 as cv
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Folder design images are picked from in DESIGN SELECTION mode (found relative to this file)
+DESIGN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'designs')
+# Toolpaths generated from the designs are kept here between runs
+TOOLPATH_CACHE_DIR = os.path.join(DESIGN_DIR, 'toolpath_cache')
+
+def rotate_points(points, angle):
+    """
+    Purpose: Rotate points about the origin
+        - points (array of flt [x y]): Points to rotate
+        - angle (float): Angle in degrees (counter-clockwise)
+    Returns: Array of the rotated points
+    """
+    a = np.radians(angle)
+    rotation = np.array([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+    return np.asarray(points, dtype = float).reshape(-1, 2) @ rotation.T
+
+def scanline_crossings(polygons, ys):
+    """
+    Purpose: Find where every horizontal scanline crosses the edges of a set of
+        polygons. All edges and scanlines are checked in one NumPy pass.
+        - polygons (list of array of flt [x y]): Closed polygons (the last
+        point connects back to the first). Holes are just more polygons.
+        - ys (array of flt): Y-coordinate of every scanline
+    Returns: (rows, xs) sorted by scanline, then x. rows is the index of the
+        scanline and xs where it crosses an edge. Every scanline crosses an
+        even number of times.
+    """
+    polygons = [np.asarray(polygon, dtype = float).reshape(-1, 2) for polygon in polygons if len(polygon) >= 3]
+    if not polygons or len(ys) == 0:
+        return np.zeros(0, dtype = int), np.zeros(0)
+    start = np.vstack(polygons)
+    end = np.vstack([np.roll(polygon, -1, axis = 0) for polygon in polygons])
+    # Half open test so a scanline through a vertex is only counted once
+    crosses = (start[:, 1] <= ys[:, None]) != (end[:, 1] <= ys[:, None])
+    rows, edges = np.nonzero(crosses)
+    x1, y1 = start[edges, 0], start[edges, 1]
+    x2, y2 = end[edges, 0], end[edges, 1]
+    xs = x1 + (ys[rows] - y1) * (x2 - x1) / (y2 - y1)
+    order = np.lexsort((xs, rows))
+    return rows[order], xs[order]
+
+def count_crossings_before(rows, xs, query_rows, query_xs):
+    """
+    Purpose: For every query point, count the crossings on its scanline that
+        are left of it. An odd count means the point is inside the polygons.
+        - rows, xs (arrays): Crossings from scanline_crossings (sorted)
+        - query_rows, query_xs (arrays): Scanline and x of every query point
+    Returns: Array of counts, one per query point
+    """
+    if len(rows) == 0:
+        return np.zeros(len(query_rows), dtype = int)
+    # One sorted key per crossing: scanlines never overlap
+    width = 2 * max(np.abs(xs).max(), np.abs(query_xs).max() if len(query_xs) else 0) + 1
+    keys = rows * width + xs
+    row_start = np.searchsorted(keys, query_rows * width - width / 2)
+    return np.searchsorted(keys, query_rows * width + query_xs) - row_start
+
+def design_polygons(image, threshold = 127):
+    """
+    Purpose: Turn a design image into polygons. Dark parts of the image are
+        frosted, light parts are left bare.
+        - image (array): Design image (BGR or grayscale)
+        - threshold (int): Gray level splitting dark from light
+    Returns: List of polygons in pixels (outlines and holes)
+    """
+    if image.ndim == 3:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    ret, mask = cv.threshold(image, threshold, 255, cv.THRESH_BINARY_INV)
+    contours, hirarchy = cv.findContours(mask, cv.RETR_CCOMP, cv.CHAIN_APPROX_SIMPLE)
+    return [np.reshape(cnt, (-1, 2)).astype(float) for cnt in contours if len(cnt) >= 3]
+
+class Design_Fill:
+    """
+    Purpose: Turn a design into hatch (scanline) strokes that frost the inside
+        of a scanned cookie. The whole set of scanlines is intersected with the
+        cookie outline and the design at once, so a full cookie takes a few
+        milliseconds instead of adding to cycle time.
+    Instance Variables:
+        self.spacing (float): Distance between hatch lines (in mm)
+        self.angle (float): Direction of the hatch lines (degrees from x-axis)
+        self.margin (float): Distance kept from the edge of the cookie (in mm)
+        self.fit (float): Fraction of the cookie's size the design is scaled to
+        self.threshold (int): Gray level splitting dark from light in designs
+    Methods:
+        load_design(self, file_name)
+            Reads a design image (from DESIGN_DIR unless a path is given) and
+            returns its polygons in pixels, or None if it can't be read
+        place_design(self, polygons, outline)
+            Scales and centers design polygons (pixels) onto a cookie outline
+            (mm). Returns the polygons in mm
+        design_scale(self, polygons, outline)
+            Returns (scale, design center, cookie center) used by place_design.
+            scale is in mm per design pixel
+        hatch(self, outline, design)
+            Returns the hatch strokes (list of 2 point arrays, in mm) covering
+            the inside of outline. If design (polygons in mm) is given, only
+            the parts inside both are covered. Lines alternate direction so
+            neighbours start close to where the last one ended.
+        clip_strokes(self, strokes, outline, design)
+            Cuts hatch strokes (in mm, along self.angle) down to the parts
+            inside the cookie outline and the design, keeping margin from the
+            edge of the cookie like hatch does
+        hatch_polygons(self, polygons)
+            Hatch strokes covering polygons (in mm) without a cookie outline
+        fill_cookie(self, outline, design_file)
+            Hatch strokes for a design file on a cookie outline (in mm). No
+            design_file frosts the whole cookie.
+    """
+
+    def __init__(self, spacing = 1.5, angle = 0, margin = 1.0, fit = 0.8, threshold = 127):
+        self.spacing = spacing
+        self.angle = angle
+        self.margin = margin
+        self.fit = fit
+        self.threshold = threshold
+
+    def load_design(self, file_name):
+        file_path = file_name if os.path.dirname(file_name) else os.path.join(DESIGN_DIR, file_name)
+        image = cv.imread(file_path, cv.IMREAD_GRAYSCALE)
+        if image is None:
+            print("Could not read design " + file_path)
+            return None
+        return design_polygons(image, self.threshold)
+
+    def place_design(self, polygons, outline):
+        outline = np.asarray(outline, dtype = float).reshape(-1, 2)
+        if not polygons or len(outline) < 3:
+            return []
+        scale, design_center, cookie_center = self.design_scale(polygons, outline)
+        return [(polygon - design_center) * scale + cookie_center for polygon in polygons]
+
+    def design_scale(self, polygons, outline):
+        outline = np.asarray(outline, dtype = float).reshape(-1, 2)
+        points = np.vstack(polygons)
+        design_low, design_high = points.min(axis = 0), points.max(axis = 0)
+        cookie_low, cookie_high = outline.min(axis = 0), outline.max(axis = 0)
+        # Keep the design's aspect ratio and fit it in the cookie's bounding box
+        scale = self.fit * np.min((cookie_high - cookie_low) / np.maximum(design_high - design_low, 1e-9))
+        return scale, (design_low + design_high) / 2, (cookie_low + cookie_high) / 2
+
+    def hatch(self, outline, design = None):
+        outline = np.asarray(outline, dtype = float).reshape(-1, 2)
+        if len(outline) < 3 or self.spacing <= 0:
+            return []
+        # Rotate everything so the hatch lines are horizontal scanlines
+        cookie = [rotate_points(outline, -self.angle)]
+        low, high = cookie[0][:, 1].min(), cookie[0][:, 1].max()
+        ys = np.arange(low + self.spacing / 2, high, self.spacing)
+        rows, xs = scanline_crossings(cookie, ys)
+        if design is not None:
+            design = [rotate_points(polygon, -self.angle) for polygon in design]
+            line_rows, line_start, line_end = self._pieces([(rows, xs), scanline_crossings(design, ys)])
+        else:
+            # Crossings come in in/out pairs along each scanline
+            line_rows, line_start, line_end = rows[0::2], xs[0::2], xs[1::2]
+        return self._trim(ys, rows, xs, line_rows, line_start, line_end)
+
+    def clip_strokes(self, strokes, outline, design = None):
+        strokes = np.asarray(strokes, dtype = float).reshape(-1, 2)
+        outline = np.asarray(outline, dtype = float).reshape(-1, 2)
+        if len(strokes) == 0 or len(outline) < 3:
+            return []
+        # Strokes run along the hatch direction: turn them into pieces of scanlines
+        ends = rotate_points(strokes, -self.angle).reshape(-1, 2, 2)
+        ys, stroke_rows = np.unique(np.round(ends[:, :, 1].mean(axis = 1), 9), return_inverse = True)
+        order = np.lexsort((ends[:, :, 0].min(axis = 1), stroke_rows))
+        stroke_xs = np.column_stack((ends[:, :, 0].min(axis = 1), ends[:, :, 0].max(axis = 1)))[order].ravel()
+        stroke_rows = np.repeat(stroke_rows[order], 2)
+        rows, xs = scanline_crossings([rotate_points(outline, -self.angle)], ys)
+        shapes = [(rows, xs), (stroke_rows, stroke_xs)]
+        if design is not None:
+            shapes.append(scanline_crossings([rotate_points(polygon, -self.angle) for polygon in design], ys))
+        line_rows, line_start, line_end = self._pieces(shapes)
+        return self._trim(ys, rows, xs, line_rows, line_start, line_end)
+
+    def _pieces(self, shapes):
+        # Every boundary of any shape splits a scanline into pieces.
+        # Keep the pieces whose middle is inside all of the shapes.
+        all_rows = np.concatenate([rows for rows, xs in shapes])
+        all_xs = np.concatenate([xs for rows, xs in shapes])
+        order = np.lexsort((all_xs, all_rows))
+        all_rows, all_xs = all_rows[order], all_xs[order]
+        same_row = all_rows[:-1] == all_rows[1:]
+        piece_rows = all_rows[:-1][same_row]
+        piece_start = all_xs[:-1][same_row]
+        piece_end = all_xs[1:][same_row]
+        middle = (piece_start + piece_end) / 2
+        inside = piece_end - piece_start > 1e-6 # Shapes sharing a boundary leave slivers
+        for rows, xs in shapes:
+            inside &= count_crossings_before(rows, xs, piece_rows, middle) % 2 == 1
+        return piece_rows[inside], piece_start[inside], piece_end[inside]
+
+    def _trim(self, ys, rows, xs, line_rows, line_start, line_end):
+        # Keep clear of the edge of the cookie (rows, xs are its crossings)
+        edge_start = count_crossings_before(rows, xs, line_rows, line_start - self.margin) % 2 == 0
+        edge_end = count_crossings_before(rows, xs, line_rows, line_end + self.margin) % 2 == 0
+        line_start = np.where(edge_start, line_start + self.margin, line_start)
+        line_end = np.where(edge_end, line_end - self.margin, line_end)
+        keep = line_end > line_start
+        return self._strokes(ys, line_rows[keep], line_start[keep], line_end[keep])
+
+    def hatch_polygons(self, polygons):
+        polygons = [rotate_points(polygon, -self.angle) for polygon in polygons if len(polygon) >= 3]
+        if not polygons or self.spacing <= 0:
+            return []
+        points = np.vstack(polygons)
+        ys = np.arange(points[:, 1].min() + self.spacing / 2, points[:, 1].max(), self.spacing)
+        rows, xs = scanline_crossings(polygons, ys)
+        return self._strokes(ys, rows[0::2], xs[0::2], xs[1::2])
+
+    def _strokes(self, ys, line_rows, line_start, line_end):
+        # Draw every other scanline backwards (zig-zag)
+        backwards = line_rows % 2 == 1
+        first = np.where(backwards, line_end, line_start)
+        last = np.where(backwards, line_start, line_end)
+        y = ys[line_rows]
+        ends = np.column_stack((first, y, last, y)).reshape(-1, 2)
+        ends = rotate_points(ends, self.angle).reshape(-1, 2, 2)
+        return list(ends)
+
+    def fill_cookie(self, outline, design_file = None):
+        design = None
+        if design_file is not None:
+            polygons = self.load_design(design_file)
+            if polygons is None:
+                return []
+            design = self.place_design(polygons, outline)
+        return self.hatch(outline, design)
+
+class Toolpath_Cache:
+    """
+    Purpose: Remember the hatch strokes of every design, so repeat cookies
+        skip reading and vectorizing the design. The design's polygons are
+        stored once per image (and threshold), so a new size only hatches
+        them again and never re-reads the image. Toolpaths are stored centered
+        on the design at a reference scale and keyed on the image's content
+        hash plus the fill settings. For each new cookie only a scale and
+        translation (affine transform) onto its outline runs, then the strokes
+        are clipped to the cookie and to the design at the cookie's own scale.
+        Recently used toolpaths are kept in memory, the rest in compressed
+        .npz files.
+    Instance Variables:
+        self.fill (Design_Fill): Fill settings and the engine used on a miss
+        self.cache_dir (str): Folder the .npz files are kept in (None to only
+            cache in memory)
+        self.max_entries (int): Toolpaths kept in memory (least recently used
+            ones are dropped first)
+        self.scale_step (float): Relative size steps toolpaths are stored at.
+            Cookies within half a step of the reference scale reuse its
+            toolpaths (the hatch spacing changes by at most that much)
+        self.memory (OrderedDict): key -> (reference scale, strokes array),
+            least recently used first
+        self.stats (dict): Counts of memory hits, disk hits and misses, and
+            of designs vectorized from their image
+    Methods:
+        fill_cookie(self, outline, design_file)
+            Same as Design_Fill.fill_cookie, using the cache for design files.
+            Thread safe, so one cache can be shared by several robots (see
+            fleet_classes.Fleet)
+        clear(self)
+            Empties the in-memory cache
+    """
+
+    def __init__(self, fill, cache_dir = TOOLPATH_CACHE_DIR, max_entries = 32, scale_step = 0.05):
+        self.fill = fill
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.scale_step = scale_step
+        self.memory = OrderedDict()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'vectorized': 0}
+        self._hashes = {} # (path, size, mtime) -> content hash
+        self._designs = {} # design key -> (design size, design center, polygons) in pixels
+        self._lock = threading.RLock()
+
+    def clear(self):
+        with self._lock:
+            self.memory.clear()
+
+    def fill_cookie(self, outline, design_file = None):
+        with self._lock:
+            return self._fill_cookie(outline, design_file)
+
+    def _fill_cookie(self, outline, design_file):
+        outline = np.asarray(outline, dtype = float).reshape(-1, 2)
+        if design_file is None or len(outline) < 3:
+            return self.fill.fill_cookie(outline, design_file) # Whole cookie: depends on its outline
+        file_path = design_file if os.path.dirname(design_file) else os.path.join(DESIGN_DIR, design_file)
+        try:
+            digest = self._content_hash(file_path)
+        except OSError as e:
+            print(e)
+            print("Could not read design " + file_path)
+            return []
+        design = self._design('%s-t%d' % (digest, self.fill.threshold), file_path)
+        if design is None:
+            return []
+        size, design_center, polygons = design
+        # Same fit as Design_Fill.place_design, from the cached design size
+        cookie_low, cookie_high = outline.min(axis = 0), outline.max(axis = 0)
+        scale = self.fill.fit * np.min((cookie_high - cookie_low) / np.maximum(size, 1e-9))
+        step = int(np.round(np.log(scale) / np.log1p(self.scale_step)))
+        key = '%s-s%d-%g-%g-%d-%g' % (digest, step, self.fill.spacing, self.fill.angle, self.fill.threshold, self.fill.fit)
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            self.stats['memory_hits'] += 1
+        else:
+            entry = self._read(key)
+            if entry is not None:
+                self.stats['disk_hits'] += 1
+            else:
+                entry = self._hatch(design, (1 + self.scale_step) ** step)
+                self.stats['misses'] += 1
+                self._write(key, entry)
+            self._remember(key, entry)
+        reference_scale, strokes = entry
+        # Affine transform onto this cookie
+        cookie_center = (cookie_low + cookie_high) / 2
+        placed = strokes * (scale / reference_scale) + cookie_center
+        # Clip to the cookie and to the design at this cookie's exact scale, so
+        # rounding to the reference scale never draws past either edge
+        design = [(polygon - design_center) * scale + cookie_center for polygon in polygons]
+        return self.fill.clip_strokes(placed, outline, design)
+
+    def _content_hash(self, file_path):
+        info = os.stat(file_path)
+        file_id = (file_path, info.st_size, info.st_mtime)
+        if file_id not in self._hashes:
+            with open(file_path, 'rb') as f:
+                self._hashes[file_id] = hashlib.sha1(f.read()).hexdigest()
+        return self._hashes[file_id]
+
+    def _design(self, design_key, file_path):
+        # Polygons of a design: from memory, its .npz file or the image
+        if design_key in self._designs:
+            return self._designs[design_key]
+        polygons = self._read_design(design_key)
+        if polygons is None:
+            # Vectorize the design (the slow part)
+            polygons = self.fill.load_design(file_path)
+            if not polygons:
+                return None
+            self.stats['vectorized'] += 1
+            self._write_design(design_key, polygons)
+        points = np.vstack(polygons)
+        low, high = points.min(axis = 0), points.max(axis = 0)
+        self._designs[design_key] = (high - low, (low + high) / 2, polygons)
+        return self._designs[design_key]
+
+    def _hatch(self, design, reference_scale):
+        # Hatch the design's polygons centered on the design at reference_scale
+        size, design_center, polygons = design
+        centered = [(polygon - design_center) * reference_scale for polygon in polygons]
+        strokes = self.fill.hatch_polygons(centered)
+        return reference_scale, np.array(strokes).reshape(-1, 2, 2)
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last = False)
+
+    def _read(self, key):
+        if self.cache_dir is None:
+            return None
+        file_path = os.path.join(self.cache_dir, key + '.npz')
+        if not os.path.isfile(file_path):
+            return None
+        try:
+            with np.load(file_path) as data:
+                return float(data['scale']), data['strokes'].astype(float)
+        except Exception as e:
+            print(e)
+            print("Error occured while reading cached toolpath " + file_path)
+            return None
+
+    def _write(self, key, entry):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok = True)
+            # float32 keeps well under the machine's 0.001 mm resolution
+            np.savez_compressed(os.path.join(self.cache_dir, key + '.npz'), scale = entry[0], strokes = entry[1].astype(np.float32))
+        except Exception as e:
+            print(e)
+            print("Error occured while caching toolpath " + key)
+
+    def _read_design(self, design_key):
+        if self.cache_dir is None:
+            return None
+        file_path = os.path.join(self.cache_dir, design_key + '.npz')
+        if not os.path.isfile(file_path):
+            return None
+        try:
+            with np.load(file_path) as data:
+                # All polygons in one array, split at the stored ends
+                return np.split(data['points'].astype(float), data['ends'][:-1])
+        except Exception as e:
+            print(e)
+            print("Error occured while reading cached design " + file_path)
+            return None
+
+    def _write_design(self, design_key, polygons):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok = True)
+            ends = np.cumsum([len(polygon) for polygon in polygons])
+            np.savez_compressed(os.path.join(self.cache_dir, design_key + '.npz'), points = np.vstack(polygons), ends = ends)
+        except Exception as e:
+            print(e)
+            print("Error occured while caching design " + design_key)
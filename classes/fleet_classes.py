@@ -0,0 +1,346 @@
+import asyncio
+import os
+import time
+import serial
+import cv2 as cv
+from classes.g_code_classes import GCode_EX, SCAN_POS_FILE, HOME_FILE
+from classes.job_classes import Robot_Worker
+from classes.vision_classes import Cookie_Vision, CALIBRATION_DIR
+from classes.capture_classes import Frame_Grabber, Scripted_Display, open_source
+from classes.path_classes import Travel_Optimizer
+from classes.design_classes import Design_Fill, Toolpath_Cache
+from classes.sim_classes import Job_Simulator
+
+class Cookie_Order:
+    """
+    Purpose: One cookie to frost, waiting in the Fleet's queue until a robot is
+        free. Whichever robot takes it frosts the next cookie put on its
+        platform.
+    Instance Variables:
+        self.name (str): Name of the order (shown in logs and job names)
+        self.design (str): Design file to frost. None fills the whole cookie,
+            'outline' only frosts the outline
+        self.station (str): Name of the robot that took the order (None while
+            it is waiting)
+        self.future (asyncio.Future): Completes with the Robot_Job progress of
+            the print (or the error that stopped it)
+        self.created / self.started (float): When the order was submitted /
+            taken by a robot
+    """
+
+    def __init__(self, name, design, future):
+        self.name = name
+        self.design = design
+        self.station = None
+        self.future = future
+        self.created = time.time()
+        self.started = None
+
+class Robot_Station:
+    """
+    Purpose: One robot and the camera looking at its platform. Has its own
+        serial port, streamer, job queue (Robot_Worker), calibration and
+        background model. Blocking work (serial, camera, vision) runs on
+        threads so many stations can share one asyncio event loop.
+    Instance Variables:
+        self.name (str): Name of the station. Its calibration and background
+            are kept in <calibration_dir>/<name> (CALIBRATION_DIR by default)
+        self.port (str): Serial port of the robot (e.g. 'COM4')
+        self.source (int, str or obj): Camera index, recording (video file or
+            image directory), or an already opened capture
+        self.vision (Cookie_Vision): Calibration and cookie scanning (no windows)
+        self.robot (GCode_EX) / self.worker (Robot_Worker): Set by open()
+        self.capture (Frame_Grabber): Newest camera frame, set by open()
+        self.state (str): 'closed', 'idle', 'scanning', 'printing',
+            'waiting for pickup', 'error' (could not be opened) or 'offline'
+            (an order failed on it, the Fleet gives it no more orders)
+        self.order (Cookie_Order): Order being made (None if idle)
+        self.cookies (int): Cookies frosted since open()
+        self.settle_frames (int): Frames in a row a cookie has to be seen in
+            (without moving) before it is scanned
+        self.z_capacity (float): Z-coordinate where the syringe is empty
+        self.cookie_timeout (float): Seconds to wait for a cookie to be put on
+            the platform (None waits forever)
+        self.archive (str): Every print is archived to <name>.txt in
+            g_code_classes.GENERATED_DIR (None if archive = False)
+    Methods:
+        open(self) (async)
+            Opens the port and camera, moves to the scan position, then loads
+            the calibration (or calibrates from the red square) and learns
+            the empty platform if there is no background saved
+        close(self) (async)
+            Homes the robot, stops the worker and closes the port and camera
+        make_cookie(self, order, toolpaths) (async)
+            Waits for a cookie, scans it, fills it with the order's design
+            (toolpaths is the shared Toolpath_Cache), checks the job with
+            Job_Simulator and prints it. Waits for the cookie to be taken off
+            before returning the print's progress
+    """
+
+    def __init__(self, name, port, source, baud = 115200, mask_mode = 'exact', settle_frames = 5, z_capacity = 60,
+                 wake_delay = 2, cookie_timeout = None, calibration_dir = CALIBRATION_DIR, archive = True):
+        self.name = name
+        self.port = port
+        self.source = source
+        self.baud = baud
+        self.settle_frames = settle_frames
+        self.z_capacity = z_capacity
+        self.wake_delay = wake_delay
+        self.cookie_timeout = cookie_timeout
+        self.calibration_file = os.path.join(calibration_dir, name, 'calibration.json')
+        self.archive = name + '.txt' if archive else None
+        self.vision = Cookie_Vision(display = Scripted_Display(), mask_mode = mask_mode)
+        self.ser = None
+        self.robot = None
+        self.worker = None
+        self.capture = None
+        self.state = 'closed'
+        self.order = None
+        self.cookies = 0
+
+    async def open(self):
+        await asyncio.to_thread(self._open)
+        await asyncio.wrap_future(self.worker.submit_file('Scan position', SCAN_POS_FILE))
+        await asyncio.to_thread(self._calibrate)
+        self.state = 'idle'
+        print(self.name + ": ready")
+
+    async def close(self):
+        if self.worker is not None:
+            try:
+                await asyncio.wrap_future(self.worker.submit_file('Home', HOME_FILE))
+            except Exception as e:
+                print(e)
+                print("Error occured while homing " + self.name)
+        await asyncio.to_thread(self._close)
+        self.state = 'closed'
+
+    async def make_cookie(self, order, toolpaths):
+        self.order = order
+        try:
+            self.state = 'scanning'
+            await asyncio.wrap_future(self.worker.submit_file('Scan position', SCAN_POS_FILE))
+            contour = await asyncio.wait_for(self._wait_for_cookie(), self.cookie_timeout)
+            strokes, arcs, estimate = await asyncio.to_thread(self._plan, contour, order.design, toolpaths)
+            self.state = 'printing'
+            job = self.worker.submit_strokes(order.name, strokes, estimate = estimate, archive = self.archive, arcs = arcs)
+            progress = await asyncio.wrap_future(job)
+            self.cookies += 1
+            self.state = 'waiting for pickup'
+            await self._wait_for_clear()
+            return progress
+        finally:
+            self.order = None
+            if self.state != 'closed':
+                self.state = 'idle'
+
+    def _open(self):
+        self.ser = serial.Serial(self.port, self.baud, timeout = 1)
+        self.robot = GCode_EX(self.ser, optimizer = Travel_Optimizer())
+        self.robot.streamer.wake_delay = self.wake_delay
+        self.worker = Robot_Worker(self.robot).start()
+        capture = open_source(self.source) if isinstance(self.source, (int, str)) else self.source
+        if not capture.isOpened():
+            raise RuntimeError(self.name + ": cannot open camera " + str(self.source))
+        self.capture = Frame_Grabber(capture).start()
+
+    def _close(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.robot.streamer.stop()
+            self.ser.close()
+        if self.capture is not None:
+            self.capture.release()
+
+    def _read(self):
+        ret, frame = self.capture.read()
+        if not ret:
+            raise RuntimeError(self.name + ": camera stopped giving frames")
+        return frame
+
+    def _calibrate(self):
+        calibrated = False
+        if self.vision.load_calibration(self.calibration_file):
+            calibrated = self.vision.check_calibration([self._read() for i in range(5)])
+        if not calibrated:
+            self.vision.clear_calibration() # The loaded one is stale: nothing may use it if calibrating fails
+            self.vision.calibrate(self._read(), im_show = False)
+            if self.vision.square_rect is None:
+                raise RuntimeError(self.name + ": red calibration square not found")
+            self.vision.save_calibration(self.calibration_file)
+        if not self.vision.background.ready():
+            # Platform has to be empty while the background is learned
+            while not self.vision.background.learn(self._read()):
+                pass
+            self.vision.background.save(self.vision.background_file)
+
+    def _scan(self):
+        # Scan the newest frame. Empty frames keep the background up to date
+        frame = self._read()
+        contour = self.vision.scan_cookie(frame)
+        if contour is None:
+            self.vision.background.update(frame)
+        return contour
+
+    async def _wait_for_cookie(self):
+        seen = 0
+        last_area = None
+        while True:
+            contour = await asyncio.to_thread(self._scan)
+            area = None if contour is None else cv.contourArea(contour)
+            # Same size as last frame: the cookie isn't being moved any more
+            if area is not None and last_area is not None and abs(area - last_area) <= 0.05 * last_area:
+                seen += 1
+            else:
+                seen = 0
+            last_area = area
+            if seen >= self.settle_frames:
+                return contour
+
+    async def _wait_for_clear(self):
+        empty = 0
+        while empty < self.settle_frames:
+            contour = await asyncio.to_thread(self._scan)
+            empty = empty + 1 if contour is None else 0
+
+    def _plan(self, contour, design, toolpaths):
+        self.vision.contours = contour
+        self.vision.gen_g_code_outline()
+        design_strokes = []
+        if design != 'outline':
+            design_strokes = toolpaths.fill_cookie(self.vision.Xt_mm, design)
+        strokes = [self.vision.Xt_mm] + design_strokes
+        arcs = [self.vision.arcs] + [None] * len(design_strokes)
+        simulator = Job_Simulator(bounds = self.vision.platform_mm(), z_capacity = self.z_capacity)
+        report = simulator.simulate(self.robot.iter_strokes(strokes, arcs = arcs))
+        if not report['ok']:
+            line_number, line, reason = report['errors'][0]
+            raise ValueError("%s: print rejected, %d problems (line %d '%s': %s)" % (self.name, len(report['errors']), line_number, line, reason))
+        return strokes, arcs, report['time']
+
+class Fleet:
+    """
+    Purpose: Runs several Robot_Stations from one process. Cookie orders go
+        into one queue, and a single scheduler hands each order to the next
+        robot that is idle. Every station shares the same design fill and
+        Toolpath_Cache, so a design is only vectorized once for the whole line.
+    Instance Variables:
+        self.stations (list of Robot_Station): Robots in the fleet
+        self.fill (Design_Fill): Hatch fill settings shared by every robot
+        self.toolpaths (Toolpath_Cache): Shared design toolpaths
+        self.orders (asyncio.Queue): Orders waiting for a robot
+        self.finished (list of Cookie_Order): Orders that are done (also the
+            failed ones)
+    Methods:
+        submit(self, design = None, name = None)
+            Queues a cookie order and returns the Cookie_Order. Has to be
+            called from the event loop's thread. If no station can take
+            orders (none could be opened, or every one went offline after a
+            failed order), the order fails right away
+        start(self) (async)
+            Opens every station (at the same time) and starts the scheduler
+        join(self) (async)
+            Waits until every queued order is finished
+        stop(self) (async)
+            Stops the scheduler and closes every station
+        status(self)
+            List of dictionaries with every station's name, state, order
+            and cookies made
+    """
+
+    def __init__(self, stations, fill = None, toolpaths = None):
+        self.stations = list(stations)
+        self.fill = fill if fill is not None else Design_Fill(spacing = 1.5)
+        self.toolpaths = toolpaths if toolpaths is not None else Toolpath_Cache(self.fill)
+        self.orders = asyncio.Queue()
+        self.finished = []
+        self._count = 0
+        self._scheduler = None
+        self._running = set()
+
+    def submit(self, design = None, name = None):
+        self._count += 1
+        order = Cookie_Order(name or 'Cookie %d' % self._count, design, asyncio.get_running_loop().create_future())
+        self.orders.put_nowait(order)
+        return order
+
+    async def start(self):
+        results = await asyncio.gather(*[station.open() for station in self.stations], return_exceptions = True)
+        for station, result in zip(self.stations, results):
+            if isinstance(result, Exception):
+                print(result)
+                print("Error occured while opening " + station.name + ": it won't take orders")
+                station.state = 'error'
+        self._scheduler = asyncio.create_task(self._schedule())
+
+    async def join(self):
+        await self.orders.join()
+
+    async def stop(self):
+        if self._scheduler is not None:
+            self._scheduler.cancel()
+            try:
+                await self._scheduler
+            except asyncio.CancelledError:
+                pass
+            self._scheduler = None
+        for task in list(self._running):
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions = True)
+        await asyncio.gather(*[station.close() for station in self.stations if station.state != 'error'], return_exceptions = True)
+
+    def status(self):
+        return [{'name': station.name, 'state': station.state, 'cookies': station.cookies,
+                 'order': None if station.order is None else station.order.name} for station in self.stations]
+
+    async def _schedule(self):
+        idle = asyncio.Queue()
+        for station in self.stations:
+            if station.state == 'idle':
+                idle.put_nowait(station)
+        while True:
+            order = await self.orders.get()
+            if not self._usable():
+                # No robot left: the order would wait forever (and join() never return)
+                self._fail(order)
+                continue
+            station = await idle.get()
+            if station is None:
+                # The last robot went offline while the order was waiting
+                idle.put_nowait(None)
+                self._fail(order)
+                continue
+            order.station = station.name
+            order.started = time.time()
+            task = asyncio.create_task(self._run_order(station, order, idle))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_order(self, station, order, idle):
+        try:
+            order.future.set_result(await station.make_cookie(order, self.toolpaths))
+            print("%s: %s done in %.1f s" % (station.name, order.name, time.time() - order.started))
+        except asyncio.CancelledError:
+            order.future.cancel()
+            raise
+        except Exception as e:
+            print(e)
+            print("Error occured while " + station.name + " was making " + order.name + ": it won't take orders")
+            order.future.set_exception(e)
+            station.state = 'offline'
+            if not self._usable():
+                idle.put_nowait(None) # Wakes the scheduler if it is waiting for a robot
+        else:
+            idle.put_nowait(station)
+        finally:
+            self.finished.append(order)
+            self.orders.task_done()
+
+    def _usable(self):
+        return any(station.state not in ('error', 'offline') for station in self.stations)
+
+    def _fail(self, order):
+        print("No robots left: " + order.name + " failed")
+        order.future.set_exception(RuntimeError("No robot in the fleet can take orders"))
+        self.finished.append(order)
+        self.orders.task_done()
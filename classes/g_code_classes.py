@@ -3,6 +3,277 @@ import serial
 import time
 import numpy as np
 import os
+import queue
+import threading
+import logging
+from classes.stream_classes import Grbl_Streamer, Job_Checkpoint
+from classes.metrics_classes import METRICS
+
+# G-code scripts and the folder generated g-code is archived in (found relative to this file)
+GCODE_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gcode_scripts')
+SCAN_POS_FILE = os.path.join(GCODE_SCRIPTS_DIR, 'scan_pos.txt')
+HOME_FILE = os.path.join(GCODE_SCRIPTS_DIR, 'home.txt')
+GENERATED_DIR = os.path.join(GCODE_SCRIPTS_DIR, 'generated_code')
+
+log = logging.getLogger(__name__)
+
+def segment_lengths(coordinates, arcs = None):
+    """
+    Purpose: Length of every move in a toolpath
+        - coordinates (array of flt [x y]): Points of the toolpath (in mm)
+        - arcs (array of flt [direction, i, j]): Optional row per point saying
+        the move ending there is an arc (see path_classes.fit_arcs)
+    Returns: Array of lengths, one per move (one less than the points)
+    """
+    xy = np.asarray(coordinates, dtype = float).reshape(-1, 2)
+    seg_length = np.hypot(*np.diff(xy, axis = 0).T)
+    if arcs is not None and len(xy) > 1:
+        arcs = np.asarray(arcs, dtype = float).reshape(-1, 3)[1:]
+        is_arc = arcs[:, 0] != 0
+        if np.any(is_arc):
+            # Arc length = radius * angle swept from the start to the end point
+            start = xy[:-1][is_arc]
+            end = xy[1:][is_arc]
+            center = start + arcs[is_arc, 1:]
+            a_start = np.arctan2(start[:, 1] - center[:, 1], start[:, 0] - center[:, 0])
+            a_end = np.arctan2(end[:, 1] - center[:, 1], end[:, 0] - center[:, 0])
+            sweep = np.where(arcs[is_arc, 0] == 2, a_start - a_end, a_end - a_start) % (2 * np.pi)
+            seg_length[is_arc] = np.hypot(arcs[is_arc, 1], arcs[is_arc, 2]) * sweep
+    return seg_length
+
+def extrusion_profile(coordinates, extrude_rate = 0.1, z_start = 0, decimals = 2, arcs = None):
+    """
+    Purpose: Calculate the z-axis (extrusion) coordinate of every point in a
+        toolpath in one vectorized pass. The z-axis moves by extrude_rate for
+        every mm the nozzle travels in x and y.
+        - coordinates (array of flt [x y]): Points of the toolpath (in mm)
+        - extrude_rate (float): Z travel per mm of x/y travel
+        - z_start (float): Z-coordinate of the first point
+        - decimals (int): Decimal places to round to (None to not round)
+        - arcs (array of flt [direction, i, j]): Optional arc rows (see
+        segment_lengths). Arcs extrude along their arc length, not their chord.
+    Returns: Array of z-coordinates, one per point
+    """
+    xy = np.asarray(coordinates, dtype = float).reshape(-1, 2)
+    z = np.full(len(xy), float(z_start))
+    if len(xy) > 1:
+        # Length of every segment, then the running sum of the extrusion
+        z[1:] += np.cumsum(extrude_rate * segment_lengths(xy, arcs))
+    if decimals is None:
+        return z
+    return np.round(z, decimals)
+
+def format_moves(xyz, command = 'G01', xy_decimals = 3, z_decimals = 2, eol = '\n', arcs = None):
+    """
+    Purpose: Format a whole array of [x y z] moves into g-code in one batch
+        - xyz (array of flt [x y z]): Moves to format
+        - command (str): G-code command put in front of every move
+        - xy_decimals (int): Decimal places written for x and y
+        - z_decimals (int): Decimal places written for z
+        - eol (str): End of line characters
+        - arcs (array of flt [direction, i, j]): Optional row per move. Moves
+        with direction 2 or 3 are written as G02/G03 with I and J words.
+    Returns: String holding one line of g-code per move
+    """
+    xyz = np.asarray(xyz, dtype = float).reshape(-1, 3)
+    line = '%s X%%.%df Y%%.%df Z%%.%df%s' % (command, xy_decimals, xy_decimals, z_decimals, eol)
+    if arcs is None or not np.any(np.asarray(arcs)[:, 0]):
+        return (line * len(xyz)) % tuple(xyz.ravel())
+    arcs = np.asarray(arcs, dtype = float).reshape(-1, 3)
+    direction = arcs[:, 0].astype(int)
+    arc_line = ' X%%.%df Y%%.%df Z%%.%df I%%.%df J%%.%df%s' % (xy_decimals, xy_decimals, z_decimals, xy_decimals, xy_decimals, eol)
+    templates = np.where(direction == 0, line, np.where(direction == 2, 'G02' + arc_line, 'G03' + arc_line))
+    # Lines take 3 values (x y z), arcs take 5 (x y z i j)
+    used = np.column_stack((np.ones((len(xyz), 3), dtype = bool), np.repeat(direction[:, None] != 0, 2, axis = 1)))
+    values = np.column_stack((xyz, arcs[:, 1:]))[used]
+    return ''.join(templates) % tuple(values)
+
+def read_gcode(file_name):
+    """
+    Purpose: Lazily yield the lines of a g-code file so it never has to be
+        read into memory all at once
+        - file_name (str): File that holds the g-code
+    """
+    with open(file_name, 'r') as f:
+        for line in f:
+            yield line
+
+def archive_gcode(lines, file_path, complete = False):
+    """
+    Purpose: Pass lines of g-code through unchanged while a background thread
+        writes a copy of them to file_path. Disk I/O never holds up whoever is
+        consuming the lines (e.g. the streamer).
+        - lines (iterable of str): Lines of g-code (with EOL characters)
+        - file_path (str): File to write the copy to
+        - complete (bool): If the consumer stops early (the generator is
+          closed), the rest of the lines are still generated into the copy,
+          and the copy is finished before close() returns. Checkpointed jobs
+          need the whole program on disk to be resumed
+    """
+    lines = iter(lines)
+    copy_queue = queue.Queue()
+
+    def write_copy():
+        try:
+            with open(file_path, 'w') as f:
+                for line in iter(copy_queue.get, None):
+                    f.write(line)
+        except Exception as e:
+            print(e)
+            print("Error occured while archiving g-code to " + file_path)
+            # Keep draining so the producer never blocks on a dead writer
+            for line in iter(copy_queue.get, None):
+                pass
+
+    writer = threading.Thread(target = write_copy, name = 'gcode-archive', daemon = True)
+    writer.start()
+    try:
+        for line in lines:
+            copy_queue.put(line)
+            yield line
+    finally:
+        if complete:
+            for line in lines:
+                copy_queue.put(line)
+        copy_queue.put(None)
+        if complete:
+            writer.join()
+
+def format_values(values, decimals):
+    """
+    Purpose: Format an array of integer counts (value * 10^decimals) as the
+        shortest decimal strings, e.g. 42500 with 3 decimals -> '42.5'
+        - values (array of int): Values in units of 10^-decimals
+        - decimals (int): Number of decimal places
+    Returns: Array of str
+    """
+    text = np.char.mod('%.' + str(decimals) + 'f', np.asarray(values) / 10 ** decimals)
+    if decimals > 0:
+        # Strip trailing zeros, then a trailing decimal point
+        text = np.char.rstrip(np.char.rstrip(text, '0'), '.')
+    return text
+
+class Compact_Emitter:
+    """
+    Purpose: Emit byte-minimal g-code so more segments per second fit through
+        the 115200 baud link and grbl's 127 byte RX buffer. Values are rounded
+        to the machine resolution with trailing zeros stripped, G1 is modal
+        (only written when the motion mode changes), unchanged axes are left
+        out, and moves that round to nothing are dropped.
+    Instance Variables:
+        self.xy_decimals (int): Decimal places for x and y (0.001 mm = 3)
+        self.z_decimals (int): Decimal places for z
+        self.relative_z (bool): Write draw moves in incremental mode (G91) so
+            the numbers sent stay small instead of z growing without bound.
+            Deltas are taken between rounded absolute positions, so rounding
+            never accumulates. grbl has no separate extruder axis, so G91
+            applies to x and y as well.
+        self.feed_rate (int): Feed rate put on the first G1 move
+        self.segments (int): Number of moves emitted since the last reset
+        self.bytes (int): Number of bytes emitted for those moves
+    Methods:
+        reset(self)
+            Forget the modal state and statistics (start of a new program)
+        rapid(self, xyz)
+            Returns the lines for a G0 move to the point xyz
+        moves(self, xyz, arcs)
+            Returns the lines for G1 moves through every point in xyz (array
+            of [x y z]), starting from where the last move ended. Rows of arcs
+            with direction 2 or 3 are written as G2/G3 moves with I/J words.
+        finish(self)
+            Returns the lines needed to put grbl back into absolute mode
+        stats(self)
+            Returns a dictionary with the segments, bytes and bytes per segment
+    """
+
+    def __init__(self, xy_decimals = 3, z_decimals = 2, relative_z = False, feed_rate = 500):
+        self.xy_decimals = xy_decimals
+        self.z_decimals = z_decimals
+        self.relative_z = relative_z
+        self.feed_rate = feed_rate
+        self.reset()
+
+    def reset(self):
+        self._last = np.zeros(3, dtype = np.int64)
+        self._modal = None
+        self._incremental = False
+        self._feed_sent = False
+        self.segments = 0
+        self.bytes = 0
+
+    def _quantize(self, xyz):
+        scale = [10 ** self.xy_decimals, 10 ** self.xy_decimals, 10 ** self.z_decimals]
+        return np.rint(np.asarray(xyz, dtype = float).reshape(-1, 3) * scale).astype(np.int64)
+
+    def _words(self, values, changed):
+        text = np.full(len(values), '', dtype = '<U1')
+        decimals = [self.xy_decimals, self.xy_decimals, self.z_decimals]
+        for i, axis in enumerate('XYZ'):
+            words = np.char.add(axis, format_values(values[:, i], decimals[i]))
+            text = np.char.add(text, np.where(changed[:, i], words, ''))
+        return text
+
+    def rapid(self, xyz):
+        q = self._quantize(xyz)[-1:]
+        lines = self.finish()
+        lines.append('G0' + self._words(q, np.ones((1, 3), dtype = bool))[0] + '\n')
+        self._modal = 'G0'
+        self._last = q[0]
+        return lines
+
+    def moves(self, xyz, arcs = None):
+        q = self._quantize(xyz)
+        if arcs is None:
+            arcs = np.zeros((len(q), 3))
+        arcs = np.asarray(arcs, dtype = float).reshape(-1, 3)
+        direction = arcs[:, 0].astype(int)
+        delta = np.diff(np.vstack((self._last, q)), axis = 0)
+        keep = np.any(delta != 0, axis = 1) | (direction != 0)
+        if not np.any(keep):
+            return []
+        q = q[keep]
+        delta = delta[keep]
+        arcs = arcs[keep]
+        direction = direction[keep]
+        self._last = q[-1]
+        text = self._words(delta if self.relative_z else q, delta != 0)
+        if np.any(direction):
+            # I/J are always relative to the start of the arc
+            ij = np.rint(arcs[:, 1:] * 10 ** self.xy_decimals).astype(np.int64)
+            ij_changed = (ij != 0) & (direction[:, None] != 0)
+            ij_changed[:, 0] |= (direction != 0) & ~ij_changed[:, 1] # Always write at least I
+            for i, axis in enumerate('IJ'):
+                words = np.char.add(axis, format_values(ij[:, i], self.xy_decimals))
+                text = np.char.add(text, np.where(ij_changed[:, i], words, ''))
+        # Only write the motion mode when it changes
+        command = np.array(['G1', 'G1', 'G2', 'G3'])[np.clip(direction, 0, 3)]
+        previous = np.concatenate(([str(self._modal)], command[:-1]))
+        text = np.char.add(np.where(command != previous, command, ''), text)
+        self._modal = str(command[-1])
+        lines = np.char.add(text, '\n').tolist()
+        if not self._feed_sent:
+            # Added to the str: the fixed width array would cut the word short
+            lines[0] = lines[0][:-1] + 'F' + str(self.feed_rate) + '\n'
+            self._feed_sent = True
+        self.segments += len(lines)
+        self.bytes += sum(len(line) for line in lines)
+        if self.relative_z and not self._incremental:
+            lines.insert(0, 'G91\n')
+            self._incremental = True
+        return lines
+
+    def finish(self):
+        if self._incremental:
+            self._incremental = False
+            return ['G90\n']
+        return []
+
+    def stats(self):
+        return {
+            'segments': self.segments,
+            'bytes': self.bytes,
+            'bytes_per_segment': self.bytes / self.segments if self.segments else 0,
+        }
 
 class GCode:
     """
@@ -15,6 +286,10 @@ class GCode:
             being printed on
         self.imgx_length (int): How many pixels are in the x-direction in the image
         self.imgy_length (int): How many pixels are in the y-direction in the image
+        self.pixel_to_mm (vision_classes.Pixel_To_MM): Calibrated pixel to mm
+            transform (Cookie_Vision.pixel_to_mm). If set, the coordinates are
+            converted with it instead of stretching the image over x_length
+            by y_length
     Methods:
         self.generate_gcode(self, file_name): Generates g_code for the input image
             - file_name corresponds to the file that will be created that will
@@ -24,8 +299,9 @@ class GCode:
 
     """
 
-    def __init__(self, file, coordinates, x_length, y_length):
+    def __init__(self, file, coordinates, x_length, y_length, pixel_to_mm = None):
         self.coordinates = coordinates
+        self.pixel_to_mm = pixel_to_mm
         self.x_length = x_length
         self.y_length = y_length
         image = cv2.imread(file)
@@ -34,43 +310,30 @@ class GCode:
 
     def generate_gcode(self, file_name):
         # 1st, convert coordinates in image to mm
-        coordinates_in_mm = []
-        for i in range(0, len(self.coordinates)):
-            x_coord_pix = self.coordinates[i][0]
-            y_coord_pix = self.coordinates[i][1]
-            img_x = self.imgx_length
-            img_y = self.imgy_length
-            x_coord_mm = round(x_coord_pix * (self.x_length / img_x), 2)
-            y_coord_mm = round(y_coord_pix * (self.y_length / img_y), 2)
-            coordinates_in_mm.append([x_coord_mm, y_coord_mm])
+        if self.pixel_to_mm is not None:
+            coordinates_in_mm = np.round(self.pixel_to_mm.to_mm(self.coordinates), 2)
+        else:
+            scale = [self.x_length / self.imgx_length, self.y_length / self.imgy_length]
+            coordinates_in_mm = np.round(np.asarray(self.coordinates, dtype = float).reshape(-1, 2) * scale, 2)
         # 2nd, need to figure out how much frosting to extrude and write the
         # code to the file (file_name)
         try:
-            f = open(file_name, 'w')
-            zi = 0
             c = 0.1
-            for i in range(0, len(coordinates_in_mm)):
-                x = coordinates_in_mm[i][0]
-                y = coordinates_in_mm[i][1]
-                xi = coordinates_in_mm[i-1][0]
-                yi = coordinates_in_mm[i-1][1]
-                if i == 0:
-                    f.write("G00 X" + str(x) + " Y" + str(y) + " Z" + str(zi) + " F500 \r\n")
-                elif i > 0:
-                    delta_z = ((x-xi)**2 + (y-yi)**2) ** 0.5 #Figures out how long the line is
-                    # This function takes the distance (delta_z) and multiplies it
-                    # by a constant, c, and adds it to the initial z-coordinate, zi
-                    z = round(zi + (c * delta_z), 2)
-                    # g-code to move the probe to a point [x,y] and extrudes 'z' amount
-                    # of frosting
-                    f.write("G01 X" + str(x) + " Y" + str(y) + " Z" + str(z) + " \r\n")
-                    zi = z
-            f.write("G00 X0 Y0") #Return to the origin once cookie is printed
-            f.close()
+            z = extrusion_profile(coordinates_in_mm, c, 0)
+            coordinates_w_z = np.column_stack((coordinates_in_mm, z))
+            program = []
+            if len(coordinates_w_z) > 0:
+                program.append(format_moves(coordinates_w_z[:1], 'G00', 2, 2, ' F500 \r\n'))
+                # g-code to move the probe to a point [x,y] and extrudes 'z' amount
+                # of frosting
+                program.append(format_moves(coordinates_w_z[1:], 'G01', 2, 2, ' \r\n'))
+            program.append("G00 X0 Y0") #Return to the origin once cookie is printed
+            with open(file_name, 'w') as f:
+                f.write(''.join(program))
             print("G-Code generated!")
-        except:
+        except Exception as e:
+            print(e)
             print("Error occured while generating gcode")
-            f.close()
 
 
 
@@ -109,6 +372,12 @@ class GCode_EX:
     Purpose: To execute g_code to the robot given a text file
     Instance Variables:
         self.file (str): file where g_code is stored
+        self.emitter (Compact_Emitter): If set, moves are written with the
+            byte-minimal emitter instead of full 'G01 X Y Z' lines
+        self.z_end (float): Z-coordinate the last generated program ended at
+        self.optimizer (Travel_Optimizer): If set, programs with more than one
+            stroke are reordered to cut down rapid moves between strokes (see
+            path_classes.Travel_Optimizer)
 
     Methods:
         self.generate_gcode(self, coordinates file_name): Generates g-code given
@@ -119,111 +388,186 @@ class GCode_EX:
             - extrude_rate (float): Rate to extrude icing
             - z-start (float): Where to start z-axis (used in cases where frosting
             multiple cookies in the same run)
-        self.send_gcode(self, file_name): Sends the gcode to the correct COM port
+            - arcs (array of flt [direction, i, j]): Optional arc rows from
+            path_classes.fit_arcs. Those moves become G02/G03 and extrude
+            along their arc length.
+        self.iter_gcode(self, coordinates, extrude_rate, z_start, chunk_size):
+            Generator yielding the g-code program line by line. Points are
+            converted chunk_size at a time, so the first lines are ready before
+            the rest of the program is generated. Uses self.emitter if set.
+        self.stream_coordinates(self, coordinates, extrude_rate, z_start,
+            archive, wait): Streams the program from iter_gcode straight to the
+            robot without going through a file.
+            - archive (str): File name to write a copy of the program to in
+            the background (None to not keep a copy)
+        self.iter_strokes(self, strokes, extrude_rate, z_start, chunk_size,
+            arcs): Same as iter_gcode for several separate paths in one
+            program (e.g. every cookie on the platform). The nozzle rapids to
+            the start of each stroke and z carries on where the last one ended.
+            - strokes (list of array of flt [x y]): Paths to draw, in order
+            - arcs (list): Arc rows for each stroke (None for straight lines)
+        self.stream_strokes(self, strokes, extrude_rate, z_start, archive,
+            wait, arcs, checkpoint): Streams the program from iter_strokes to
+            the robot
+            - checkpoint (str): JSON file to checkpoint the job in (None to
+            not checkpoint). The program is copied to archive (or
+            Checkpoint_job.txt) in GENERATED_DIR while it streams, and the
+            copy is finished even if the job stops early, so it can be resumed
+        self.send_gcode(self, file_name, wait, checkpoint): Streams the gcode
+            to the robot through self.streamer (see stream_classes.Grbl_Streamer)
             - file_name corresponds to the file that holds the g-code to be sent
+            - wait (bool): Block until grbl accepted every line. If False, the
+            Stream_Job future is returned right away.
+            - checkpoint (str): JSON file to checkpoint the job in
+        self.resume(self, checkpoint_file, wait): Carries on a checkpointed job
+            from the last line grbl acknowledged (see
+            stream_classes.Job_Checkpoint). Returns None if there is nothing
+            to resume
     """
 
-    def __init__(self, ser):
+    def __init__(self, ser, emitter = None, optimizer = None):
         self.ser = ser
+        self.streamer = Grbl_Streamer(ser)
+        self.emitter = emitter
+        self.optimizer = optimizer
+        self.z_end = 0
 
-    def generate_gcode(self, coordinates, file_name = 'Trial.txt', extrude_rate = 0.1, z_start = 0):
-        print("Hello World")
-        coordinates_z = np.ones((len(coordinates), 1)) # Initialize array to store z-coordinates
-        zi = z_start
-        coordinates_z[0] = zi # Start coordinate for z-axis
-        for i in range(1, len(coordinates)):
-            x = coordinates[i][0]
-            y = coordinates[i][1]
-            xi = coordinates[i-1][0]
-            yi = coordinates[i-1][1]
-            # Find the del_z that the extruder needs to move
-            delta_z = ((x-xi)**2 + (y-yi)**2) ** 0.5 #Figures out how long the line is
-            # This function takes the distance (delta_z) and multiplies it
-            # by a constant, extrude_rate, and adds it to the initial z-coordinate, zi
-            z = round(zi + (extrude_rate * delta_z), 2)
-            coordinates_z[i] = z
-            # Update zi so the next z-coordinate is stationed
-            zi = z
-        # Once all of the z-axis coordinates are generated, put two matrices together
-        coordinates_w_z = np.column_stack((coordinates, coordinates_z))
-        # Print out success
-        print("G-Code generated!")
-        print(coordinates_w_z)
-
-        print("Writing to file")
-        path = 'C:/Users/hsima/Documents/Cookie_Bot_ver1.1/gcode_scripts/generated_code/'
-        file_path = path + file_name
-        try:
-            first_line = True
-            # Erase original file if the original file is held here with name
-            if os.path.isfile(file_path):
-                f = open(file_path, 'w').close()
-
-            f = open(file_path, 'w') # Open file
-            f.write('(File Creation: ' + str(time.ctime()) + ') \n')
-            # Write the g-code to the file
-            f.write('% \n')
-            f.write('G90 \n')
-            for i in coordinates_w_z:
-                if first_line == True:
-                    f.write('G00 X' + str(i[0]) + ' Y' + str(i[1]) + ' Z' + str(i[2]) + '\n')
-                    f.write('G01 F500' + '\n') # Feed rate is arbitrary: using Z as feed rate
-                    first_line = False
+    def iter_gcode(self, coordinates, extrude_rate = 0.1, z_start = 0, chunk_size = 256, arcs = None):
+        return self.iter_strokes([coordinates], extrude_rate, z_start, chunk_size, None if arcs is None else [arcs])
+
+    def iter_strokes(self, strokes, extrude_rate = 0.1, z_start = 0, chunk_size = 256, arcs = None):
+        emitter = self.emitter
+        if emitter is not None:
+            emitter.reset()
+        if self.optimizer is not None and len(strokes) > 1:
+            strokes, arcs = self.optimizer.optimize(strokes, arcs)
+            report = self.optimizer.report
+            log.info("Travel %.1f mm -> %.1f mm (%d strokes joined)", report['travel_before'], report['travel_after'], report['joined'])
+        yield '(File Creation: ' + str(time.ctime()) + ') \n'
+        yield '% \n'
+        yield 'G90 \n'
+        # Z is the syringe, so it carries on from one stroke to the next. It
+        # stays put during the rapid moves between strokes (no icing drawn).
+        z_last = z_start
+        feed_sent = False
+        for n, coordinates in enumerate(strokes):
+            coordinates = np.asarray(coordinates, dtype = float).reshape(-1, 2)
+            stroke_arcs = None
+            if arcs is not None and arcs[n] is not None:
+                stroke_arcs = np.asarray(arcs[n], dtype = float).reshape(-1, 3)
+            if len(coordinates) == 0:
+                continue
+            first_point = [coordinates[0, 0], coordinates[0, 1], round(z_last, 2)]
+            if emitter is None:
+                yield format_moves([first_point], 'G00')
+                if not feed_sent:
+                    yield 'G01 F500' + '\n' # Feed rate is arbitrary: using Z as feed rate
+                    feed_sent = True
+            else:
+                for line in emitter.rapid(first_point):
+                    yield line
+            # Z-coordinate of every point from the cumulative length of the path.
+            # Each chunk starts from the last point and z of the chunk before it.
+            for start in range(1, len(coordinates), chunk_size):
+                chunk = coordinates[start - 1:start + chunk_size]
+                chunk_arcs = None if stroke_arcs is None else stroke_arcs[start - 1:start + chunk_size]
+                chunk_z = extrusion_profile(chunk, extrude_rate, z_last, None, chunk_arcs)
+                z_last = chunk_z[-1]
+                coordinates_w_z = np.column_stack((chunk[1:], np.round(chunk_z[1:], 2)))
+                move_arcs = None if stroke_arcs is None else chunk_arcs[1:]
+                if emitter is None:
+                    lines = format_moves(coordinates_w_z, 'G01', arcs = move_arcs).splitlines(True)
                 else:
-                    f.write('G01 X' + str(i[0]) + ' Y' + str(i[1]) + ' Z' + str(i[2]) + '\n')
-            # Put robot into the scan position and end the program
-            f.write('G00 X00 Y-42 \n')
-            f.write('M30 \n')
-            f.write('% \n')
-            f.close()
-        except:
-            print("Error occured while generating gcode")
-            f.close()
+                    lines = emitter.moves(coordinates_w_z, move_arcs)
+                for line in lines:
+                    yield line
+        self.z_end = z_last
+        if emitter is not None:
+            for line in emitter.finish():
+                yield line
+        # Put robot into the scan position and end the program
+        yield 'G00 X00 Y-42 \n'
+        yield 'M30 \n'
+        yield '% \n'
 
+    def generate_gcode(self, coordinates, file_name = 'Trial.txt', extrude_rate = 0.1, z_start = 0, arcs = None):
+        log.info("Writing to file")
+        file_path = os.path.join(GENERATED_DIR, file_name)
+        try:
+            # Build the whole program in memory, then write it in one go
+            with METRICS.span('generate'):
+                program = ''.join(self.iter_gcode(coordinates, extrude_rate, z_start, len(coordinates) or 1, arcs))
+            log.info("G-Code generated!")
+            self._print_emit_stats()
+            # Opening with 'w' erases the original file if one is held here with name
+            with open(file_path, 'w') as f:
+                f.write(program)
+        except Exception as e:
+            print(e)
+            print("Error occured while generating gcode")
 
+    def stream_coordinates(self, coordinates, extrude_rate = 0.1, z_start = 0, archive = None, wait = True, arcs = None, checkpoint = None):
+        return self.stream_strokes([coordinates], extrude_rate, z_start, archive, wait, None if arcs is None else [arcs], checkpoint)
 
-    def send_gcode(self, file_name):
+    def stream_strokes(self, strokes, extrude_rate = 0.1, z_start = 0, archive = None, wait = True, arcs = None, checkpoint = None):
+        lines = self.iter_strokes(strokes, extrude_rate, z_start, arcs = arcs)
         try:
-            print("Opening file and port...")
-            f = open(file_name, 'r')
-            # ser = serial.Serial(self.COM, 115200, timeout=1)
-            # Wake up Arduino & flush the input of the serial stream
-            self.ser.write(str.encode("\r\n\r\n"))
-            time.sleep(4)
-            self.ser.flushInput()
-            
-            print("Opened " + str(self.ser.name) + " and " + file_name)
-            # Deliver gcode to the 3D printer
-            """
-            for line in f.readlines():
-                self.ser.write(str.encode(line))
-                print(">> Sent command: " + str(line))
-                output = self.ser.readline() # Wait for grbl to respond
-                print(">> " + str(output))
-                # time.sleep(0.1)
-            f.close()
-            """
-            # Keep track of the lines sent to the arduino
-            num_char_sent = [] # Number of characters sent from each line
-            for line in f.readlines():
-                line_send = line.strip() # Get rid of EOL characters
-                num_char_sent.append(len(line_send)+1) # Append the number of characters sent to the arduino
-                print("Sum of number of characters to send:", sum(num_char_sent))
-                while sum(num_char_sent) >= 126: # Can send up to 127 characters before buffer is full
-                    output = self.ser.readline().strip() # Read line & strip any unneccessary characters
-                    if output.find(b'ok') >= 0:
-                        print("Output found: deleting first entry")
-                        del num_char_sent[0] # Delete the number of characters sent already
-                        break # Break out of while loop
-            
-                self.ser.write((line_send + '\n').encode('utf-8')) # Send line to arduino once buffer is clear
-                print(">> Sent line:", line_send)
+            if checkpoint is not None:
+                # Resuming needs the whole program on disk: it is written while
+                # streaming, and finished even if the job stops early
+                program = os.path.join(GENERATED_DIR, archive or 'Checkpoint_job.txt')
+                lines = archive_gcode(lines, program, complete = True)
+                checkpoint = Job_Checkpoint(checkpoint, program)
+            elif archive is not None:
+                lines = archive_gcode(lines, os.path.join(GENERATED_DIR, archive))
+            log.info("Streaming generated g-code to %s", self.ser.name)
+            job = self.streamer.stream(lines, checkpoint = checkpoint)
+            if wait:
+                progress = job.result() # Wait for grbl to accept every line
+                log.info("Sent %d lines (%d errors) in %.2f s", progress['acked'], progress['errors'], progress['elapsed'])
+                self._print_emit_stats()
+            return job
+        except Exception as e:
+            print(e)
+            print("Error occured while trying to stream generated g-code")
 
-            f.close()
+    def _print_emit_stats(self):
+        if self.emitter is not None:
+            stats = self.emitter.stats()
+            log.info("Emitted %d segments in %d bytes (%.1f bytes/segment)", stats['segments'], stats['bytes'], stats['bytes_per_segment'])
 
-             
-            # ser.close()
+    def send_gcode(self, file_name, wait = True, checkpoint = None):
+        try:
+            log.info("Streaming %s to %s", file_name, self.ser.name)
+            if checkpoint is not None:
+                checkpoint = Job_Checkpoint(checkpoint, file_name)
+            job = self.streamer.stream(read_gcode(file_name), checkpoint = checkpoint)
+            if wait:
+                progress = job.result() # Wait for grbl to accept every line
+                log.info("Sent %d lines (%d errors) in %.2f s", progress['acked'], progress['errors'], progress['elapsed'])
+            return job
         except Exception as e:
             print(e)
-            print("Error occured while trying to open port")
-            f.close()
+            print("Error occured while trying to stream " + file_name)
+
+    def resume(self, checkpoint_file, wait = True):
+        checkpoint = Job_Checkpoint(checkpoint_file)
+        if not checkpoint.load():
+            print("No checkpoint to resume in " + checkpoint_file)
+            return None
+        if checkpoint.complete:
+            print("The checkpointed job already finished")
+            return None
+        if checkpoint.lost:
+            print("The checkpoint lost track of the job when it was aborted: it can't be resumed")
+            return None
+        try:
+            log.info("Resuming %s from line %d at X%.3f Y%.3f Z%.3f", checkpoint.program, checkpoint.line + 1, *checkpoint.position)
+            job = self.streamer.stream(checkpoint.resume_lines(), checkpoint = checkpoint)
+            if wait:
+                progress = job.result()
+                log.info("Sent %d lines (%d errors) in %.2f s", progress['acked'], progress['errors'], progress['elapsed'])
+            return job
+        except Exception as e:
+            print(e)
+            print("Error occured while trying to resume " + checkpoint_file)
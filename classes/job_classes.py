@@ -0,0 +1,227 @@
+import threading
+import queue
+from concurrent.futures import Future
+from classes.stream_classes import Job_Aborted
+from classes.g_code_classes import read_gcode
+
+class Job_Failed(Exception):
+    """Raised by a Robot_Job when grbl answered lines of it with 'error'"""
+
+class Robot_Job(Future):
+    """
+    Purpose: A job waiting for, or running on, the Robot_Worker. Completes
+        with the Stream_Job progress once grbl accepted every line, or fails
+        with Job_Failed if grbl rejected any of them.
+    Instance Variables:
+        self.name (str): Name shown to the operator (e.g. 'Home', 'Cookie')
+        self.total (int): Approximate number of lines (None if unknown)
+        self.estimate (float): Run time from the pre-flight simulation
+            (seconds, None if the job wasn't simulated)
+        self.stream (Stream_Job): Stream of the job once it started
+    Methods:
+        progress(self)
+            Returns a dictionary with the name, state, lines acknowledged,
+            total lines, elapsed time and estimated time left (eta, seconds).
+            The eta comes from self.estimate if there is one, since grbl
+            acknowledges lines well before the moves are finished. Otherwise
+            it comes from the rate lines are executed at (status reports, see
+            stream_classes.Status_Poller) or acknowledged at
+    """
+
+    def __init__(self, name, start_stream, total = None, estimate = None):
+        super().__init__()
+        self.name = name
+        self.total = total
+        self.estimate = estimate
+        self.stream = None
+        self._start_stream = start_stream
+
+    def progress(self):
+        info = {'name': self.name, 'acked': 0, 'total': self.total, 'elapsed': 0, 'eta': self.estimate}
+        if self.stream is None:
+            info['state'] = 'cancelled' if self.cancelled() else 'queued'
+            return info
+        info.update(self.stream.progress())
+        info['state'] = 'done' if self.done() else 'running'
+        if self.total:
+            info['total'] = self.total
+        info['eta'] = None
+        if not self.done():
+            if self.estimate is not None:
+                info['eta'] = max(self.estimate - info['elapsed'], 0)
+            else:
+                done = info['acked'] if info.get('executed') is None else info['executed']
+                if self.total and done > 0:
+                    rate = info['elapsed'] / done
+                    info['eta'] = max(self.total - done, 0) * rate
+        return info
+
+class Robot_Worker:
+    """
+    Purpose: Owns the serial port to the robot and runs jobs one after another
+        on a worker thread, so the UI loop never waits on send_gcode. The UI
+        submits jobs, reads their progress, and reacts when they are done.
+    Instance Variables:
+        self.robot (GCode_EX): Robot the jobs are sent to
+        self.jobs (Queue): Jobs waiting to run
+        self.current (Robot_Job): Job that is running (None if idle)
+        self.paused (bool): True while grbl is in feed hold
+    Methods:
+        start(self) / stop(self)
+            Starts/stops the worker thread (start returns self)
+        submit(self, name, start_stream, total, estimate)
+            Queues a job. start_stream(robot) has to start streaming and
+            return the Stream_Job. Returns the Robot_Job
+        submit_file(self, name, file_name)
+            Queues a g-code file
+        submit_coordinates(self, name, coordinates, **kwargs)
+            Queues a toolpath (kwargs are passed to GCode_EX.stream_coordinates)
+        submit_strokes(self, name, strokes, estimate, **kwargs)
+            Queues several toolpaths as one job (kwargs are passed to
+            GCode_EX.stream_strokes)
+        submit_resume(self, name, checkpoint_file)
+            Queues the rest of a checkpointed job (see GCode_EX.resume)
+        time_left(self)
+            Estimated seconds until every job is done (jobs without an
+            estimate count as 0)
+        pause(self) / resume(self)
+            grbl feed hold / cycle start
+        abort(self)
+            Soft resets grbl: the running job stops and queued jobs are
+            cancelled (also one the worker was just starting). A reset during
+            a move locks grbl in an alarm, so the next job first unlocks it
+            ('$X')
+        busy(self)
+            True if a job is running or waiting
+    """
+
+    def __init__(self, robot):
+        self.robot = robot
+        self.jobs = queue.Queue()
+        self.current = None
+        self.paused = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock() # Jobs start and aborts happen one at a time
+        self._aborts = 0
+        self._unlock = False # grbl may be locked in an alarm by the last abort
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._run, name = 'robot-worker', daemon = True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, name, start_stream, total = None, estimate = None):
+        job = Robot_Job(name, start_stream, total, estimate)
+        with self._lock:
+            job._aborts = self._aborts # Aborts from now on cancel the job
+            self.jobs.put(job)
+        return job
+
+    def submit_file(self, name, file_name):
+        try:
+            with open(file_name, 'r') as f:
+                total = sum(1 for line in f)
+        except OSError:
+            total = None # The job itself will report the error
+        return self.submit(name, lambda robot: robot.streamer.stream(read_gcode(file_name)), total)
+
+    def submit_coordinates(self, name, coordinates, **kwargs):
+        kwargs['wait'] = False
+        total = len(coordinates) + 8 # Moves plus the start/end lines of the program
+        return self.submit(name, lambda robot: robot.stream_coordinates(coordinates, **kwargs), total)
+
+    def submit_strokes(self, name, strokes, estimate = None, **kwargs):
+        kwargs['wait'] = False
+        total = sum(len(stroke) + 1 for stroke in strokes) + 7 # Moves, rapids and start/end lines
+        return self.submit(name, lambda robot: robot.stream_strokes(strokes, **kwargs), total, estimate)
+
+    def submit_resume(self, name, checkpoint_file):
+        return self.submit(name, lambda robot: robot.resume(checkpoint_file, wait = False))
+
+    def time_left(self):
+        seconds = 0
+        current = self.current
+        if current is not None:
+            seconds += current.progress()['eta'] or 0
+        with self.jobs.mutex:
+            waiting = list(self.jobs.queue)
+        for job in waiting:
+            seconds += job.estimate or 0
+        return seconds
+
+    def busy(self):
+        return self.current is not None or not self.jobs.empty()
+
+    def pause(self):
+        self.robot.streamer.feed_hold()
+        self.paused = True
+
+    def resume(self):
+        self.robot.streamer.cycle_start()
+        self.paused = False
+
+    def abort(self):
+        # Cancel everything waiting, then stop what is running
+        with self._lock:
+            self._aborts += 1
+            self._unlock = True
+            while not self.jobs.empty():
+                try:
+                    self.jobs.get_nowait().cancel()
+                except queue.Empty:
+                    break
+        self.robot.streamer.soft_reset()
+        self.paused = False
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self.jobs.get(timeout = 0.2)
+            except queue.Empty:
+                continue
+            if not job.set_running_or_notify_cancel():
+                continue # Cancelled while waiting
+            self.current = job
+            try:
+                with self._lock:
+                    unlock, self._unlock = self._unlock, False
+                if unlock:
+                    self._unlock_grbl()
+                with self._lock:
+                    # A job taken off the queue just before an abort never starts.
+                    # Once started, a later abort's soft reset fails its stream
+                    if job._aborts != self._aborts:
+                        raise Job_Aborted("aborted before it started")
+                    job.stream = job._start_stream(self.robot)
+                if job.stream is None:
+                    raise RuntimeError("Job '" + job.name + "' could not be started")
+                result = job.stream.result()
+                if result['errors']:
+                    # e.g. 'error:9' for every line while grbl is locked in an alarm
+                    line_number, line, response = job.stream.errors[0]
+                    raise Job_Failed("grbl rejected %d lines of job '%s' (line %d '%s': %s)" % (
+                        result['errors'], job.name, line_number + 1, line, response))
+                job.set_result(result)
+            except Job_Aborted as e:
+                print("Job '" + job.name + "' aborted")
+                job.set_exception(e)
+            except Exception as e:
+                print(e)
+                print("Error occured while running job '" + job.name + "'")
+                job.set_exception(e)
+            self.current = None
+
+    def _unlock_grbl(self):
+        # The stream waits for grbl to restart after the reset (see Grbl_Streamer.soft_reset)
+        unlock = self.robot.streamer.stream(['$X']).result()
+        if unlock['errors']:
+            raise Job_Failed("grbl could not be unlocked after the abort")
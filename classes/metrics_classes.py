@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import bisect
+import threading
+from collections import deque
+
+# Folder metrics are exported to (found relative to this file)
+METRICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'metrics')
+# Upper bounds of the histogram buckets in seconds (anything slower goes in +Inf)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    """
+    Purpose: Keep the distribution of a timing without storing every value.
+        Values are counted into fixed buckets (like a Prometheus histogram),
+        and the most recent values are kept for live averages.
+    Instance Variables:
+        self.buckets (tuple of flt): Upper bound of every bucket
+        self.counts (list of int): Values in each bucket (last one is +Inf)
+        self.count / self.sum (int / flt): Number and total of all values
+        self.min / self.max (float): Smallest and largest value
+        self.recent (deque): The last values observed
+    Methods:
+        observe(self, value)
+            Adds a value
+        recent_mean(self)
+            Mean of the recent values (0 if there aren't any)
+        quantile(self, q)
+            Upper bound of the bucket the q quantile (0-1) falls in
+        snapshot(self)
+            Dictionary of the statistics
+    """
+
+    def __init__(self, buckets = DEFAULT_BUCKETS, recent = 50):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.recent = deque(maxlen = recent)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.recent.append(value)
+
+    def recent_mean(self):
+        recent = list(self.recent)
+        return sum(recent) / len(recent) if recent else 0
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'recent_mean': self.recent_mean(),
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+class _Span:
+    # Times a with-block into a Histogram
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+class _No_Span:
+    # Stands in for _Span when metrics are turned off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_SPAN = _No_Span()
+
+class Metrics:
+    """
+    Purpose: Lightweight timing of the stages of a cookie cycle (capture,
+        vision, generation, streaming). Stages are timed with
+        'with METRICS.span(name):' into histograms kept in memory, which can be
+        exported to a JSON or Prometheus text file on a background thread.
+    Instance Variables:
+        self.enabled (bool): If False, spans and observations do nothing
+        self.histograms (dict): Stage name -> Histogram of its times (seconds)
+        self.counters (dict): Name -> count (e.g. lines streamed)
+        self.gauges (dict): Name -> last value set (e.g. camera FPS)
+    Methods:
+        span(self, name)
+            Context manager timing its block into the histogram 'name'
+        observe(self, name, seconds) / count(self, name, n) / gauge(self, name, value)
+            Record a time / add to a counter / set a gauge
+        fps(self, name)
+            Runs per second of a span, from its recent times
+        snapshot(self)
+            Dictionary of every metric
+        export(self, file_path)
+            Writes the metrics to file_path: Prometheus text format if it ends
+            in '.prom', JSON otherwise
+        start_export(self, file_path, interval) / stop_export(self)
+            Export every interval seconds on a background thread
+    """
+
+    def __init__(self, enabled = True):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def span(self, name):
+        if not self.enabled:
+            return NO_SPAN
+        return _Span(self, name)
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, n = 1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        if self.enabled:
+            with self._lock:
+                self.gauges[name] = value
+
+    def fps(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            return 0
+        mean = histogram.recent_mean()
+        return 1 / mean if mean > 0 else 0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'time': time.time(),
+                'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+    def prometheus(self):
+        # Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = []
+        for name, stats in sorted(snapshot['histograms'].items()):
+            metric = 'cookie_bot_' + name + '_seconds'
+            lines.append('# TYPE ' + metric + ' histogram')
+            cumulative = 0
+            for bound, count in stats['buckets'].items():
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (metric, bound, cumulative))
+            lines.append('%s_sum %.6f' % (metric, stats['sum']))
+            lines.append('%s_count %d' % (metric, stats['count']))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE cookie_bot_%s_total counter' % name)
+            lines.append('cookie_bot_%s_total %d' % (name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('# TYPE cookie_bot_%s gauge' % name)
+            lines.append('cookie_bot_%s %g' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, file_path):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok = True)
+            if file_path.endswith('.prom'):
+                text = self.prometheus()
+            else:
+                text = json.dumps(self.snapshot(), indent = 2)
+            # Write a temporary file first so readers never see half a file
+            with open(file_path + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(file_path + '.tmp', file_path)
+        except Exception as e:
+            print(e)
+            print("Error occured while exporting metrics to " + file_path)
+
+    def start_export(self, file_path, interval = 10):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._export_loop, args = (file_path, interval), name = 'metrics-export', daemon = True)
+            self._thread.start()
+
+    def stop_export(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _export_loop(self, file_path, interval):
+        while not self._stop.wait(interval):
+            self.export(file_path)
+        self.export(file_path) # Last values on the way out
+
+# Shared by every class, so one export covers the whole robot
+METRICS = Metrics()
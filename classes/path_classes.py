@@ -0,0 +1,472 @@
+import numpy as np
+
+def point_segment_distance(points, start, end):
+    """
+    Purpose: Distance from every point to the line segment start-end
+        - points (array of flt [x y]): Points to measure
+        - start (array of flt [x y]): Start of the segment
+        - end (array of flt [x y]): End of the segment
+    Returns: Array of distances, one per point
+    """
+    seg = end - start
+    seg_len2 = np.dot(seg, seg)
+    rel = points - start
+    if seg_len2 == 0:
+        return np.hypot(rel[:, 0], rel[:, 1])
+    t = np.clip((rel @ seg) / seg_len2, 0, 1)
+    closest = rel - np.outer(t, seg)
+    return np.hypot(closest[:, 0], closest[:, 1])
+
+def simplify_path(points, tolerance, closed = False):
+    """
+    Purpose: Ramer-Douglas-Peucker simplification of a path. Drops points so
+        the simplified path never strays more than tolerance from the original.
+        Distances for every candidate segment are found in one NumPy pass.
+        - points (array of flt [x y]): Path to simplify (in mm)
+        - tolerance (float): Largest allowed deviation (in mm)
+        - closed (bool): The path is a closed contour. It is split at the point
+        farthest from the start so the first/last points don't form a
+        degenerate segment.
+    Returns: Array of the points that were kept (always keeps both ends)
+    """
+    points = np.asarray(points, dtype = float).reshape(-1, 2)
+    n = len(points)
+    if n < 3 or tolerance <= 0:
+        return points.copy()
+    keep = np.zeros(n, dtype = bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    if closed:
+        far = int(np.argmax(np.hypot(*(points - points[0]).T)))
+        if 0 < far < n - 1:
+            keep[far] = True
+            stack = [(0, far), (far, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dist = point_segment_distance(points[first + 1:last], points[first], points[last])
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+def fit_circle(points):
+    """
+    Purpose: Least squares circle through a set of points
+        - points (array of flt [x y]): Points to fit
+    Returns: (cx, cy, r) of the circle, or None if the points don't define one
+    """
+    mean = points.mean(axis = 0)
+    rel = points - mean # Center the points so the fit is well conditioned
+    A = np.column_stack((rel, np.ones(len(rel))))
+    b = (rel * rel).sum(axis = 1)
+    solution, _, rank, _ = np.linalg.lstsq(A, b, rcond = None)
+    if rank < 3:
+        return None
+    cx, cy = solution[0] / 2, solution[1] / 2
+    r2 = solution[2] + cx * cx + cy * cy
+    if r2 <= 0:
+        return None
+    return cx + mean[0], cy + mean[1], np.sqrt(r2)
+
+def fit_arc(points, tolerance, min_radius = 2, max_radius = 500, max_sweep = 1.5 * np.pi):
+    """
+    Purpose: Check if a run of points lies on one circular arc
+        - points (array of flt [x y]): Run of points, in path order
+        - tolerance (float): Largest distance a point (or a chord between two
+        points) may be from the arc
+        - min_radius (float): Smaller radii are left to straight lines (tiny
+        arcs fit the pixel staircase of a contour rather than its shape)
+        - max_radius (float): Larger radii are treated as straight lines
+        - max_sweep (float): Largest angle (radians) one arc may cover
+    Returns: (direction, cx, cy) where direction is 2 for clockwise (G02) or 3
+        for counter-clockwise (G03), or None if the points aren't an arc. The
+        center is equidistant from the first and last point so grbl accepts it.
+    """
+    circle = fit_circle(points)
+    if circle is None or not min_radius <= circle[2] <= max_radius:
+        return None
+    # Slide the center onto the perpendicular bisector of the end points
+    start, end = points[0], points[-1]
+    chord = end - start
+    chord_len = np.hypot(chord[0], chord[1])
+    if chord_len == 0:
+        return None
+    normal = np.array([-chord[1], chord[0]]) / chord_len
+    mid = (start + end) / 2
+    center = mid + np.dot(np.array(circle[:2]) - mid, normal) * normal
+    rel = points - center
+    radius = np.hypot(*(start - center))
+    if np.max(np.abs(np.hypot(rel[:, 0], rel[:, 1]) - radius)) > tolerance:
+        return None
+    # Points have to go around the center in one direction
+    steps = np.diff(np.unwrap(np.arctan2(rel[:, 1], rel[:, 0])))
+    if not (np.all(steps > 0) or np.all(steps < 0)):
+        return None
+    if abs(steps.sum()) > max_sweep:
+        return None
+    # The arc bulges out from the original chords by its sagitta
+    if radius * (1 - np.cos(np.max(np.abs(steps)) / 2)) > tolerance:
+        return None
+    return (2 if steps[0] < 0 else 3), center[0], center[1]
+
+def fit_arcs(points, tolerance, line_tolerance = None, min_points = 5, min_radius = 2, max_radius = 500):
+    """
+    Purpose: Replace runs of points that lie on a circle with G02/G03 arcs. The
+        points left between arcs are simplified with simplify_path.
+        - points (array of flt [x y]): Path to fit (in mm)
+        - tolerance (float): Largest distance the arcs may be from the path
+        - line_tolerance (float): Tolerance for simplifying the straight parts
+        (defaults to tolerance)
+        - min_points (int): Fewest points that can be turned into an arc
+        - min_radius (float): Smaller radii are left as straight lines
+        - max_radius (float): Larger radii are left as straight lines
+    Returns: (points, arcs)
+        - points (array of flt [x y]): End point of every move
+        - arcs (array of flt [direction, i, j]): One row per point describing
+        the move that ends there. direction is 0 for a straight line, 2 for
+        G02 or 3 for G03, and i/j are the center offsets from the start of the
+        move. The first row is always a 0 row.
+    """
+    points = np.asarray(points, dtype = float).reshape(-1, 2)
+    if line_tolerance is None:
+        line_tolerance = tolerance
+    n = len(points)
+    out_points = [points[:1]]
+    out_arcs = [np.zeros((min(n, 1), 3))]
+
+    def add_lines(first, last):
+        if last > first:
+            kept = simplify_path(points[first:last + 1], line_tolerance)[1:]
+            out_points.append(kept)
+            out_arcs.append(np.zeros((len(kept), 3)))
+
+    line_start = 0
+    i = 0
+    while i + min_points - 1 < n:
+        arc_end = i + min_points - 1
+        arc = fit_arc(points[i:arc_end + 1], tolerance, min_radius, max_radius)
+        if arc is None:
+            i += 1
+            continue
+        # Grow the arc by doubling, then binary search for where it stops fitting
+        step = min_points
+        bad_end = None
+        while arc_end < n - 1:
+            candidate = min(arc_end + step, n - 1)
+            candidate_arc = fit_arc(points[i:candidate + 1], tolerance, min_radius, max_radius)
+            if candidate_arc is None:
+                bad_end = candidate
+                break
+            arc_end, arc = candidate, candidate_arc
+            step *= 2
+        if bad_end is not None:
+            while bad_end - arc_end > 1:
+                middle = (arc_end + bad_end) // 2
+                middle_arc = fit_arc(points[i:middle + 1], tolerance, min_radius, max_radius)
+                if middle_arc is None:
+                    bad_end = middle
+                else:
+                    arc_end, arc = middle, middle_arc
+        add_lines(line_start, i)
+        direction, cx, cy = arc
+        out_points.append(points[arc_end:arc_end + 1])
+        out_arcs.append(np.array([[direction, cx - points[i, 0], cy - points[i, 1]]]))
+        i = line_start = arc_end
+    add_lines(line_start, n - 1)
+    return np.vstack(out_points), np.vstack(out_arcs)
+
+def reverse_stroke(points, arcs = None):
+    """
+    Purpose: Draw a stroke from its end to its start
+        - points (array of flt [x y]): Points of the stroke
+        - arcs (array of flt [direction, i, j]): Optional arc rows (see fit_arcs)
+    Returns: (points, arcs) of the reversed stroke. Arcs turn the other way
+        (G02 <-> G03) and their I/J are taken from the new start of the move.
+    """
+    points = np.asarray(points, dtype = float).reshape(-1, 2)
+    if arcs is None:
+        return points[::-1].copy(), None
+    arcs = np.asarray(arcs, dtype = float).reshape(-1, 3)
+    k = np.arange(len(points) - 1, 0, -1) # Moves in reversed order
+    direction = arcs[k, 0]
+    is_arc = direction != 0
+    # Same center, seen from what used to be the end of the move
+    ij = np.where(is_arc[:, None], points[k - 1] + arcs[k, 1:] - points[k], 0)
+    rows = np.column_stack((np.where(is_arc, 5 - direction, 0), ij))
+    return points[::-1].copy(), np.vstack((np.zeros((1, 3)), rows))
+
+def rotate_stroke(points, arcs, start):
+    """
+    Purpose: Start a closed stroke (contour) at another one of its points. The
+        stroke is drawn all the way around back to that point.
+        - points (array of flt [x y]): Points of the closed stroke
+        - arcs (array of flt [direction, i, j]): Arc rows (None if all lines)
+        - start (int): Index of the point to start at
+    Returns: (points, arcs) of the rotated stroke
+    """
+    points = np.asarray(points, dtype = float).reshape(-1, 2)
+    n = len(points)
+    if arcs is not None:
+        arcs = np.asarray(arcs, dtype = float).reshape(-1, 3)
+    zero = np.zeros((1, 3))
+    if np.all(points[0] == points[-1]):
+        # Already ends where it starts: the last point is the first one
+        start = start % (n - 1)
+        new_points = np.vstack((points[start:-1], points[:start + 1]))
+        if arcs is None:
+            return new_points, None
+        return new_points, np.vstack((zero, arcs[start + 1:], arcs[1:start + 1]))
+    # Close the gap between the last and first point with a straight line
+    new_points = np.vstack((points[start:], points[:start + 1]))
+    if arcs is None:
+        return new_points, None
+    return new_points, np.vstack((zero, arcs[start + 1:], zero, arcs[1:start + 1]))
+
+def travel_length(strokes, start = (0, 0)):
+    """
+    Purpose: Total distance of the rapid (G00) moves needed to draw strokes
+        in order
+        - strokes (list of array of flt [x y]): Paths in the order they're drawn
+        - start (flt [x y]): Where the nozzle is before the first stroke
+    Returns: Travel distance (in mm)
+    """
+    ends = [np.asarray(start, dtype = float)]
+    starts = []
+    for stroke in strokes:
+        stroke = np.asarray(stroke, dtype = float).reshape(-1, 2)
+        if len(stroke) > 0:
+            starts.append(stroke[0])
+            ends.append(stroke[-1])
+    if not starts:
+        return 0.0
+    gaps = np.array(starts) - np.array(ends[:-1])
+    return float(np.hypot(gaps[:, 0], gaps[:, 1]).sum())
+
+class Endpoint_Grid:
+    """
+    Purpose: Uniform grid (spatial hash) over points, to find the nearest
+        point that is still available without checking every point
+    Instance Variables:
+        self.cell_size (float): Width of a grid cell (in mm)
+        self.cells (dict): (column, row) -> list of (x, y, key) in that cell
+    Methods:
+        add(self, point, key)
+            Adds a point. key is returned by nearest()
+        nearest(self, point, available)
+            Returns (distance, key) of the closest point whose key passes
+            available(key), or None if there isn't one
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self._low = None
+        self._high = None
+
+    def _cell(self, point):
+        return int(np.floor(point[0] / self.cell_size)), int(np.floor(point[1] / self.cell_size))
+
+    def add(self, point, key):
+        cell = self._cell(point)
+        self.cells.setdefault(cell, []).append((float(point[0]), float(point[1]), key))
+        if self._low is None:
+            self._low, self._high = list(cell), list(cell)
+        else:
+            self._low = [min(self._low[0], cell[0]), min(self._low[1], cell[1])]
+            self._high = [max(self._high[0], cell[0]), max(self._high[1], cell[1])]
+
+    def _ring(self, column, row, r):
+        if r == 0:
+            return [(column, row)]
+        ring = [(column + dc, row + dr) for dc in range(-r, r + 1) for dr in (-r, r)]
+        ring += [(column + dc, row + dr) for dc in (-r, r) for dr in range(-r + 1, r)]
+        return ring
+
+    def nearest(self, point, available):
+        if self._low is None:
+            return None
+        column, row = self._cell(point)
+        # Rings far enough out to cover every cell that holds a point
+        last_ring = max(abs(column - self._low[0]), abs(column - self._high[0]),
+                        abs(row - self._low[1]), abs(row - self._high[1]))
+        best = None
+        for r in range(last_ring + 1):
+            # Nothing in ring r can be closer than (r - 1) cells
+            if best is not None and best[0] <= (r - 1) * self.cell_size:
+                break
+            for cell in self._ring(column, row, r):
+                entries = self.cells.get(cell)
+                if not entries:
+                    continue
+                # Drop points that were used up since the last visit
+                entries[:] = [entry for entry in entries if available(entry[2])]
+                for x, y, key in entries:
+                    distance = np.hypot(x - point[0], y - point[1])
+                    if best is None or distance < best[0]:
+                        best = (distance, key)
+        return best
+
+class Travel_Optimizer:
+    """
+    Purpose: Reorder the strokes of a job so the robot spends less time on
+        rapid (G00) moves between them. Strokes are ordered nearest neighbour
+        first using an Endpoint_Grid, then improved with 2-opt. Open strokes
+        can be drawn either way around and closed strokes (cookie outlines)
+        can start at any of their points. Strokes that end close to where the
+        next one starts are joined into one path.
+    Instance Variables:
+        self.join_tolerance (float): Strokes closer than this (mm) are joined
+            with a short drawn line instead of a rapid move (0 to never join)
+        self.close_tolerance (float): Strokes whose ends are closer than this
+            (mm) are treated as closed contours that can start at any point.
+            Keep it tiny: rotating a stroke that isn't really closed draws a
+            line between its ends that was never in the design
+        self.two_opt_passes (int): Most 2-opt passes over the stroke order
+        self.start (flt [x y]): Where the nozzle is before the job (the scan
+            position, where every job starts)
+        self.report (dict): Travel before/after (mm), strokes in/out and
+            strokes joined by the last call to optimize()
+    Methods:
+        optimize(self, strokes, arcs)
+            Returns (strokes, arcs) in the new order. arcs is a list with the
+            arc rows of each stroke (see fit_arcs) or None.
+    """
+
+    def __init__(self, join_tolerance = 0.5, close_tolerance = 1e-6, two_opt_passes = 10, start = (0, -42)):
+        self.join_tolerance = join_tolerance
+        self.close_tolerance = close_tolerance
+        self.two_opt_passes = two_opt_passes
+        self.start = start
+        self.report = {}
+
+    def optimize(self, strokes, arcs = None):
+        strokes = [np.asarray(stroke, dtype = float).reshape(-1, 2) for stroke in strokes]
+        keep = [i for i, stroke in enumerate(strokes) if len(stroke) > 0]
+        strokes = [strokes[i] for i in keep]
+        if arcs is not None:
+            arcs = [np.zeros((len(strokes[n]), 3)) if arcs[i] is None else np.asarray(arcs[i], dtype = float).reshape(-1, 3)
+                    for n, i in enumerate(keep)]
+        before = travel_length(strokes, self.start)
+        if len(strokes) == 0:
+            self.report = {'travel_before': 0.0, 'travel_after': 0.0, 'strokes_in': 0, 'strokes_out': 0, 'joined': 0}
+            return [], ([] if arcs is not None else None)
+        order = self._nearest_neighbour(strokes)
+        order = self._two_opt(strokes, order)
+        # Put every stroke the right way around / at the right start point
+        new_strokes, new_arcs = [], []
+        for i, how in order:
+            stroke_arcs = None if arcs is None else arcs[i]
+            if how == 'reverse':
+                points, stroke_arcs = reverse_stroke(strokes[i], stroke_arcs)
+            elif how == 'forward':
+                points = strokes[i]
+            else:
+                points, stroke_arcs = rotate_stroke(strokes[i], stroke_arcs, how)
+            new_strokes.append(points)
+            new_arcs.append(stroke_arcs)
+        new_strokes, new_arcs, joined = self._join(new_strokes, new_arcs)
+        self.report = {
+            'travel_before': before,
+            'travel_after': travel_length(new_strokes, self.start),
+            'strokes_in': len(strokes),
+            'strokes_out': len(new_strokes),
+            'joined': joined,
+        }
+        return new_strokes, (new_arcs if arcs is not None else None)
+
+    def _is_closed(self, stroke):
+        return len(stroke) > 2 and np.hypot(*(stroke[0] - stroke[-1])) <= self.close_tolerance
+
+    def _nearest_neighbour(self, strokes):
+        # Open strokes can start at either end, closed ones at any point
+        ends = np.vstack([stroke[[0, -1]] for stroke in strokes])
+        extent = np.ptp(np.vstack((ends, [self.start])), axis = 0).max()
+        cell_size = max(extent / np.sqrt(len(ends)), 1e-3)
+        grid = Endpoint_Grid(cell_size)
+        for i, stroke in enumerate(strokes):
+            if self._is_closed(stroke):
+                for k in range(len(stroke)):
+                    grid.add(stroke[k], (i, k))
+            else:
+                grid.add(stroke[0], (i, 'forward'))
+                grid.add(stroke[-1], (i, 'reverse'))
+        used = np.zeros(len(strokes), dtype = bool)
+        available = lambda key: not used[key[0]]
+        position = np.asarray(self.start, dtype = float)
+        order = []
+        while len(order) < len(strokes):
+            distance, (i, how) = grid.nearest(position, available)
+            used[i] = True
+            order.append((i, how))
+            if how == 'forward':
+                position = strokes[i][-1]
+            elif how == 'reverse':
+                position = strokes[i][0]
+            else:
+                position = strokes[i][how] # Closed strokes end where they start
+        return order
+
+    def _two_opt(self, strokes, order):
+        n = len(order)
+        if n == 0 or self.two_opt_passes <= 0:
+            return order
+        # Entry and exit point of every stroke in the order they're drawn
+        entry = np.empty((n, 2))
+        exit = np.empty((n, 2))
+        for m, (i, how) in enumerate(order):
+            if how == 'forward':
+                entry[m], exit[m] = strokes[i][0], strokes[i][-1]
+            elif how == 'reverse':
+                entry[m], exit[m] = strokes[i][-1], strokes[i][0]
+            else:
+                entry[m] = exit[m] = strokes[i][how]
+        order = list(order)
+        start = np.asarray(self.start, dtype = float)
+        flip = {'forward': 'reverse', 'reverse': 'forward'}
+        for _ in range(self.two_opt_passes):
+            improved = False
+            for a in range(n):
+                # Reverse the run a..b for every b at once: only the gaps at
+                # both ends of the run change (the last run has no gap after)
+                before_a = start if a == 0 else exit[a - 1]
+                b = np.arange(a, n)
+                after_b = entry[np.minimum(b + 1, n - 1)]
+                has_next = b + 1 < n
+                old = np.hypot(*(entry[a] - before_a)) + np.where(has_next, np.hypot(*(exit[b] - after_b).T), 0)
+                new = np.hypot(*(exit[b] - before_a).T) + np.where(has_next, np.hypot(*(entry[a] - after_b).T), 0)
+                gain = old - new
+                best = int(np.argmax(gain))
+                if gain[best] > 1e-9:
+                    last = b[best]
+                    entry[a:last + 1], exit[a:last + 1] = exit[a:last + 1][::-1].copy(), entry[a:last + 1][::-1].copy()
+                    order[a:last + 1] = [(i, flip.get(how, how)) for i, how in order[a:last + 1][::-1]]
+                    improved = True
+            if not improved:
+                break
+        return order
+
+    def _join(self, strokes, arcs):
+        if self.join_tolerance <= 0 or len(strokes) < 2:
+            return strokes, arcs, 0
+        joined_strokes, joined_arcs = [strokes[0]], [arcs[0]]
+        joined = 0
+        for points, stroke_arcs in zip(strokes[1:], arcs[1:]):
+            gap = np.hypot(*(points[0] - joined_strokes[-1][-1]))
+            if gap > self.join_tolerance:
+                joined_strokes.append(points)
+                joined_arcs.append(stroke_arcs)
+                continue
+            # Draw across the gap (a line) instead of a rapid move
+            if gap == 0:
+                points = points[1:]
+                stroke_arcs = None if stroke_arcs is None else stroke_arcs[1:]
+            joined_strokes[-1] = np.vstack((joined_strokes[-1], points))
+            if stroke_arcs is not None:
+                joined_arcs[-1] = np.vstack((joined_arcs[-1], stroke_arcs))
+            joined += 1
+        return joined_strokes, joined_arcs, joined
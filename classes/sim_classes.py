@@ -0,0 +1,261 @@
+import math
+from collections import deque
+import numpy as np
+import cv2 as cv
+from classes.stream_classes import clean_line, WORD
+
+class Planner_Block:
+    """
+    Purpose: One move in the Job_Simulator's planner (like a grbl block)
+    Instance Variables:
+        self.length (float): Length of the move (mm)
+        self.nominal2 (float): Square of the speed the move wants to run at
+        self.accel (float): Acceleration of the move (mm/s^2)
+        self.max_entry2 (float): Square of the fastest speed the move can be
+            entered at (junction deviation with the move before it)
+        self.entry2 (float): Square of the planned entry speed
+        self.start_dir / self.end_dir (array): Unit direction of the move at
+            its start and end (differ for arcs)
+    """
+
+    def __init__(self, length, nominal, accel, start_dir, end_dir):
+        self.length = length
+        self.nominal2 = nominal * nominal
+        self.accel = accel
+        self.start_dir = start_dir
+        self.end_dir = end_dir
+        self.max_entry2 = 0.0
+        self.entry2 = 0.0
+
+def block_time(block, exit2):
+    """
+    Purpose: Time a block takes with a trapezoid (or triangle) speed profile
+        - block (Planner_Block): Planned block
+        - exit2 (float): Square of the speed the block is left at
+    Returns: Time (seconds)
+    """
+    v_entry, v_exit = math.sqrt(block.entry2), math.sqrt(exit2)
+    a = block.accel
+    accel_dist = (block.nominal2 - block.entry2) / (2 * a)
+    decel_dist = (block.nominal2 - exit2) / (2 * a)
+    if accel_dist + decel_dist <= block.length:
+        v_nominal = math.sqrt(block.nominal2)
+        cruise = block.length - accel_dist - decel_dist
+        return (v_nominal - v_entry) / a + (v_nominal - v_exit) / a + cruise / v_nominal
+    # Never gets up to speed: accelerate to a peak, then slow down
+    v_peak = math.sqrt(max((2 * a * block.length + block.entry2 + exit2) / 2, 0))
+    return (v_peak - v_entry) / a + (v_peak - v_exit) / a
+
+class Job_Simulator:
+    """
+    Purpose: Dry run a g-code program before it is sent to the robot. Every
+        line is read once, in order, so files and generators (e.g.
+        GCode_EX.iter_strokes) both work without holding the program in memory.
+        Checks that every drawing move stays on the platform and that the
+        syringe (z-axis) doesn't run out, and estimates the run time with a
+        grbl-like planner (acceleration and junction deviation over a fixed
+        lookahead buffer).
+    Instance Variables:
+        self.bounds (array of flt [x y]): Corners of the platform in mm
+            (Cookie_Vision.platform_mm()). None skips the bounds check
+        self.bounds_tolerance (float): How far (mm) moves may go past bounds
+        self.z_capacity (float): Z-coordinate at which the syringe is empty
+            (mm). None skips the check
+        self.max_rate (flt [x y z]): Fastest speed of each axis (mm/min,
+            grbl $110-$112). Rapid moves run at these speeds
+        self.accel (flt [x y z]): Acceleration of each axis (mm/s^2, grbl
+            $120-$122)
+        self.junction_deviation (float): grbl $11 (mm)
+        self.planner_size (int): Blocks the planner can look ahead (grbl: 16)
+    Methods:
+        simulate(self, lines)
+            Runs the program and returns a report dictionary:
+            - ok (bool): True if the program can be run
+            - errors (list of tuple): (line number, line, reason) for every
+            problem found
+            - lines, moves (int): Lines read and moves planned
+            - time (float): Estimated run time (seconds)
+            - draw_length, travel_length (float): mm drawn (G1/G2/G3) and mm
+            of rapid moves (G0)
+            - z_start, z_max, z_end (float): Syringe positions
+        simulate_file(self, file_name)
+            Same as simulate for a g-code file
+    """
+
+    def __init__(self, bounds = None, bounds_tolerance = 0.5, z_capacity = None, max_rate = (1000, 1000, 500),
+                 accel = (50, 50, 50), junction_deviation = 0.01, planner_size = 16):
+        self.bounds = None if bounds is None else np.asarray(bounds, dtype = np.float32).reshape(-1, 1, 2)
+        self.bounds_tolerance = bounds_tolerance
+        self.z_capacity = z_capacity
+        self.max_rate = np.asarray(max_rate, dtype = float) / 60 # mm/s
+        self.accel = np.asarray(accel, dtype = float)
+        self.junction_deviation = junction_deviation
+        self.planner_size = planner_size
+
+    def simulate_file(self, file_name):
+        with open(file_name, 'r') as f:
+            return self.simulate(f)
+
+    def simulate(self, lines):
+        report = {'ok': True, 'errors': [], 'lines': 0, 'moves': 0, 'time': 0.0, 'draw_length': 0.0,
+                  'travel_length': 0.0, 'z_start': None, 'z_max': None, 'z_end': None}
+        position = np.zeros(3)
+        modal = 0
+        absolute = True
+        feed = None
+        planner = deque()
+        self._last_dir = None
+        for n, line in enumerate(lines):
+            report['lines'] += 1
+            text = clean_line(line).upper().replace(' ', '')
+            if not text:
+                continue
+            values = {}
+            g_codes = []
+            bad = False
+            for letter, number in WORD.findall(text):
+                if number in ('', '-', '+', '.'):
+                    bad = True
+                elif letter == 'G':
+                    g_codes.append(float(number))
+                else:
+                    values[letter] = float(number)
+            if bad:
+                self._error(report, n, line, 'bad number')
+                continue
+            for g in g_codes:
+                if g in (0, 1, 2, 3):
+                    modal = int(g)
+                elif g == 90:
+                    absolute = True
+                elif g == 91:
+                    absolute = False
+                elif g == 4:
+                    # Dwell: the planner empties first
+                    self._flush(planner, report)
+                    report['time'] += values.get('P', 0)
+            if 'F' in values:
+                feed = values['F'] / 60
+            if not any(axis in values for axis in 'XYZ'):
+                continue
+            end = position.copy()
+            for i, axis in enumerate('XYZ'):
+                if axis in values:
+                    end[i] = values[axis] if absolute else position[i] + values[axis]
+            if modal != 0 and feed is None:
+                self._error(report, n, line, 'no feed rate')
+                position = end
+                continue
+            if modal in (2, 3):
+                move = self._arc(position, end, values, modal == 2)
+                if move is None:
+                    self._error(report, n, line, 'bad arc')
+                    position = end
+                    continue
+                length, start_dir, end_dir, check_points, radius = move
+            else:
+                delta = end - position
+                length = float(np.linalg.norm(delta))
+                start_dir = end_dir = delta / length if length > 0 else None
+                check_points = [end[:2]]
+                radius = None
+            # Only drawing moves have to stay on the platform
+            if modal != 0 and not self._in_bounds(check_points):
+                self._error(report, n, line, 'off the platform')
+            if report['z_start'] is None:
+                report['z_start'] = position[2]
+                report['z_max'] = position[2]
+            report['z_max'] = max(report['z_max'], end[2])
+            if self.z_capacity is not None and end[2] > self.z_capacity:
+                self._error(report, n, line, 'syringe empty')
+            report['draw_length' if modal != 0 else 'travel_length'] += length
+            position = end
+            if length > 0:
+                self._plan(planner, report, length, modal, feed, start_dir, end_dir, radius)
+        self._flush(planner, report)
+        report['z_end'] = position[2]
+        for key in ('time', 'z_start', 'z_max', 'z_end'):
+            if report[key] is not None:
+                report[key] = float(report[key])
+        report['ok'] = not report['errors']
+        return report
+
+    def _error(self, report, n, line, reason):
+        report['errors'].append((n, clean_line(line), reason))
+
+    def _in_bounds(self, points):
+        if self.bounds is None:
+            return True
+        for x, y in points:
+            if cv.pointPolygonTest(self.bounds, (float(x), float(y)), True) < -self.bounds_tolerance:
+                return False
+        return True
+
+    def _arc(self, start, end, values, clockwise):
+        center = start[:2] + np.array([values.get('I', 0), values.get('J', 0)])
+        r_start = np.hypot(*(start[:2] - center))
+        r_end = np.hypot(*(end[:2] - center))
+        # grbl rejects arcs whose end isn't on the circle (error 33)
+        if r_start == 0 or abs(r_start - r_end) > max(0.005, 0.001 * r_start):
+            return None
+        a_start = math.atan2(start[1] - center[1], start[0] - center[0])
+        a_end = math.atan2(end[1] - center[1], end[0] - center[0])
+        sweep = ((a_start - a_end) if clockwise else (a_end - a_start)) % (2 * math.pi) or 2 * math.pi
+        length = math.hypot(r_start * sweep, end[2] - start[2])
+        sign = -1 if clockwise else 1
+
+        def tangent(angle):
+            t = np.array([-math.sin(angle) * sign * r_start * sweep, math.cos(angle) * sign * r_start * sweep, end[2] - start[2]])
+            return t / np.linalg.norm(t)
+
+        # End points plus points along the arc for the bounds check
+        angles = a_start + sign * sweep * np.linspace(0, 1, 9)
+        check_points = center + r_start * np.column_stack((np.cos(angles), np.sin(angles)))
+        return length, tangent(a_start), tangent(a_start + sign * sweep), check_points, r_start
+
+    def _plan(self, planner, report, length, modal, feed, start_dir, end_dir, radius):
+        # Speed and acceleration are limited by the slowest axis that moves
+        with np.errstate(divide = 'ignore'):
+            axis_rate = np.min(self.max_rate / np.abs(start_dir))
+            axis_accel = np.min(self.accel / np.abs(start_dir))
+        nominal = axis_rate if modal == 0 else min(feed, axis_rate)
+        if radius is not None:
+            nominal = min(nominal, math.sqrt(axis_accel * radius)) # Centripetal limit
+        block = Planner_Block(length, nominal, axis_accel, start_dir, end_dir)
+        if self._last_dir is not None:
+            # grbl's junction deviation: how fast the corner can be taken
+            cos_theta = -float(np.dot(self._last_dir, start_dir))
+            if cos_theta < 0.999999:
+                sin_half = math.sqrt(max(0.5 * (1 - cos_theta), 0))
+                if sin_half < 0.999999:
+                    block.max_entry2 = axis_accel * self.junction_deviation * sin_half / (1 - sin_half)
+                else:
+                    block.max_entry2 = float('inf')
+                block.max_entry2 = min(block.max_entry2, block.nominal2, planner[-1].nominal2 if planner else block.nominal2)
+        self._last_dir = end_dir
+        planner.append(block)
+        report['moves'] += 1
+        self._recalculate(planner)
+        if len(planner) > self.planner_size:
+            # The oldest block runs with what the planner knew at the time
+            oldest = planner.popleft()
+            report['time'] += block_time(oldest, planner[0].entry2)
+
+    def _recalculate(self, planner):
+        # Backward pass: every block must be able to stop by the end of the buffer
+        exit2 = 0.0
+        for k in range(len(planner) - 1, 0, -1):
+            block = planner[k]
+            block.entry2 = min(block.max_entry2, exit2 + 2 * block.accel * block.length)
+            exit2 = block.entry2
+        # Forward pass: can't enter faster than the block before could reach
+        for k in range(1, len(planner)):
+            before = planner[k - 1]
+            planner[k].entry2 = min(planner[k].entry2, before.entry2 + 2 * before.accel * before.length)
+
+    def _flush(self, planner, report):
+        self._recalculate(planner)
+        while planner:
+            block = planner.popleft()
+            report['time'] += block_time(block, planner[0].entry2 if planner else 0.0)
+        self._last_dir = None
@@ -0,0 +1,716 @@
+import threading
+import queue
+import time
+import logging
+import os
+import re
+import json
+import math
+from collections import deque
+from concurrent.futures import Future
+from classes.metrics_classes import METRICS
+
+log = logging.getLogger(__name__)
+
+# One g-code word: letter and number (the number can be missing or bad)
+WORD = re.compile(r'([A-Z])([-+]?[0-9]*\.?[0-9]*)')
+# A motion mode word (G0, G1, G2, G3 with optional leading zero)
+MOTION_WORD = re.compile(r'G0?[0-3](?![0-9.])')
+# grbl's $12 arc tolerance (mm): G02/G03 are cut into planner blocks this close to the arc
+ARC_TOLERANCE = 0.002
+# Words that make a line a move, and the center/radius words of an arc
+AXIS_WORD = re.compile(r'[XYZ][-+.0-9]')
+ARC_WORD = re.compile(r'[IJR][-+.0-9]')
+SET_POSITION = re.compile(r'G92(?![0-9.])')
+
+def clean_line(line):
+    """
+    Purpose: Strip comments, whitespace and EOL characters from a line of g-code
+        - line (str or bytes): Line of g-code
+    Returns: The cleaned line (str). Empty if nothing is left to send.
+    """
+    if isinstance(line, bytes):
+        line = line.decode('ascii', 'ignore')
+    # Remove (...) comments and everything after a ';'
+    while '(' in line and ')' in line:
+        start = line.index('(')
+        end = line.index(')', start) + 1
+        line = line[:start] + line[end:]
+    line = line.split(';')[0]
+    return line.strip()
+
+def line_blocks(line):
+    """
+    Purpose: Tell how many of grbl's planner blocks a line takes, without
+        keeping track of modes (Job_Checkpoint counts them exactly)
+        - line (str): Cleaned line of g-code
+    Returns: 0 if the line doesn't move, 1 for a straight move, None for an
+        arc (grbl cuts it into many blocks)
+    """
+    line = line.upper()
+    if not AXIS_WORD.search(line) or SET_POSITION.search(line):
+        return 0
+    if ARC_WORD.search(line):
+        return None
+    return 1
+
+def parse_status(report):
+    """
+    Purpose: Read a grbl 1.1 status report, e.g.
+        '<Run|MPos:10.000,5.000,1.250|Bf:12,98|FS:500,0>'
+        - report (str): Line grbl sent back after a '?'
+    Returns: Dictionary (None if report isn't a status report) with:
+        - state (str): Idle, Run, Hold, Jog, Alarm, Door, Check, Home or Sleep
+        (sub-states like 'Hold:0' are cut off)
+        - mpos / wpos (tuple of flt): Machine / work position (None if grbl
+        didn't send it)
+        - planner_free (int): Free blocks in the planner (None if not sent)
+        - rx_free (int): Free bytes in the RX buffer (None if not sent)
+        - feed (float): Current feed rate (None if not sent)
+        - time (float): When the report was read
+    """
+    report = report.strip()
+    if not (report.startswith('<') and report.endswith('>')):
+        return None
+    fields = report[1:-1].split('|')
+    status = {'state': fields[0].split(':')[0], 'mpos': None, 'wpos': None, 'planner_free': None,
+              'rx_free': None, 'feed': None, 'time': time.time()}
+    try:
+        for field in fields[1:]:
+            name, _, value = field.partition(':')
+            numbers = [float(number) for number in value.split(',')] if value else []
+            if name == 'MPos':
+                status['mpos'] = tuple(numbers)
+            elif name == 'WPos':
+                status['wpos'] = tuple(numbers)
+            elif name == 'WCO':
+                status['wco'] = tuple(numbers)
+            elif name == 'Bf':
+                status['planner_free'], status['rx_free'] = int(numbers[0]), int(numbers[1])
+            elif name in ('FS', 'F'):
+                status['feed'] = numbers[0]
+    except (ValueError, IndexError):
+        return None
+    # grbl only sends one of MPos/WPos: the other comes from the work offset
+    if 'wco' in status:
+        offset = status.pop('wco')
+        if status['mpos'] is not None and status['wpos'] is None:
+            status['wpos'] = tuple(m - o for m, o in zip(status['mpos'], offset))
+        elif status['wpos'] is not None and status['mpos'] is None:
+            status['mpos'] = tuple(w + o for w, o in zip(status['wpos'], offset))
+    return status
+
+class Stream_Job(Future):
+    """
+    Purpose: Future returned by Grbl_Streamer.stream(). Completes once every
+        line of the job was acknowledged by grbl. Progress can be read while
+        the job runs.
+    Instance Variables:
+        self.total (int): Number of lines in the job (None if unknown)
+        self.sent (int): Number of lines written to the serial port
+        self.acked (int): Number of lines grbl answered with 'ok' or 'error'
+        self.errors (list of tuple): (line number, line, response) of every
+            line grbl answered with 'error'
+        self.start_time (float): Time the first line was sent
+        self.planner_used (int): Blocks still waiting in grbl's planner (from
+            the last status report, None without reports). An arc line is cut
+            into many blocks
+        self.checkpoint (Job_Checkpoint): Records the job's progress (None
+            if the job isn't checkpointed)
+    Methods:
+        progress(self)
+            Returns a dictionary with the current progress of the job. If
+            status reports are coming in (see Status_Poller), 'executed' is the
+            number of lines the machine has finished (None otherwise): the
+            acknowledged lines less the ones whose blocks are still in the
+            planner (an arc that is still in it holds the rest of the blocks)
+    """
+
+    def __init__(self, total = None, checkpoint = None):
+        super().__init__()
+        self.total = total
+        self.checkpoint = checkpoint
+        self.sent = 0
+        self.acked = 0
+        self.errors = []
+        self.start_time = None
+        self.end_time = None
+        self.bytes_sent = 0
+        self.max_in_flight = 0
+        self.planner_used = None
+        self._occupancy_sum = 0
+        self._resets = 0 # Streamer's soft reset count when the job was created
+        self._blocks = deque(maxlen = 64) # line_blocks of the last acknowledged lines
+
+    def progress(self):
+        elapsed = 0
+        if self.start_time is not None:
+            elapsed = (self.end_time or time.time()) - self.start_time
+        return {
+            'sent': self.sent,
+            'acked': self.acked,
+            'total': self.total,
+            'errors': len(self.errors),
+            'elapsed': elapsed,
+            'lines_per_sec': self.acked / elapsed if elapsed > 0 else 0,
+            'mean_buffer': self._occupancy_sum / self.sent if self.sent else 0,
+            'max_buffer': self.max_in_flight,
+            'executed': None if self.planner_used is None else self.acked - self._lines_planned(),
+        }
+
+    def _lines_planned(self):
+        # Newest acknowledged lines that still have blocks in grbl's planner
+        blocks = self.planner_used
+        lines = 0
+        for line_blocks in reversed(self._blocks):
+            if blocks <= 0:
+                break
+            lines += 1
+            if line_blocks is None:
+                break # An arc: the rest of the planner is (at most) this line
+            blocks -= line_blocks
+        return lines
+
+class Job_Aborted(Exception):
+    """Raised by a Stream_Job when grbl was soft reset while it was streaming"""
+
+class Job_Checkpoint:
+    """
+    Purpose: Keeps track of how far a streamed program got, so a job that was
+        aborted or lost its serial port can carry on where it stopped instead
+        of starting the cookie over. Every acknowledged line moves the
+        checkpoint on, and it is saved to a small JSON file every interval
+        seconds (and when the job ends).
+    Instance Variables:
+        self.file_path (str): JSON file the checkpoint is saved to
+        self.program (str): G-code file of the job (needed to resume it)
+        self.interval (float): Seconds between saves while streaming
+        self.line (int): Program lines done (not counting empty/comment lines,
+            same as the streamer). Resuming starts at this line
+        self.position (list of flt [x y z]): Where the machine is after
+            those lines. z is how far the syringe has pushed
+        self.feed (float): Last feed rate (None if none was set)
+        self.motion (int): Motion mode in effect (0-3 for G0-G3)
+        self.absolute (bool): G90 (True) or G91 (False) in effect
+        self.complete (bool): True once every line was acknowledged with 'ok'
+        self.lost (bool): True if a rollback went further back than the
+            history kept: the checkpoint can't be resumed
+        self.arc_tolerance (float): grbl's $12 setting (mm), used to count
+            the planner blocks an arc is cut into
+    Methods:
+        update(self, line_number, line, ok)
+            Records that grbl answered a line. ok is False for errors: grbl
+            didn't run the line, so the checkpoint stays where it is (e.g.
+            every line is rejected with 'error:9' while grbl is in an alarm)
+        rollback(self, blocks)
+            Steps back over the acknowledged lines that made the last blocks
+            planner blocks (the moves still in grbl's planner when it was
+            reset). A line is one block, an arc as many as grbl cuts it into
+            and a line that doesn't move none. Returns False (and marks the
+            checkpoint lost) if the history doesn't go back that far
+        save(self) / load(self)
+            Save/load the checkpoint file. load returns True if loaded
+        finish(self)
+            Marks the job complete and saves
+        resume_lines(self, unlock = True)
+            Yields the lines that carry on the job: G90, G92 Z (tells grbl the
+            syringe is where the checkpoint left it), G00 back to the last x, y,
+            the feed rate and motion/distance modes, then the program from the
+            first line that wasn't done. unlock adds '$X' first, since a reset
+            during a move leaves grbl locked in an alarm. A G92.1 at the end
+            clears the Z offset again (G92 offsets outlast the program, so the
+            next job would run with a shifted Z otherwise)
+    """
+
+    def __init__(self, file_path, program = None, interval = 1.0, history = 32, arc_tolerance = ARC_TOLERANCE):
+        self.file_path = file_path
+        self.program = program
+        self.interval = interval
+        self.line = 0
+        self.position = [0.0, 0.0, 0.0]
+        self.feed = None
+        self.motion = 0
+        self.absolute = True
+        self.complete = False
+        self.lost = False
+        self.arc_tolerance = arc_tolerance
+        self._base = 0 # Program line of streamer line 0 (resumed jobs start after a preamble)
+        self._history = deque(maxlen = history) # State before each of the last updates and its planner blocks
+        self._last_save = 0
+
+    def update(self, line_number, line, ok = True):
+        if ok:
+            state = (self.line, list(self.position), self.feed, self.motion, self.absolute)
+            self.line = max(self.line, self._base + line_number + 1)
+            self._history.append(state + (self._apply(line),))
+        if time.time() - self._last_save >= self.interval:
+            self.save()
+
+    def _apply(self, line):
+        values = {}
+        set_position = False
+        for letter, number in WORD.findall(line.upper().replace(' ', '')):
+            try:
+                value = float(number)
+            except ValueError:
+                continue # e.g. '$X'
+            if letter != 'G':
+                values[letter] = value
+            elif value in (0, 1, 2, 3):
+                self.motion = int(value)
+            elif value == 90:
+                self.absolute = True
+            elif value == 91:
+                self.absolute = False
+            elif value == 92:
+                set_position = True
+        if 'F' in values:
+            self.feed = values['F']
+        start = list(self.position)
+        for i, axis in enumerate('XYZ'):
+            if axis in values:
+                if set_position or self.absolute:
+                    self.position[i] = values[axis]
+                else:
+                    self.position[i] += values[axis]
+        if set_position or self.position == start:
+            return 0 # grbl doesn't plan moves that go nowhere
+        if self.motion in (2, 3) and ('I' in values or 'J' in values):
+            return self._arc_blocks(start, values.get('I', 0), values.get('J', 0))
+        return 1
+
+    def _arc_blocks(self, start, i, j):
+        # Number of segments grbl's mc_arc cuts the arc into
+        radius = math.hypot(i, j)
+        if radius <= self.arc_tolerance:
+            return 1
+        start_x, start_y = -i, -j
+        end_x, end_y = self.position[0] - start[0] - i, self.position[1] - start[1] - j
+        travel = math.atan2(start_x * end_y - start_y * end_x, start_x * end_x + start_y * end_y)
+        if self.motion == 2 and travel >= -5e-7:
+            travel -= 2 * math.pi
+        elif self.motion == 3 and travel <= 5e-7:
+            travel += 2 * math.pi
+        segment = math.sqrt(self.arc_tolerance * (2 * radius - self.arc_tolerance))
+        return max(int(abs(0.5 * travel * radius) / segment), 1)
+
+    def rollback(self, blocks):
+        while blocks > 0:
+            if not self._history:
+                self.lost = True
+                log.error("Checkpoint %s: the planner held more moves than the %d lines of history kept, can't resume it",
+                          self.file_path, self._history.maxlen)
+                return False
+            line, position, feed, motion, absolute, line_blocks = self._history.pop()
+            self.line, self.position, self.feed, self.motion, self.absolute = line, position, feed, motion, absolute
+            blocks -= line_blocks
+        return True
+
+    def finish(self):
+        self.complete = True
+        self.save()
+
+    def save(self):
+        self._last_save = time.time()
+        checkpoint = {
+            'saved': time.ctime(),
+            'program': self.program,
+            'line': self.line,
+            'position': self.position,
+            'feed': self.feed,
+            'motion': self.motion,
+            'absolute': self.absolute,
+            'complete': self.complete,
+            'lost': self.lost,
+        }
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.file_path)), exist_ok = True)
+            # Write a temporary file first so a crash never leaves half a checkpoint
+            with open(self.file_path + '.tmp', 'w') as f:
+                json.dump(checkpoint, f, indent = 4)
+            os.replace(self.file_path + '.tmp', self.file_path)
+        except Exception as e:
+            print(e)
+            print("Error occured while saving checkpoint to " + self.file_path)
+
+    def load(self):
+        if not os.path.isfile(self.file_path):
+            return False
+        try:
+            with open(self.file_path, 'r') as f:
+                checkpoint = json.load(f)
+            self.program = checkpoint['program']
+            self.line = checkpoint['line']
+            self.position = [float(value) for value in checkpoint['position']]
+            self.feed = checkpoint['feed']
+            self.motion = checkpoint['motion']
+            self.absolute = checkpoint['absolute']
+            self.complete = checkpoint['complete']
+            self.lost = checkpoint.get('lost', False)
+            self._history.clear()
+            return True
+        except Exception as e:
+            print(e)
+            print("Error occured while loading checkpoint " + self.file_path)
+            return False
+
+    def resume_lines(self, unlock = True):
+        x, y, z = self.position
+        preamble = ['$X'] if unlock else []
+        preamble += ['G90', 'G92 Z%.3f' % z, 'G00 X%.3f Y%.3f' % (x, y)]
+        modal = 'G00' if self.motion == 0 else 'G01'
+        if self.feed is not None:
+            modal += ' F%g' % self.feed
+        preamble.append(modal)
+        if not self.absolute:
+            preamble.append('G91')
+        start = self.line
+        self._base = start - len(preamble)
+        for line in preamble:
+            yield line + '\n'
+        n = 0
+        with open(self.program, 'r') as f:
+            for line in f:
+                line_send = clean_line(line)
+                if not line_send:
+                    continue
+                if n == start and self.motion in (2, 3) and not MOTION_WORD.search(line_send.upper()):
+                    # Arcs can't be set up without a move: put the mode on the first line
+                    line_send = 'G%d %s' % (self.motion, line_send)
+                if n >= start:
+                    yield line_send + '\n'
+                n += 1
+        yield 'G92.1\n'
+
+class Grbl_Streamer:
+    """
+    Purpose: Stream g-code to grbl using character-counting flow control. A
+        reader thread owns ser.readline() and sorts responses into queues, and
+        a sender thread per job keeps grbl's RX buffer as full as possible.
+    Instance Variables:
+        self.ser (obj): Open serial port to the robot
+        self.rx_buffer_size (int): Size of grbl's serial RX buffer (bytes)
+        self.wake_delay (float): Seconds to wait for grbl to boot after waking
+        self.responses (Queue): 'ok' and 'error' responses from grbl
+        self.messages (Queue): Every other line grbl sends (welcome, alarms,
+            feedback messages) except status reports
+        self.status (dict): Last status report (see parse_status, None until
+            the first one). Reports come in when '?' is sent, e.g. by a
+            Status_Poller
+        self.status_listeners (list): Functions called with every status report
+            (on the reader thread, so they have to be quick)
+        self.adaptive (bool): Let status reports change self.fill_limit
+        self.fill_limit (int): Bytes the sender keeps in grbl's RX buffer. The
+            whole buffer unless adaptive: while grbl's planner is full, extra
+            bytes in the RX buffer don't make the job faster, so the limit is
+            lowered (down to self.min_fill) and acknowledged lines stay close
+            to what the machine is doing. As soon as the planner runs low
+            (self.starve_blocks free blocks or more while running) the limit
+            goes back to the whole buffer
+        self.planner_blocks (int): Size of grbl's planner (largest number of
+            free blocks reported)
+    Methods:
+        start(self)
+            Wakes grbl (once) and starts the reader thread
+        stop(self)
+            Stops the reader thread
+        write(self, data)
+            Writes raw bytes to the serial port (thread safe)
+        stream(self, lines, total, checkpoint)
+            Streams an iterable of g-code lines in the background and returns
+            a Stream_Job future. Lines are pulled lazily from the iterable.
+            - lines (iterable of str): G-code to send
+            - total (int): Number of lines (taken from len(lines) if possible)
+            - checkpoint (Job_Checkpoint): Records every acknowledged line so
+            the job can be resumed if it fails (None to not checkpoint)
+        feed_hold(self) / cycle_start(self)
+            Sends grbl's real-time feed hold ('!') / resume ('~') commands.
+            Real-time commands skip the RX buffer, so they act right away.
+        soft_reset(self)
+            Sends grbl's real-time soft reset (ctrl-x). grbl stops and throws
+            away its buffers, so the running job fails with Job_Aborted, and
+            so do jobs that were streamed before the reset but were still
+            waiting for grbl. The next job waits for grbl's welcome (up to
+            wake_delay seconds): lines sent while grbl restarts are lost, and
+            answers to lines sent before the reset are thrown away. A reset
+            during a move also locks grbl in an alarm until '$X' is sent.
+    """
+
+    def __init__(self, ser, rx_buffer_size = 127, wake_delay = 2):
+        self.ser = ser
+        self.rx_buffer_size = rx_buffer_size
+        self.wake_delay = wake_delay
+        self.responses = queue.Queue()
+        self.messages = queue.Queue()
+        self._write_lock = threading.Lock()
+        self._job_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._resets = 0 # Soft resets sent: jobs started before the last one are aborted
+        self._restarted = threading.Event() # Cleared from a soft reset until grbl's welcome
+        self._restarted.set()
+        self._reader = None
+        self._awake = False
+        self._job = None # Job whose moves are in grbl's planner (kept once it streamed every line)
+        self.status = None
+        self.status_listeners = []
+        self.adaptive = False
+        self.fill_limit = rx_buffer_size
+        self.min_fill = 48
+        self.starve_blocks = 4
+        self.planner_blocks = 15
+
+    def start(self):
+        if not self._awake:
+            # Wake up Arduino & flush the input of the serial stream
+            self.write(b"\r\n\r\n")
+            time.sleep(self.wake_delay)
+            self.ser.reset_input_buffer()
+            self._awake = True
+        if self._reader is None or not self._reader.is_alive():
+            self._stop.clear()
+            self._reader = threading.Thread(target = self._read_loop, name = 'grbl-reader', daemon = True)
+            self._reader.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
+
+    def write(self, data):
+        with self._write_lock:
+            self.ser.write(data)
+
+    def feed_hold(self):
+        self.write(b'!')
+
+    def cycle_start(self):
+        self.write(b'~')
+
+    def soft_reset(self):
+        with self._write_lock:
+            self._resets += 1
+            self._restarted.clear()
+            self.ser.write(b'\x18')
+
+    def stream(self, lines, total = None, checkpoint = None):
+        if total is None and hasattr(lines, '__len__'):
+            total = len(lines)
+        job = Stream_Job(total, checkpoint)
+        # A reset from now on aborts the job, even before its sender gets grbl
+        job._resets = self._resets
+        self.start()
+        job.set_running_or_notify_cancel()
+        sender = threading.Thread(target = self._send_loop, args = (job, lines), name = 'grbl-sender', daemon = True)
+        sender.start()
+        return job
+
+    def _read_loop(self):
+        while not self._stop.is_set():
+            try:
+                output = self.ser.readline()
+            except Exception as e:
+                self.messages.put('error: serial read failed (' + str(e) + ')')
+                break
+            if not output:
+                continue # Read timed out: check if the reader should stop
+            response = output.strip().decode('ascii', 'ignore')
+            if response.startswith('ok') or response.startswith('error'):
+                self.responses.put(response)
+            elif response.startswith('<'):
+                status = parse_status(response)
+                if status is not None:
+                    self._on_status(status)
+            elif response:
+                if response.startswith('Grbl'):
+                    # grbl restarted: answers still queued are from lines it had before
+                    while not self.responses.empty():
+                        self.responses.get_nowait()
+                    self._restarted.set()
+                self.messages.put(response)
+
+    def _on_status(self, status):
+        self.status = status
+        if status['planner_free'] is not None:
+            self.planner_blocks = max(self.planner_blocks, status['planner_free'])
+            job = self._job
+            if job is not None:
+                job.planner_used = self.planner_blocks - status['planner_free']
+            if self.adaptive:
+                self._adapt(status)
+            METRICS.gauge('planner_free', status['planner_free'])
+            METRICS.gauge('rx_free', status['rx_free'])
+        for listener in self.status_listeners:
+            try:
+                listener(status)
+            except Exception as e:
+                print(e)
+                print("Error occured in a status listener")
+
+    def _adapt(self, status):
+        if status['state'] == 'Run' and status['planner_free'] >= self.starve_blocks:
+            # Planner is running low: keep as much queued as possible
+            self.fill_limit = self.rx_buffer_size
+        elif status['planner_free'] == 0:
+            # Planner is full: the machine is the limit, not the serial line
+            self.fill_limit = max(self.min_fill, self.fill_limit - 16)
+
+    def _wait_response(self, job):
+        # Wait for grbl to answer without blocking forever if the reader stops
+        while True:
+            if self._resets != job._resets:
+                raise Job_Aborted("grbl was reset while streaming")
+            try:
+                return self.responses.get(timeout = 0.5)
+            except queue.Empty:
+                if self._stop.is_set():
+                    raise RuntimeError("Reader stopped while waiting for grbl")
+
+    def _send_loop(self, job, lines):
+        # Only one job can own grbl's RX buffer at a time
+        with self._job_lock:
+            self._job = job
+            self.fill_limit = self.rx_buffer_size
+            try:
+                if not self._restarted.wait(self.wake_delay):
+                    log.warning("grbl didn't restart after the soft reset, streaming anyway")
+                # Throw away responses left over from before this job
+                while not self.responses.empty():
+                    self.responses.get_nowait()
+                in_flight = deque() # (line number, line, number of bytes, send time) in grbl's buffer
+                # Checked once: formatting a message for every line is too slow
+                debug = log.isEnabledFor(logging.DEBUG)
+                buffer_used = 0
+                job.start_time = time.time()
+                for line in lines:
+                    line_send = clean_line(line)
+                    if not line_send:
+                        continue
+                    data = (line_send + '\n').encode('ascii')
+                    # Can send more once grbl has removed enough from the RX buffer
+                    while in_flight and buffer_used + len(data) > self.fill_limit:
+                        buffer_used -= self._ack(job, in_flight)
+                    with self._write_lock:
+                        # Checked with the lock soft_reset holds: no line goes out after a reset
+                        if self._resets != job._resets:
+                            raise Job_Aborted("grbl was reset while streaming")
+                        self.ser.write(data)
+                    if debug:
+                        log.debug("> %s", line_send)
+                    in_flight.append((job.sent, line_send, len(data), time.perf_counter()))
+                    buffer_used += len(data)
+                    job.sent += 1
+                    job.bytes_sent += len(data)
+                    job._occupancy_sum += buffer_used
+                    job.max_in_flight = max(job.max_in_flight, buffer_used)
+                # Wait for grbl to accept the rest of the job
+                while in_flight:
+                    buffer_used -= self._ack(job, in_flight)
+                job.end_time = time.time()
+                METRICS.observe('stream_job', job.end_time - job.start_time)
+                METRICS.count('lines_streamed', job.acked)
+                if job.checkpoint is not None:
+                    if job.errors:
+                        job.checkpoint.save() # Rejected lines still have to be done
+                    else:
+                        job.checkpoint.finish()
+                job.set_result(job.progress())
+            except Exception as e:
+                self._job = None # planner_used stays what it was when the job failed
+                job.end_time = time.time()
+                if hasattr(lines, 'close'):
+                    # A generator's clean-up runs now, before the job fails (e.g.
+                    # archive_gcode finishing a checkpointed program)
+                    lines.close()
+                if job.checkpoint is not None:
+                    if isinstance(e, Job_Aborted) and job.planner_used is not None:
+                        # The reset threw away the moves still in the planner
+                        # (marks the checkpoint lost if its history is too short)
+                        job.checkpoint.rollback(job.planner_used)
+                    job.checkpoint.save()
+                job.set_exception(e)
+
+    def _ack(self, job, in_flight):
+        response = self._wait_response(job)
+        line_number, line_send, num_bytes, sent_at = in_flight.popleft()
+        METRICS.observe('stream_ack', time.perf_counter() - sent_at)
+        ok = not response.startswith('error')
+        if not ok:
+            log.warning("Line %d '%s': %s", line_number + 1, line_send, response)
+            job.errors.append((line_number, line_send, response))
+        if job.checkpoint is not None:
+            job.checkpoint.update(line_number, line_send, ok)
+        job._blocks.append(line_blocks(line_send) if ok else 0) # Rejected lines never reach the planner
+        job.acked += 1
+        return num_bytes
+
+class Status_Poller:
+    """
+    Purpose: Asks grbl where it is by sending the real-time '?' command at a
+        fixed rate. '?' never goes into grbl's RX buffer, so it doesn't take
+        space from the job being streamed. The reports are read by the
+        streamer's reader thread (Grbl_Streamer.status)
+    Instance Variables:
+        self.streamer (Grbl_Streamer): Streamer of the robot that is polled
+        self.rate (float): Status reports asked for per second
+    Methods:
+        start(self) / stop(self)
+            Starts/stops polling (start wakes grbl if needed and returns self)
+        latest(self)
+            Last status report (see parse_status), None if there isn't one
+        position(self)
+            Last machine position (x, y, z), None if unknown
+        wait_update(self, timeout)
+            Waits for the next report. Returns it (None on timeout)
+    """
+
+    def __init__(self, streamer, rate = 5):
+        self.streamer = streamer
+        self.rate = rate
+        self._update = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        streamer.status_listeners.append(self._notify)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self.streamer.start()
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._poll_loop, name = 'grbl-status', daemon = True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def latest(self):
+        return self.streamer.status
+
+    def position(self):
+        status = self.streamer.status
+        if status is None:
+            return None
+        return status['wpos'] or status['mpos']
+
+    def wait_update(self, timeout = None):
+        with self._update:
+            last = self.streamer.status
+            self._update.wait_for(lambda: self.streamer.status is not last, timeout)
+            status = self.streamer.status
+        return None if status is last else status
+
+    def _notify(self, status):
+        with self._update:
+            self._update.notify_all()
+
+    def _poll_loop(self):
+        while not self._stop.wait(1 / self.rate):
+            try:
+                self.streamer.write(b'?')
+            except Exception as e:
+                print(e)
+                print("Error occured while asking grbl for its status")
+                break
@@ -1,6 +1,423 @@
 import numpy as np
 import cv2 as cv
 import math
+import os
+import json
+import time
+import logging
+from classes.path_classes import simplify_path, fit_arcs
+from classes.metrics_classes import METRICS
+
+# Where calibration results are kept between runs (found relative to this file)
+CALIBRATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibration')
+CALIBRATION_FILE = os.path.join(CALIBRATION_DIR, 'calibration.json')
+BACKGROUND_FILE = os.path.join(CALIBRATION_DIR, 'background.png')
+# 'exact' opens masks at full resolution, 'fast' on a pyramid-downscaled mask
+MASK_MODES = ('exact', 'fast')
+# 'fast' only pays off on big masks: smaller ones (e.g. the 640x480 camera) are opened 'exact'
+FAST_MIN_PIXELS = 800 * 600
+# Side of the red calibration square (mm)
+SQUARE_MM = 15
+
+log = logging.getLogger(__name__)
+
+def find_red_square(image, kernel_size = 25):
+    """
+    Purpose: Find the red calibration square in an image
+        - image (img): BGR image (or part of one) to search
+        - kernel_size (int): Size of the kernel used to remove noise
+    Returns: minAreaRect ((cx, cy), (w, h), angle) of the largest red area, or
+        None if nothing red was found
+    """
+    # Convert image from BGR to HSV (easier to detect color ranges)
+    hsv = cv.cvtColor(image, cv.COLOR_BGR2HSV)
+    # Apply mask with the upper and lower bounds (H-0-180)
+    mask = cv.inRange(hsv, np.array([0,150,50]), np.array([180,255,255]))
+    # Remove noise by eroding and dilating image
+    kernel = np.ones((kernel_size,kernel_size),np.uint8)
+    opening = cv.morphologyEx(mask, cv.MORPH_OPEN, kernel)
+    contours, hirarchy = cv.findContours(opening, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        return None
+    return cv.minAreaRect(max(contours, key = cv.contourArea))
+
+def platform_from_square(square_rect):
+    """
+    Purpose: Scale the red calibration square up to the printable area
+        - square_rect (tuple): minAreaRect of the red square
+    Returns: (l_avg, box_platform)
+        - l_avg (int): Average side length of the square (pixels)
+        - box_platform (array of int): Verticies of the printable area
+    """
+    rsq_l = np.intp(square_rect[1]) # Red Square length
+    l_avg = int((rsq_l[0] + rsq_l[1])/2) # Average length of square
+    l_platform = int(8.8 * l_avg)
+    w_platform = int(7.3 * l_avg)
+    bounding_platform = (square_rect[0], (w_platform, l_platform), square_rect[2])
+    return l_avg, np.intp(cv.boxPoints(bounding_platform))
+
+def sample_image(image, points):
+    """
+    Purpose: Bilinear interpolation of a single channel image at (sub-pixel)
+        points
+        - image (img): Single channel image
+        - points (array of flt (..., 2)): x, y of every sample
+    Returns: array of flt with the shape of points without the last axis
+    """
+    x = np.clip(points[..., 0], 0, image.shape[1] - 1.001)
+    y = np.clip(points[..., 1], 0, image.shape[0] - 1.001)
+    x0, y0 = np.floor(x).astype(np.intp), np.floor(y).astype(np.intp)
+    fx, fy = x - x0, y - y0
+    image = image.astype(np.float32)
+    top = image[y0, x0] * (1 - fx) + image[y0, x0 + 1] * fx
+    bottom = image[y0 + 1, x0] * (1 - fx) + image[y0 + 1, x0 + 1] * fx
+    return top * (1 - fy) + bottom * fy
+
+def square_corners(contour, square_rect, image = None, band = 3):
+    """
+    Purpose: Corners of the red square as the camera sees them. A minAreaRect
+        is always a rectangle, so when the camera looks at the platform at an
+        angle the corners are found from the sides instead: a line is fit to
+        the middle of every side (the noise removal rounds off the corners)
+        and neighbouring lines are intersected. A pixel of error at a 15 mm
+        square moves points several squares away by much more, so if an image
+        is given every side is moved onto the image's edge to a fraction of a
+        pixel first (the centroid of the drop from inside to outside)
+        - contour (array): Contour of the red square
+        - square_rect (tuple): minAreaRect of the contour
+        - image (img): Single channel image that changes linearly from the
+            square to the platform (e.g. red minus green). None skips the
+            sub-pixel refinement
+        - band (int): How far (pixels) a side may move when refined
+    Returns: array of flt (4, 2), in the same order as cv.boxPoints(square_rect)
+    """
+    box = cv.boxPoints(square_rect).astype(np.float64)
+    points = np.asarray(contour, dtype = np.float64).reshape(-1, 2)
+    lines = []
+    for k in range(4):
+        a, b = box[k], box[(k + 1) % 4]
+        side = b - a
+        length = np.linalg.norm(side)
+        if length == 0:
+            return box.astype(np.float32)
+        offset = points - a
+        along = offset @ side / length**2
+        across = np.abs(side[0] * offset[:, 1] - side[1] * offset[:, 0]) / length
+        # Middle half of the side, close to the rectangle's edge
+        middle = points[(along > 0.1) & (along < 0.9) & (across < 0.15 * length)]
+        if len(middle) < 2:
+            return box.astype(np.float32)
+        if image is not None:
+            # Profiles across the side, from inside the square to outside
+            outward = np.array([side[1], -side[0]]) / length
+            if outward @ (a - np.asarray(square_rect[0])) < 0:
+                outward = -outward
+            steps = np.arange(-band, band + 0.25, 0.25)
+            samples = middle[:, None, :] + steps[None, :, None] * outward
+            profiles = sample_image(image, samples)
+            # The edge is at the centroid of the drop from inside to outside
+            drop = np.maximum(profiles[:, :-1] - profiles[:, 1:], 0)
+            total = drop.sum(axis = 1)
+            found = total > 10
+            if np.count_nonzero(found) >= 2:
+                shift = (drop @ (steps[:-1] + 0.125)) / np.maximum(total, 1e-6)
+                middle = (middle + shift[:, None] * outward)[found]
+        vx, vy, x0, y0 = cv.fitLine(middle.astype(np.float32), cv.DIST_HUBER, 0, 0.01, 0.01).reshape(4)
+        lines.append((np.array([x0, y0]), np.array([vx, vy])))
+    corners = []
+    for k in range(4):
+        # Corner k is where side k-1 meets side k
+        (p0, d0), (p1, d1) = lines[k - 1], lines[k]
+        denominator = d0[0] * d1[1] - d0[1] * d1[0]
+        if abs(denominator) < 1e-6:
+            return box.astype(np.float32)
+        gap = p1 - p0
+        corners.append(p0 + d0 * (gap[0] * d1[1] - gap[1] * d1[0]) / denominator)
+    return np.array(corners, dtype = np.float32)
+
+class Pixel_To_MM:
+    """
+    Purpose: Converts camera pixels to platform mm (the g-code coordinates) with
+        one transform found at calibration: the lens distortion is undone (if
+        the camera was calibrated for it), then a homography takes the point
+        onto the platform, so the platform's rotation and the camera's
+        perspective are accounted for. Only the points of contours/strokes
+        are transformed, frames are never warped.
+    Instance Variables:
+        self.homography (array of flt 3x3): Undistorted pixels -> mm
+        self.scale (float): mm per pixel at the red square (used for
+            tolerances and areas)
+        self.camera_matrix (array of flt 3x3): Camera matrix from
+            cv.calibrateCamera (None to skip undistortion)
+        self.dist_coeffs (array of flt): Lens distortion coefficients from
+            cv.calibrateCamera (None to skip undistortion)
+    Methods:
+        to_mm(self, points)
+            Converts points (any shape with x, y last, e.g. a contour) to mm.
+            Returns an array of flt (N, 2)
+        to_pixels(self, points)
+            Converts points in mm back to camera pixels (e.g. to draw a
+            design on a frame). Returns an array of flt (N, 2)
+        to_dict(self)
+            The transform as lists (saved in the calibration JSON). The
+            transform can be made again with Pixel_To_MM(**dictionary)
+    """
+
+    def __init__(self, homography, scale, camera_matrix = None, dist_coeffs = None):
+        self.homography = np.asarray(homography, dtype = float)
+        self.scale = float(scale)
+        self.camera_matrix = None if camera_matrix is None else np.asarray(camera_matrix, dtype = float)
+        self.dist_coeffs = None if dist_coeffs is None else np.asarray(dist_coeffs, dtype = float)
+        self._inverse = np.linalg.inv(self.homography)
+
+    def _undistort(self, points):
+        if self.camera_matrix is None or self.dist_coeffs is None:
+            return points
+        return cv.undistortPoints(points, self.camera_matrix, self.dist_coeffs, P = self.camera_matrix)
+
+    def to_mm(self, points):
+        points = np.asarray(points, dtype = np.float64).reshape(-1, 1, 2)
+        if len(points) == 0:
+            return np.empty((0, 2))
+        return cv.perspectiveTransform(self._undistort(points), self.homography).reshape(-1, 2)
+
+    def to_pixels(self, points):
+        points = np.asarray(points, dtype = np.float64).reshape(-1, 1, 2)
+        if len(points) == 0:
+            return np.empty((0, 2))
+        pixels = cv.perspectiveTransform(points, self._inverse).reshape(-1, 2)
+        if self.camera_matrix is None or self.dist_coeffs is None:
+            return pixels
+        # Put the lens distortion back: project the normalized rays through the camera
+        rays = np.column_stack((pixels, np.ones(len(pixels)))) @ np.linalg.inv(self.camera_matrix).T
+        projected, jacobian = cv.projectPoints(rays, np.zeros(3), np.zeros(3), self.camera_matrix, self.dist_coeffs)
+        return projected.reshape(-1, 2)
+
+    def to_dict(self):
+        return {
+            'homography': self.homography.tolist(),
+            'scale': self.scale,
+            'camera_matrix': None if self.camera_matrix is None else self.camera_matrix.tolist(),
+            'dist_coeffs': None if self.dist_coeffs is None else self.dist_coeffs.tolist(),
+        }
+
+def square_transform(corners, origin, square_mm = SQUARE_MM, camera_matrix = None, dist_coeffs = None):
+    """
+    Purpose: Make the Pixel_To_MM transform of a calibration
+        - corners (array of flt (4, 2)): Corners of the red square in pixels,
+            in order around the square (see square_corners)
+        - origin (array [x y]): Pixel that becomes (0, 0) mm (the corner of
+            the printable area, box_platform[0])
+        - square_mm (float): Side of the red square (mm)
+        - camera_matrix, dist_coeffs: Lens calibration (None if there isn't one)
+    Returns: Pixel_To_MM. The mm axes follow the sides of the square that are
+        closest to the image x and y axes, so with the camera straight above
+        an unrotated platform it is the same as scaling by square_mm/side.
+        The perspective only comes from the square, so its errors grow with
+        the distance from it (see testing_files/pixel_to_mm_test.py)
+    """
+    transform = Pixel_To_MM(np.eye(3), 1, camera_matrix, dist_coeffs)
+    corners = transform._undistort(np.asarray(corners, dtype = np.float64).reshape(-1, 1, 2)).reshape(-1, 2)
+    # Square in mm with its first side turned to the nearest 90 degrees of the image
+    side_0 = corners[1] - corners[0]
+    side_1 = corners[2] - corners[1]
+    quarter = round(math.atan2(side_0[1], side_0[0]) / (math.pi / 2))
+    direction_0 = np.array([math.cos(quarter * math.pi / 2), math.sin(quarter * math.pi / 2)])
+    turn = 1 if side_0[0] * side_1[1] - side_0[1] * side_1[0] > 0 else -1 # Same handedness as the image
+    direction_1 = np.array([-turn * direction_0[1], turn * direction_0[0]])
+    square = square_mm * np.array([[0, 0], direction_0, direction_0 + direction_1, direction_1])
+    homography = cv.getPerspectiveTransform(corners.astype(np.float32), square.astype(np.float32))
+    # Move (0, 0) to the origin pixel
+    origin_mm = cv.perspectiveTransform(transform._undistort(np.asarray(origin, dtype = np.float64).reshape(1, 1, 2)), homography).reshape(2)
+    shift = np.array([[1, 0, -origin_mm[0]], [0, 1, -origin_mm[1]], [0, 0, 1]])
+    side = np.mean(np.linalg.norm(corners - np.roll(corners, 1, axis = 0), axis = 1))
+    return Pixel_To_MM(shift @ homography, square_mm / side, camera_matrix, dist_coeffs)
+
+def refine_contour(mask, contour, band):
+    """
+    Purpose: Move the points of a rough contour onto the edge of a full
+        resolution mask. Every point looks along its normal, up to band pixels
+        each way, for the inside/outside change closest to it
+        - mask (img): Full resolution mask (0/255)
+        - contour (array of int): Rough contour (e.g. scaled up from a smaller
+        mask), one pixel steps apart in the small mask
+        - band (int): How far (pixels) points may move
+    Returns: Contour (same format as cv.findContours) on the mask's edge.
+        Points that find no edge keep their rough position
+    """
+    points = contour.reshape(-1, 2).astype(np.float32)
+    if len(points) < 3:
+        return contour.astype(np.int32)
+    # Normal of every point from its neighbours
+    tangent = np.roll(points, -1, axis = 0) - np.roll(points, 1, axis = 0)
+    length = np.hypot(tangent[:, 0], tangent[:, 1])
+    length[length == 0] = 1
+    normal = np.column_stack((tangent[:, 1], -tangent[:, 0])) / length[:, None]
+    # Sample the mask across the band: one row of samples per point
+    offsets = np.arange(-band, band + 1, dtype = np.float32)
+    samples = points[:, None, :] + offsets[None, :, None] * normal[:, None, :]
+    xs = np.clip(np.rint(samples[..., 0]).astype(np.intp), 0, mask.shape[1] - 1)
+    ys = np.clip(np.rint(samples[..., 1]).astype(np.intp), 0, mask.shape[0] - 1)
+    inside = mask[ys, xs] > 0
+    # Closest change between neighbouring samples
+    distance = np.abs(np.arange(len(offsets) - 1) + 0.5 - band)
+    distance = np.where(inside[:, 1:] != inside[:, :-1], distance, np.inf)
+    k = np.argmin(distance, axis = 1)
+    found = np.isfinite(distance[np.arange(len(points)), k])
+    # The contour goes through the inside pixel of the change (like findContours)
+    k = np.where(inside[np.arange(len(points)), k], k, k + 1)
+    shift = np.where(found, offsets[k], 0)
+    # Specks touching the edge only move one or two points: those follow the
+    # median of their neighbours instead (a real edge changes smoothly)
+    median = np.median(np.stack([np.roll(shift, n) for n in range(-2, 3)]), axis = 0)
+    shift = np.where(np.abs(shift - median) <= 1, shift, median)
+    refined = np.rint(points + shift[:, None] * normal).astype(np.intp)
+    # Points that landed on the same pixel are dropped
+    keep = np.any(refined != np.roll(refined, 1, axis = 0), axis = 1)
+    keep[0] = True
+    return refined[keep].astype(np.int32).reshape(-1, 1, 2)
+
+def mask_contours(mask, kernel_size = 25, mask_mode = 'exact', retrieval = cv.RETR_EXTERNAL, levels = 2):
+    """
+    Purpose: Remove noise from a mask with a morphology open, then find its
+        contours
+        - mask (img): Mask (0/255) from a color filter or background subtraction
+        - kernel_size (int): Size of the square kernel (pixels at full
+        resolution). Anything thinner than this is removed
+        - mask_mode (str): 'exact' opens the full resolution mask. 'fast'
+        shrinks the mask levels times with cv.pyrDown, opens it with a kernel
+        scaled to match, finds the contours on the small mask and then moves
+        them back onto the full resolution edge (see refine_contour, band of
+        2^levels pixels). Contours are within 2^levels pixels of 'exact': the
+        difference is where the open rounds off thin points of the mask, which
+        'fast' follows more closely. Masks under FAST_MIN_PIXELS always use
+        'exact': measured 'exact'/'fast' speed-up (25 px kernel, 2 levels) was
+        0.7-0.9x at 640x480, 1.0x at 800x600, 1.2-1.5x at 1280x720 and
+        2.0-2.4x at 1920x1080
+        - retrieval (int): Contour retrieval mode for cv.findContours
+        - levels (int): Pyramid levels for 'fast' (each halves the size)
+    Returns: List of contours
+    """
+    if mask_mode not in MASK_MODES:
+        raise ValueError("mask_mode must be one of " + str(MASK_MODES))
+    if mask_mode == 'exact' or mask.size < FAST_MIN_PIXELS:
+        kernel = np.ones((kernel_size,kernel_size),np.uint8)
+        with METRICS.span('morphology'):
+            opening = cv.morphologyEx(mask, cv.MORPH_OPEN, kernel)
+        with METRICS.span('find_contours'):
+            contours, hirarchy = cv.findContours(opening, retrieval, cv.CHAIN_APPROX_SIMPLE)
+        return contours
+    scale = 2 ** levels
+    with METRICS.span('morphology'):
+        small = mask
+        for i in range(levels):
+            small = cv.pyrDown(small)
+        small = cv.threshold(small, 127, 255, cv.THRESH_BINARY)[1]
+        # Odd kernel so the open doesn't shift the mask
+        small_size = max(1, int(round(kernel_size / scale)) | 1)
+        opening = cv.morphologyEx(small, cv.MORPH_OPEN, np.ones((small_size,small_size),np.uint8))
+    with METRICS.span('find_contours'):
+        # Every point is kept: refine_contour needs them one pixel apart
+        contours, hirarchy = cv.findContours(opening, retrieval, cv.CHAIN_APPROX_NONE)
+        contours = [refine_contour(mask, cnt * scale, scale) for cnt in contours]
+    return contours
+
+class Background_Model:
+    """
+    Purpose: Model of the empty platform that is kept between scans (and saved
+        to disk) so scanning a cookie only takes a single frame. The first
+        learn_frames frames are combined with a median. After that, frames
+        that look empty slowly update the model to follow lighting changes.
+    Instance Variables:
+        self.background (img): Current estimate of the empty platform (float32)
+        self.background_u8 (img): self.background as uint8, refreshed whenever
+            the model changes (compared against every frame)
+        self.learn_frames (int): Frames used to learn the background
+        self.alpha (float): Weight of a new empty frame when updating
+        self.threshold (int): Smallest difference (0-255) that counts as
+            something placed on the platform
+        self.empty_fraction (float): Largest fraction of changed pixels for a
+            frame to still count as an empty platform
+    Methods:
+        ready(self)
+            True once the background has been learned
+        learn(self, frame)
+            Adds a frame to the initial learning. Returns True when done
+        update(self, frame)
+            Updates the background with frame if the platform is empty
+        foreground(self, frame)
+            Returns a mask (0/255) of pixels that differ from the background
+        reset(self)
+            Forgets the background so it is learned again
+        save(self, file_path) / load(self, file_path)
+            Save/load the background image. load returns True if loaded
+    """
+    def __init__(self, learn_frames = 15, alpha = 0.02, threshold = 30, empty_fraction = 0.002):
+        self.learn_frames = learn_frames
+        self.alpha = alpha
+        self.threshold = threshold
+        self.empty_fraction = empty_fraction
+        self.reset()
+
+    def reset(self):
+        self._set(None)
+        self._learning = []
+
+    def _set(self, background):
+        self.background = background
+        self.background_u8 = None if background is None else cv.convertScaleAbs(background)
+
+    def ready(self):
+        return self.background is not None
+
+    def _prepare(self, frame):
+        # Blur away camera noise so it isn't mistaken for a cookie
+        return cv.GaussianBlur(frame, (5,5), 0)
+
+    def learn(self, frame):
+        self._learning.append(self._prepare(frame))
+        if len(self._learning) < self.learn_frames:
+            return False
+        # Median of the frames ignores anything that moved through the view
+        self._set(np.median(np.stack(self._learning), axis = 0).astype(np.float32))
+        self._learning = []
+        return True
+
+    def foreground(self, frame):
+        prepared = self._prepare(frame)
+        if not self.ready() or prepared.shape != self.background.shape:
+            return np.zeros(frame.shape[:2], np.uint8)
+        diff = cv.absdiff(prepared, self.background_u8)
+        if diff.ndim == 3:
+            # Largest difference of any channel (cv.max is much faster than numpy's max over axis 2)
+            channels = cv.split(diff)
+            diff = channels[0]
+            for channel in channels[1:]:
+                diff = cv.max(diff, channel)
+        return np.where(diff > self.threshold, 255, 0).astype(np.uint8)
+
+    def update(self, frame):
+        if not self.ready():
+            return False
+        if np.count_nonzero(self.foreground(frame)) > self.empty_fraction * frame.shape[0] * frame.shape[1]:
+            return False # Something is on the platform: don't learn it
+        cv.accumulateWeighted(self._prepare(frame).astype(np.float32), self.background, self.alpha)
+        self._set(self.background)
+        return True
+
+    def save(self, file_path = BACKGROUND_FILE):
+        if self.ready():
+            os.makedirs(os.path.dirname(file_path), exist_ok = True)
+            cv.imwrite(file_path, self.background_u8)
+
+    def load(self, file_path = BACKGROUND_FILE):
+        if not os.path.isfile(file_path):
+            return False
+        image = cv.imread(file_path)
+        if image is None:
+            return False
+        self._set(image.astype(np.float32))
+        return True
 
 class Cookie_Vision:
     """
@@ -22,22 +439,98 @@ class Cookie_Vision:
                 equivalent on each side). Used in other methods.
             self.box_platform (list of int): Locations of platform verticies
             self.contours (db list of x,y coord.): Coordinates of contours of cookie
+            self.contour_list (list): Contours of every cookie (batch mode)
+            self.Xt_mm (array of x,y coord.): Simplified outline of the cookie in mm
+            self.arcs (array of [direction, i, j]): Arc moves of self.Xt_mm
+            self.points_removed (int): Points dropped from the last outline
+            self.Xt_mm_list (list): Outline in mm of every cookie (batch mode)
+            self.arcs_list (list): Arc moves of every outline in self.Xt_mm_list
+            self.square_rect (tuple): minAreaRect of the red square found by
+                the last calibration ((cx, cy), (w, h), angle)
+            self.pixel_to_mm (Pixel_To_MM): Pixels -> platform mm transform of
+                the last calibration (None until calibrated)
+            self.camera_matrix, self.dist_coeffs (array of flt): Lens
+                calibration from cv.calibrateCamera used by the next
+                calibrate (None: the lens isn't corrected)
+            self.background (Background_Model): Model of the empty platform
+            self.camera_index (int): Camera the calibration was done with
+            self.resolution (list of int): [width, height] of the calibrated
+                camera frames
+            self.display (obj): Shows frames and reads keys (imshow/waitKey).
+                cv by default, capture_classes.Scripted_Display to run from a
+                key script and/or without a display
+            self.scan_time (float): Seconds the last cookie scan took
+            self.mask_mode (str): How masks are cleaned up when a call doesn't
+                say: 'exact' or 'fast' (see mask_contours)
+            self.background_file (str): The empty platform is saved here, next
+                to the calibration file last saved or loaded (BACKGROUND_FILE
+                until then)
         Methods:
-            calibrate(self, frame_test, key, im_show = True)
+            calibrate(self, frame_test, im_show = True, mask_mode = None)
                 Takes webcam feed, records where the printable area verticies lay.
-                Verticies are stored in self.box_platform
+                Verticies are stored in self.box_platform and the pixel to mm
+                transform (from the corners of the red square) in
+                self.pixel_to_mm
                 - frame_test (img): Image to be calibrated
                 - im_show (bool): Shows image in seperate window to verify the
                     calibration worked
-            find_cookie(self, camera_feed, display_name)
+                - mask_mode (str): 'exact' or 'fast' (None uses self.mask_mode)
+            save_calibration(self, file_path = CALIBRATION_FILE)
+                Saves box_platform, l_avg, the red square (position, size and
+                rotation), the pixel to mm transform, camera index and
+                resolution to a small JSON file
+            load_calibration(self, file_path = CALIBRATION_FILE)
+                Loads a saved calibration. Returns True if one was loaded.
+                Files saved before the transform was added get one from the
+                red square
+            track_square(self, frame, pad = 0.5, scale = 1.0)
+                Real-time tracking of the red square. After the first full frame
+                search, only a region padded by pad (fraction of the square
+                size) around the last square is searched, optionally after
+                shrinking it by scale. Falls back to a full frame search when
+                the square is lost. Returns the minAreaRect of the square (in
+                full frame pixels) or None, and updates self.box_platform,
+                self.l_avg and self.pixel_to_mm while tracking
+                - frame (img): Camera frame
+                - pad (float): ROI padding as a fraction of the square size
+                - scale (float): Scale the search image by this (< 1 is faster)
+            check_calibration(self, frames, max_drift = 5)
+                Cheap check that a loaded calibration still matches the camera.
+                Only looks for the red square in a padded region around where it
+                was calibrated, on each of the frames given (the first few
+                frames from the camera). Returns False if the square moved or
+                changed size by more than max_drift pixels, or is missing, so
+                the platform needs to be calibrated again
+                - frames (list of img): Frames to check
+                - max_drift (float): Largest allowed movement (pixels)
+            clear_calibration(self)
+                Forgets the platform calibration and the learned empty platform
+                (e.g. a loaded calibration that failed check_calibration), so
+                nothing is scanned or printed with it. The lens calibration is
+                kept
+            find_cookie(self, camera_feed, display_name, multiple = False, mask_mode = None)
                 Find cookie on platform by using background subtraction. Please
                 note that this method only works by making sure lighting and
                 platform stays still when placing the cookie on the platform.
                 Will operate by itself and operate within this function until
-                prompted to exit.
+                prompted to exit. The background (self.background) is only
+                learned if there isn't one yet, is kept up to date while the
+                platform is empty, and is saved next to the calibration. 'r'
+                relearns it.
                 - camera_feed (obj): Uses current camera feed to use for learning
                 - display_name (str): Name of the window the software will display
                 to
+                - multiple (bool): Find every cookie on the platform (batch
+                mode). All of them are saved in self.contour_list
+                - mask_mode (str): Passed on to scan_cookie/scan_cookies
+            scan_cookie(self, frame, mask_mode = None)
+                Finds the cookie in a single frame using self.background.
+                Returns the contour of the cookie or None. mask_mode is 'exact'
+                or 'fast' (None uses self.mask_mode)
+            scan_cookies(self, frame, min_area = 300, max_area = 15000, mask_mode = None)
+                Finds every cookie-sized object in a single frame. Areas are in
+                mm^2 (pixels^2 if the platform isn't calibrated). Returns a list
+                of contours, biggest first
             set_threshold(self, threshold_value, max_binary_value, threshold_type)
                 Sets the threshold variables for use in the class. Displays a
                 GUI to configure the webcam specs. If 's' is pressed, then the
@@ -49,24 +542,44 @@ class Cookie_Vision:
                 the image will be displayed in a window along with the contours
                 drawn out. Returns the list of contours found
             -------------------------------WIP----------------------------------
-            gen_g_code_outline(self)
+            gen_g_code_outline(self, tolerance = 0.1, arc_tolerance = None)
                 Takes known contours and generates g_code to frost the outside
                 of the cookie. Robot needs to be calibrated and cookie needs to
                 be scanned before running this method. Will print "Error: Robot
                 needs to be calibrated and cookie needs to be scanned" and return
                 0 if self.box_platform or self.contours is empty
+                - tolerance (float): Largest distance (mm) the outline may move
+                    when dropping points (see path_classes.simplify_path). 0
+                    keeps every contour point. The number of points dropped is
+                    stored in self.points_removed
+                - arc_tolerance (float): Largest distance (mm) G02/G03 arcs
+                    may be from the outline (see path_classes.fit_arcs). None
+                    uses one camera pixel, since the contour is only accurate
+                    to a pixel. 0 turns arc fitting off. The arcs are stored in
+                    self.arcs (None if arc fitting is off)
+            gen_g_code_outlines(self, tolerance = 0.1, arc_tolerance = None)
+                Same as gen_g_code_outline for every contour in
+                self.contour_list. Results go in self.Xt_mm_list and
+                self.arcs_list
+            outline_to_mm(self, contour, tolerance = 0.1, arc_tolerance = None)
+                Converts one contour to a simplified outline in mm with
+                self.pixel_to_mm. Returns (outline, arcs, points removed)
+            draw_strokes(self, frame, strokes, color)
+                Draws strokes (in mm, e.g. a design preview) onto a camera frame
 
 
-            check_bounds(self)
-                Finds if cookie contours is within bounds of printable area.
-                Looks at self.box_platform and self.contours to determine wether
-                the cookie is within the printable area when the platform calibrated.
-                Returns True if the cookie is within bounds and False if cookie is
-                outside of the bounds. WIP as its not necessary for functionality,
-                but it would be nice as a double check
+            platform_mm(self)
+                Returns the corners of the printable platform in mm (same
+                coordinates as self.Xt_mm and the g-code), or None if the
+                platform isn't calibrated
+            check_bounds(self, tolerance = 0.5)
+                Finds if the cookie outline (self.Xt_mm) is within the printable
+                area. Returns True if the cookie is within bounds (give or take
+                tolerance mm) and False if it is outside of the bounds. Whole
+                jobs are checked by sim_classes.Job_Simulator
 
     """
-    def __init__(self, file_name = ""):
+    def __init__(self, file_name = "", camera_index = 0, display = cv, mask_mode = 'exact'):
         # self.file_name = file_name
         # self.threshold_value = 230
         # self.threshold_type = 1
@@ -76,47 +589,64 @@ class Cookie_Vision:
         self.l_avg = 0
         self.box_platform = []
         self.contours = []
+        self.contour_list = []
         self.Xt_mm = []
+        self.Xt_mm_list = []
+        self.arcs_list = []
+        self.points_removed = 0
+        self.arcs = None
+        self.square_rect = None
+        self.pixel_to_mm = None
+        self.camera_matrix = None
+        self.dist_coeffs = None
+        self.camera_index = camera_index
+        self.resolution = []
+        self.track_rect = None # Last square found by track_square
+        self.track_stats = {'roi': 0, 'full': 0, 'lost': 0}
+        self.background = Background_Model()
+        self.display = display
+        self.scan_time = 0
+        self.mask_mode = mask_mode
+        self.background_file = BACKGROUND_FILE
 
-    def calibrate(self, frame_test, im_show = True):
-        # Convert image from BGR to HSV (easier to detect color ranges)
-        hsv = cv.cvtColor(frame_test, cv.COLOR_BGR2HSV)
+    def calibrate(self, frame_test, im_show = True, mask_mode = None):
+        with METRICS.span('hsv'):
+            # Convert image from BGR to HSV (easier to detect color ranges)
+            hsv = cv.cvtColor(frame_test, cv.COLOR_BGR2HSV)
 
-        # Define the upper and lower threshold of the filter (H-0-180)
-        red_lower = np.array([0,150,50])
-        red_upper = np.array([180,255,255])
+            # Define the upper and lower threshold of the filter (H-0-180)
+            red_lower = np.array([0,150,50])
+            red_upper = np.array([180,255,255])
 
-        # Apply mask with the upper and lower bounds
-        mask = cv.inRange(hsv, red_lower, red_upper)
+            # Apply mask with the upper and lower bounds
+            mask = cv.inRange(hsv, red_lower, red_upper)
+            # Red minus green changes linearly across the square's edges (finds the corners to a fraction of a pixel)
+            red = cv.subtract(frame_test[:, :, 2], frame_test[:, :, 1])
 
-        # Remove noise by eroding and dilating image
-        kernel = np.ones((25,25),np.uint8)
-        opening = cv.morphologyEx(mask, cv.MORPH_OPEN, kernel)
-
-        # Find and draw contours on binary image
-        contours, hirarchy = cv.findContours(opening, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+        # Remove noise by eroding and dilating image, then find contours
+        contours = mask_contours(mask, 25, mask_mode or self.mask_mode, cv.RETR_TREE)
         # print(contours)
         # cv.drawContours(frame_test, contours, -1, (0,255,0), 3)
         # If there are contours, draw contours
-        if contours != ():
+        if len(contours) > 0:
             bounding_rect = cv.minAreaRect(contours[0])
+            self.square_rect = bounding_rect
+            self.resolution = [frame_test.shape[1], frame_test.shape[0]]
             # print(bounding_rect)
             box = cv.boxPoints(bounding_rect)
-            print(box)
-            box = np.int0(box) # Convert box into integer values
+            log.debug("Red square corners: %s", box)
+            box = np.intp(box) # Convert box into integer values
             # print(box)
             cv.drawContours(frame_test, [box],0,(0,0,255),2)
 
             # Take the calibration square and scale-up to printable area
-            rsq_l = np.int0(bounding_rect[1]) # Red Square length
-            self.l_avg = int((rsq_l[0] + rsq_l[1])/2) # Average length of square
-            l_platform = int(8.8 * self.l_avg)
-            w_platform = int(7.3 * self.l_avg)
+            self.l_avg, self.box_platform = platform_from_square(bounding_rect)
+            # The sides are fit on the mask before the noise removal rounded the corners off
+            raw_contours, hirarchy = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+            inside = [cnt for cnt in raw_contours if cv.pointPolygonTest(cnt, bounding_rect[0], False) >= 0]
+            corners = square_corners(max(inside, key = cv.contourArea) if inside else contours[0], bounding_rect, red)
+            self.pixel_to_mm = square_transform(corners, self.box_platform[0], SQUARE_MM, self.camera_matrix, self.dist_coeffs)
             # Draw this on the frame_test
-            bounding_platform = (bounding_rect[0], (w_platform, l_platform), bounding_rect[2])
-            box_platform = cv.boxPoints(bounding_platform)
-            self.box_platform = np.int0(box_platform)
-
             cv.drawContours(frame_test, [self.box_platform],0,(0,255,0),2)
 
 
@@ -124,148 +654,298 @@ class Cookie_Vision:
         # Display the resulting frame
         if im_show == True:
             cv.putText(frame_test, 'Correct? (y/n)', (10,450), cv.FONT_HERSHEY_SIMPLEX, 1,(255,255,255),2,cv.LINE_AA)
-            cv.imshow('Calibration', frame_test)
+            self.display.imshow('Calibration', frame_test)
 
 
             # cv.imshow('mask',mask) # Mask display
             # cv.imshow('opening',opening) # Dialation display
 
-    def find_cookie(self, camera_feed, display_name = "test"):
-        # KNN Subtractor (other is MOG2: it was found KNN works best)
-        backSub = cv.createBackgroundSubtractorKNN()
+    def save_calibration(self, file_path = CALIBRATION_FILE):
+        if self.square_rect is None:
+            print("Platform needs to be calibrated before saving calibration")
+            return
+        (cx, cy), (w, h), angle = self.square_rect
+        calibration = {
+            'saved': time.ctime(),
+            'box_platform': np.asarray(self.box_platform).tolist(),
+            'l_avg': self.l_avg,
+            'square_rect': [[float(cx), float(cy)], [float(w), float(h)], float(angle)],
+            'pixel_to_mm': self.pixel_to_mm.to_dict(),
+            'camera_index': self.camera_index,
+            'resolution': self.resolution,
+        }
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok = True)
+            with open(file_path, 'w') as f:
+                json.dump(calibration, f, indent = 4)
+            print("Calibration saved to " + file_path)
+            self.background_file = os.path.join(os.path.dirname(file_path), 'background.png')
+        except Exception as e:
+            print(e)
+            print("Error occured while saving calibration")
+
+    def load_calibration(self, file_path = CALIBRATION_FILE):
+        if not os.path.isfile(file_path):
+            return False
+        try:
+            with open(file_path, 'r') as f:
+                calibration = json.load(f)
+            self.box_platform = np.array(calibration['box_platform'], dtype = np.intp)
+            self.l_avg = calibration['l_avg']
+            center, size, angle = calibration['square_rect']
+            self.square_rect = (tuple(center), tuple(size), angle)
+            if 'pixel_to_mm' in calibration:
+                self.pixel_to_mm = Pixel_To_MM(**calibration['pixel_to_mm'])
+                self.camera_matrix = self.pixel_to_mm.camera_matrix
+                self.dist_coeffs = self.pixel_to_mm.dist_coeffs
+            else:
+                self.pixel_to_mm = square_transform(cv.boxPoints(self.square_rect), self.box_platform[0])
+            self.camera_index = calibration['camera_index']
+            self.resolution = calibration['resolution']
+            print("Loaded calibration from " + calibration['saved'])
+            # The empty platform is saved next to the calibration
+            self.background_file = os.path.join(os.path.dirname(file_path), 'background.png')
+            if self.background.load(self.background_file):
+                print("Loaded background from " + self.background_file)
+            return True
+        except Exception as e:
+            print(e)
+            print("Error occured while loading calibration")
+            return False
+
+    def track_square(self, frame, pad = 0.5, scale = 1.0):
+        rect = None
+        if self.track_rect is not None:
+            # Only search a padded region around the last square
+            (cx, cy), (w, h), angle = self.track_rect
+            reach = max(w, h) * (0.5 + pad)
+            x0, y0 = max(int(cx - reach), 0), max(int(cy - reach), 0)
+            x1, y1 = int(cx + reach) + 1, int(cy + reach) + 1
+            rect = self._search_square(frame[y0:y1, x0:x1], scale, (x0, y0))
+            if rect is not None:
+                self.track_stats['roi'] += 1
+        if rect is None:
+            # Tracking lost (or never started): search the whole frame
+            rect = self._search_square(frame, scale, (0, 0))
+            self.track_stats['full'] += 1
+        if rect is None:
+            self.track_stats['lost'] += 1
+        else:
+            self.l_avg, self.box_platform = platform_from_square(rect)
+            self.pixel_to_mm = square_transform(cv.boxPoints(rect), self.box_platform[0], SQUARE_MM, self.camera_matrix, self.dist_coeffs)
+        self.track_rect = rect
+        return rect
+
+    def _search_square(self, image, scale, offset):
+        if image.size == 0:
+            return None
+        kernel_size = 25
+        if scale != 1.0:
+            image = cv.resize(image, None, fx = scale, fy = scale, interpolation = cv.INTER_AREA)
+            kernel_size = max(3, int(round(25 * scale)))
+        rect = find_red_square(image, kernel_size)
+        if rect is None:
+            return None
+        (cx, cy), (w, h), angle = rect
+        return ((cx / scale + offset[0], cy / scale + offset[1]), (w / scale, h / scale), angle)
+
+    def check_calibration(self, frames, max_drift = 5):
+        if self.square_rect is None:
+            return False
+        (cx, cy), (w, h), angle = self.square_rect
+        # Region of interest: the square's bounding box padded by half a square
+        x0, y0, box_w, box_h = cv.boundingRect(cv.boxPoints(self.square_rect).astype(np.float32))
+        pad = int(max(w, h) / 2) + max_drift
+        for frame in frames:
+            if frame is None or [frame.shape[1], frame.shape[0]] != list(self.resolution):
+                print("Calibration check: camera resolution changed")
+                return False
+            x1, y1 = max(x0 - pad, 0), max(y0 - pad, 0)
+            roi = frame[y1:y0 + box_h + pad, x1:x0 + box_w + pad]
+            rect = find_red_square(roi)
+            if rect is None:
+                print("Calibration check: red square not found")
+                return False
+            (rx, ry), (rw, rh), r_angle = rect
+            drift = math.hypot(rx + x1 - cx, ry + y1 - cy)
+            size_change = abs((rw + rh) / 2 - self.l_avg)
+            if drift > max_drift or size_change > max_drift:
+                print("Calibration check: square moved %.1f px, size changed %.1f px" % (drift, size_change))
+                return False
+        return True
+
+    def clear_calibration(self):
+        self.l_avg = 0
+        self.box_platform = []
+        self.square_rect = None
+        self.pixel_to_mm = None # The lens calibration (camera_matrix, dist_coeffs) is kept
+        self.resolution = []
+        self.track_rect = None
+        self.background.reset()
 
+    def find_cookie(self, camera_feed, display_name = "test", multiple = False, mask_mode = None):
         capture = camera_feed
         # Check if camera was opened
         if not capture.isOpened():
             print("Error opening camera: couldn't be opened")
             exit()
 
-        frameNumSinceTest = 1 # Capturing the frame number since the testing began
         font = cv.FONT_HERSHEY_SIMPLEX # Font type
         wait_for_respose = False
         # Main loop
         while True:
-            key_press = cv.waitKey(1) # Detect any keys that were pressed
+            key_press = self.display.waitKey(1) # Detect any keys that were pressed
             ret, frame = capture.read() # read the camera
             # Check to see if the frame was read correctly
             if frame is None:
                 print("Error reading frame: quitting")
                 break
 
-            cv.rectangle(frame, (10,2), (225,20), (255,255,255), -1)
-            # Use the first 100 frames as masking "learning" data
-            # print(frameNumSinceTest)
-            if frameNumSinceTest < 100:
-                fgMask = backSub.apply(frame) # Apply masking to video feed using first frame
-                cv.putText(frame,'Learning: Please Wait',(15,15), font, 0.5, (0,0,0))
-                cv.rectangle(frame, (575,2), (625, 20), (255,255,255), -1)
-                cv.putText(frame, str(frameNumSinceTest), (595,15), font, 0.5, (0,0,0))
-                frameNumSinceTest += 1
+            display = frame.copy()
+            cv.rectangle(display, (10,2), (225,20), (255,255,255), -1)
+            # Only learn the empty platform if there is no background saved
+            if not self.background.ready():
+                cv.putText(display,'Learning: Please Wait',(15,15), font, 0.5, (0,0,0))
+                cv.rectangle(display, (575,2), (625, 20), (255,255,255), -1)
+                cv.putText(display, str(len(self.background._learning) + 1), (595,15), font, 0.5, (0,0,0))
+                if self.background.learn(frame):
+                    self.background.save(self.background_file)
             elif wait_for_respose == False:
-                # print("Done Testing")
-                cv.putText(frame,'Place Cookie on Platform',(15,15), font, 0.5, (0,0,0))
+                # Keep the background up to date while the platform is empty
+                self.background.update(frame)
+                cv.putText(display,'Place Cookie on Platform',(15,15), font, 0.5, (0,0,0))
                 # Instruction on bottom left hand corner
-                cv.rectangle(frame, (10,435), (225,455), (255,255,255), -1)
-                cv.putText(frame, 's=Scan, q=Quit', (15,450), font, 0.5, (0,0,0))
-
-            # Record after the cookie is placed
-            if key_press == ord('s'):
-                # Back substitution
-                fgMask = backSub.apply(frame)
-                # Remove noise by eroding and dilating image
-                kernel = np.ones((25,25),np.uint8)
-                opening = cv.morphologyEx(fgMask, cv.MORPH_OPEN, kernel)
-                # cv.imshow("test", opening)
-                # Find and draw contours on binary image
-                contours, hirarchy = cv.findContours(opening, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-                if contours != ():
-                    cnt = contours[0]
-                    print(cnt)
+                cv.rectangle(display, (10,435), (225,455), (255,255,255), -1)
+                cv.putText(display, 's=Scan, r=Relearn, q=Quit', (15,450), font, 0.5, (0,0,0))
+
+            # Record after the cookie is placed (one frame is enough)
+            if key_press == ord('s') and self.background.ready():
+                scan_start = time.time()
+                if multiple:
+                    cnts = self.scan_cookies(frame, mask_mode = mask_mode)
+                    print("Found %d cookies" % len(cnts))
                 else:
+                    cnt = self.scan_cookie(frame, mask_mode)
+                    cnts = [] if cnt is None else [cnt]
+                self.scan_time = time.time() - scan_start
+                if len(cnts) == 0:
                     print("No Contours Found")
                 wait_for_respose = True
+            elif key_press == ord('r'):
+                print("Relearning background: make sure the platform is empty")
+                self.background.reset()
+                wait_for_respose = False
 
             # If the user recorded the cookie, display the threshold for user to verify
             # if the cookie shape looks correct
             if wait_for_respose == True:
-                if contours != ():
-                    cv.drawContours(frame, [cnt], 0, (0,255,0), 3)
+                cv.drawContours(display, cnts, -1, (0,255,0), 3)
 
-                cv.putText(frame,'Correct? (Y/N)',(15,15), font, 0.5, (0,0,0))
-                # cv.rectangle(frame, (10,2), (225,20), (255,255,255), -1)
-                cv.imshow(display_name, frame)
+                cv.putText(display,'Correct? (Y/N)',(15,15), font, 0.5, (0,0,0))
+                self.display.imshow(display_name, display)
 
                 if key_press == ord('y'):
                     print("Saving Contours")
-                    if contours != ():
-                        self.contours = cnt
+                    if len(cnts) > 0:
+                        self.contours = cnts[0]
+                        self.contour_list = cnts
                     else:
                         print("No Contours Found: Exiting Cookie Scanner & Homing")
-                    """
-                    INSERT NEW CODE HERE TO SAVE CONTOURS
-                    """
-
                     break
                 elif key_press == ord('n'):
-                    wait_for_respose = False
-                    frameNumSinceTest = 1 # Set the number of frames to 1 so model can relearn
+                    wait_for_respose = False # Background is kept: just scan again
             else:
-                cv.imshow(display_name, frame)
+                self.display.imshow(display_name, display)
 
             if key_press == ord('q'):
                 print("'q' was pressed: quitting")
                 break
 
-    def gen_g_code_outline(self):
-        if self.box_platform != () and self.contours != ():
-            # Given self attributes, convert everything into mm and transform contours into g-code
-            # Find top left corner of printable platform
-            origin_translation = [self.box_platform[0]]
-            # Reshape contours list from 3D to 2D
-            contours_reshaped = np.reshape(self.contours, (len(self.contours), 2))
-            # Make matrix of linear transformation & use to set origin (subtract transformation)
-            lin_trans_matrix = np.tile(origin_translation, (len(contours_reshaped), 1)) # Makes matrix same dimensions as contours
-            # Subtract the translation
-            Xt = np.subtract(contours_reshaped, lin_trans_matrix)
-            # Find scalar to convert from pixels to mm
-            scalar = 15/self.l_avg # 15 mm / l_avg [=] mm/pixel
-            # Apply scalar to matrix to convert to mm & store in self.Xt_mm
-            self.Xt_mm = scalar * Xt
-        elif self.box_platform == () and self.contours == ():
+    def scan_cookie(self, frame, mask_mode = None):
+        # Back substitution against the saved empty platform
+        with METRICS.span('background'):
+            fgMask = self.background.foreground(frame)
+        # Remove noise by eroding and dilating image, find contours & keep the biggest one
+        contours = mask_contours(fgMask, 25, mask_mode or self.mask_mode)
+        if len(contours) == 0:
+            return None
+        return max(contours, key = cv.contourArea)
+
+    def scan_cookies(self, frame, min_area = 300, max_area = 15000, mask_mode = None):
+        with METRICS.span('background'):
+            fgMask = self.background.foreground(frame)
+        # Only outer contours: holes and decorations inside a cookie don't count
+        contours = mask_contours(fgMask, 25, mask_mode or self.mask_mode)
+        area_scale = self.pixel_to_mm.scale**2 if self.pixel_to_mm is not None else 1 # mm^2 per pixel
+        cookies = [cnt for cnt in contours if min_area <= cv.contourArea(cnt) * area_scale <= max_area]
+        return sorted(cookies, key = cv.contourArea, reverse = True)
+
+    def gen_g_code_outline(self, tolerance = 0.1, arc_tolerance = None):
+        if len(self.box_platform) > 0 and len(self.contours) > 0:
+            with METRICS.span('outline'):
+                self.Xt_mm, self.arcs, self.points_removed = self.outline_to_mm(self.contours, tolerance, arc_tolerance)
+        elif len(self.box_platform) == 0 and len(self.contours) == 0:
             print("Platform needs calibration and cookie needs to be scanned")
-        elif self.contours == ():
+        elif len(self.contours) == 0:
             print("Cookie needs to be scanned before generating g-code")
         else:
             print("Platform needs to be calibrated before generating g-code")
 
-"""
-    def check_bounds(self):
-        cnt = self.contours
-        ret = False
-
-        # Find the extreme points on the cookie shape
-        # Code adapted from https://docs.opencv.org/4.x/d1/d32/tutorial_py_contour_properties.html
-        extreme_points[0] = tuple(cnt[cnt[:,:,0].argmin()][0]) # Leftmost
-        extreme_points[1] = tuple(cnt[cnt[:,:,0].argmax()][0]) # Rightmost
-        extreme_points[2] = tuple(cnt[cnt[:,:,1].argmin()][0]) # Topmost
-        extreme_points[3] = tuple(cnt[cnt[:,:,1].argmax()][0]) # Bottommost
-        # Find extreme points of rectangle
-        extreme_points_box[0] = tuple(self.box_platform[self.box_platform[:,:,0].argmin()][0]) # Leftmost
-        extreme_points_box[1] = tuple(self.box_platform[self.box_platform[:,:,0].argmax()][0]) # Rightmost
-        extreme_points_box[2] = tuple(self.box_platform[self.box_platform[:,:,1].argmin()][0]) # Topmost
-        extreme_points_box[3] = tuple(self.box_platform[self.box_platform[:,:,1].argmax()][0]) # Bottommost
-        # Put all relevant points into different list
-        extreme_x_y[0] = extreme_points[0][0]
-        extreme_x_y[1] = extreme_points[1][0]
-        extreme_x_y[2] = extreme_points[2][1]
-        extreme_x_y[3] = extreme_points[3][1]
-        # Repeat for rectangle
-        extreme_x_y_box[0]
-
-        # Find if the mins and maxes are within bounding rectangle
-        # x dimenstions
-        for i in self.box_platform:
-            if
-        # Find if the cookie is within min and max bounds
-        # x-coordinates
-"""
+    def gen_g_code_outlines(self, tolerance = 0.1, arc_tolerance = None):
+        if len(self.box_platform) > 0 and len(self.contour_list) > 0:
+            self.Xt_mm_list = []
+            self.arcs_list = []
+            for contour in self.contour_list:
+                Xt_mm, arcs, removed = self.outline_to_mm(contour, tolerance, arc_tolerance)
+                self.Xt_mm_list.append(Xt_mm)
+                self.arcs_list.append(arcs)
+            print("Outlines generated for %d cookies" % len(self.Xt_mm_list))
+        elif len(self.contour_list) == 0:
+            print("Cookies need to be scanned before generating g-code")
+        else:
+            print("Platform needs to be calibrated before generating g-code")
+
+    def draw_strokes(self, frame, strokes, color = (255,0,255)):
+        if self.pixel_to_mm is None:
+            return
+        # Undo outline_to_mm: mm -> camera pixels
+        for stroke in strokes:
+            pixels = self.pixel_to_mm.to_pixels(stroke)
+            cv.polylines(frame, [np.intp(np.round(pixels))], False, color, 1)
+
+    def outline_to_mm(self, contour, tolerance = 0.1, arc_tolerance = None):
+        # Given self attributes, convert everything into mm and transform contours into g-code
+        # Only the contour points go through the calibrated transform (lens,
+        # platform rotation and perspective), the frame itself is never warped
+        Xt_mm = self.pixel_to_mm.to_mm(contour)
+        scalar = self.pixel_to_mm.scale # mm/pixel
+        if arc_tolerance is None:
+            arc_tolerance = max(tolerance, scalar) # One pixel in mm
+        if arc_tolerance > 0:
+            # Turn round parts of the outline into arcs, simplify the rest
+            outline, arcs = fit_arcs(Xt_mm, arc_tolerance, tolerance)
+            log.debug("Outline arcs: %d", np.count_nonzero(arcs[:, 0]))
+        else:
+            # Drop points that don't change the outline by more than tolerance
+            outline = simplify_path(Xt_mm, tolerance, closed = True)
+            arcs = None
+        removed = len(Xt_mm) - len(outline)
+        log.info("Outline simplified: removed %d of %d points", removed, len(Xt_mm))
+        return outline, arcs, removed
+
+    def platform_mm(self):
+        # Corners of the printable platform in the same mm coordinates as Xt_mm
+        if self.pixel_to_mm is None:
+            return None
+        return self.pixel_to_mm.to_mm(self.box_platform)
+
+    def check_bounds(self, tolerance = 0.5):
+        platform = self.platform_mm()
+        if platform is None or len(self.Xt_mm) == 0:
+            print("Platform needs calibration and the outline needs to be generated")
+            return False
+        platform = platform.astype(np.float32).reshape(-1, 1, 2)
+        for x, y in np.asarray(self.Xt_mm, dtype = float).reshape(-1, 2):
+            if cv.pointPolygonTest(platform, (float(x), float(y)), True) < -tolerance:
+                return False
+        return True
@@ -0,0 +1,52 @@
+# Created on 10/18/26
+"""
+Purpose: Run several cookie robots from one computer. Every robot has its own
+serial port and camera: python fleet_main.py COM4:0 COM5:1 ...
+Orders are typed in while the robots run, one per line:
+- full: Frost the whole cookie
+- outline: Only frost the outline
+- <design file>: Frost an image from the designs folder
+- s: Show what every robot is doing
+- q: Wait for the queued orders, home every robot and quit
+Each robot frosts the next cookie put on its platform once it takes an order.
+"""
+import sys
+import asyncio
+import logging
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.fleet_classes as f
+
+async def main(pairs):
+    stations = []
+    for i, pair in enumerate(pairs):
+        port, camera = pair.split(':', 1)
+        stations.append(f.Robot_Station('robot_%d' % (i + 1), port, camera))
+    fleet = f.Fleet(stations)
+    await fleet.start()
+    print("Type full, outline or a design file to queue a cookie (s=Status q=Quit)")
+    while True:
+        command = (await asyncio.to_thread(input, '> ')).strip()
+        if command == 'q':
+            break
+        elif command == 's':
+            for station in fleet.status():
+                print("%s: %s, %d cookies (%s)" % (station['name'], station['state'], station['cookies'], station['order'] or 'no order'))
+            print("%d orders waiting" % fleet.orders.qsize())
+        elif command:
+            order = fleet.submit(None if command == 'full' else command)
+            print("Queued " + order.name)
+    print("Finishing the queued orders...")
+    await fleet.join()
+    await fleet.stop()
+
+# Main code (one event loop for every robot)
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO, format = '%(message)s')
+    if len(sys.argv) < 2:
+        print("Usage: python fleet_main.py <port>:<camera index or recording> ...")
+        sys.exit(1)
+    try:
+        asyncio.run(main(sys.argv[1:]))
+    except Exception as e:
+        print(e)
+        print("Error occured while trying to run the fleet")
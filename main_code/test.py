@@ -4,6 +4,7 @@ sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_B
 import cv2 as cv
 import classes.g_code_classes as g
 import classes.vision_classes as v
+import classes.capture_classes as c
 
 # Main code (opening serial port until user is done)
 try:
@@ -24,6 +25,8 @@ try:
         print("Cannot open camera")
         ser.close()
         exit()
+    # Read the camera on its own thread: the loop always gets the newest frame
+    capture = c.Frame_Grabber(capture).start()
 
     while True:
         # Capture frame by frame of camera feed
@@ -0,0 +1,131 @@
+"""
+abort_test.py
+GOAL: Check that an abort stops every job that was waiting when it came, also
+jobs that were already taken off a queue but hadn't started streaming yet, and
+that jobs queued after the abort still run. A reset during a move locks grbl
+in an alarm: the worker has to unlock it, and jobs grbl rejects lines of have
+to fail
+MODULES USED:
+- numpy as np
+- serial
+CLASSES:
+stream_classes.Grbl_Streamer: soft_reset while a second job waits for grbl
+job_classes.Robot_Worker: abort while the worker starts a job
+fake_grbl.Fake_Grbl: grbl on a pty
+TEST CASES:
+- Streamer: a job is streaming and a second one is waiting for grbl when grbl
+  is soft reset. Both have to fail with Job_Aborted. grbl has to be locked in
+  an alarm, and a job streamed after the reset has to finish once '$X'
+  unlocked it
+- Worker: abort() right after the worker took a job off its queue (its
+  start_stream is still running). The job must not stream, a job submitted
+  after the abort has to finish
+- Worker: abort() during a move. The job submitted after it has to finish
+  without errors (the worker unlocks grbl) and move the machine
+- Worker: a job grbl answers with 'error' has to fail with Job_Failed
+USAGE:
+python abort_test.py [number of points]
+"""
+# Import modules
+import sys
+import time
+import threading
+from concurrent.futures import CancelledError
+import numpy as np
+import serial
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.g_code_classes as g
+import classes.stream_classes as st
+import classes.job_classes as j
+from fake_grbl import Fake_Grbl
+
+def outcome(job):
+    # 'done', 'aborted', 'cancelled' or the error
+    try:
+        job.result(timeout = 10)
+        return 'done'
+    except st.Job_Aborted:
+        return 'aborted'
+    except j.Job_Failed:
+        return 'failed'
+    except CancelledError:
+        return 'cancelled'
+    except Exception as e:
+        return str(e)
+
+def check(name, result, expected):
+    ok = result in expected
+    print("%-34s %-10s (%s)" % (name, result, 'ok' if ok else 'FAIL'))
+    return ok
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+theta = np.linspace(0, 2 * np.pi, n)
+circle = np.column_stack((50 + 30 * np.cos(theta), 50 + 30 * np.sin(theta)))
+failures = 0
+
+fake = Fake_Grbl(speedup = 5)
+fake.start()
+ser = serial.Serial(fake.port, 115200, timeout = 0.1)
+robot = g.GCode_EX(ser)
+robot.streamer.wake_delay = 0.1
+
+print("---------Streamer---------")
+running = robot.streamer.stream(robot.iter_gcode(circle))
+waiting = robot.streamer.stream(robot.iter_gcode(circle)) # Waits for the first job to give up grbl
+while running.acked < 10:
+    time.sleep(0.005)
+robot.streamer.soft_reset()
+failures += not check("Running job", outcome(running), ('aborted',))
+failures += not check("Job waiting for grbl", outcome(waiting), ('aborted',))
+time.sleep(0.2) # The reset is behind the lines already on their way to grbl
+failures += not check("grbl locked after the reset", 'alarm' if fake.alarm else 'unlocked', ('alarm',))
+after = robot.streamer.stream(['$X', 'G90', 'G00 X1 Y1'])
+failures += not check("Job after the reset", outcome(after), ('done',))
+failures += not check("Lines rejected after the reset", len(after.errors), (0,))
+
+print("---------Worker---------")
+worker = j.Robot_Worker(robot).start()
+taken = threading.Event()
+release = threading.Event()
+def slow_start(robot):
+    # The worker has taken the job off its queue: abort before it streams
+    taken.set()
+    release.wait(5)
+    return robot.streamer.stream(robot.iter_gcode(circle))
+first = worker.submit('Slow start', slow_start)
+taken.wait(5)
+aborter = threading.Thread(target = worker.abort)
+aborter.start()
+time.sleep(0.1)
+release.set()
+aborter.join()
+result = outcome(first)
+# Either the abort waited for the start and reset the stream, or it came first and the job never streamed
+failures += not check("Job being started", result, ('aborted', 'cancelled'))
+after = worker.submit_file('After the abort', '../gcode_scripts/home.txt')
+failures += not check("Job after the abort", outcome(after), ('done',))
+print("Lines of the aborted job acknowledged = %d" % (first.stream.acked if first.stream is not None else 0))
+
+moving = worker.submit('Moving', lambda robot: robot.streamer.stream(robot.iter_gcode(circle)))
+while moving.stream is None or moving.stream.acked < 10:
+    time.sleep(0.005)
+worker.abort()
+failures += not check("Job moving when aborted", outcome(moving), ('aborted',))
+after = worker.submit('After the move', lambda robot: robot.streamer.stream(['G90', 'G00 X7 Y3']))
+failures += not check("Job after an abort mid-move", outcome(after), ('done',))
+while fake.planner:
+    time.sleep(0.01)
+failures += not check("Machine moved after the abort", 'moved' if fake.position[:2] == [7.0, 3.0] else str(fake.position[:2]), ('moved',))
+
+fake.alarm = True # Locked without an abort (e.g. a limit switch)
+rejected = worker.submit('Locked', lambda robot: robot.streamer.stream(['G90', 'G00 X1 Y1']))
+failures += not check("Job grbl rejected", outcome(rejected), ('failed',))
+fake.alarm = False
+worker.stop()
+robot.streamer.stop()
+ser.close()
+fake.stop()
+
+print("---------Results---------")
+print("%d failures" % failures)
+sys.exit(1 if failures else 0)
@@ -0,0 +1,207 @@
+"""
+benchmark.py
+GOAL: Measure the hot paths of a cookie cycle (g-code generation, vision,
+streaming) so slowdowns show up before the code goes on the robot
+MODULES USED:
+- numpy as np
+- cv2 as cv
+- serial
+- json
+BENCHMARKS:
+gcode_ex_<n>: GCode_EX.generate_gcode of a path with n points
+gcode_legacy_<n>: GCode.generate_gcode of a path with n points
+calibrate_<w>x<h>: Cookie_Vision.calibrate on one synthetic frame
+scan_<w>x<h>: Cookie_Vision.scan_cookie (contour extraction) on one frame
+scan_fast_<w>x<h>: Same with mask_mode = 'fast' (the same as scan_<w>x<h>
+below vision_classes.FAST_MIN_PIXELS)
+scan_replay: scan_cookie on every frame of a recording (if one is given)
+outline: Cookie_Vision.gen_g_code_outline of a scanned cookie
+stream_<n>: GCode_EX.send_gcode of an n line program to fake_grbl.Fake_Grbl
+Every result is the best of several runs, in seconds (lines/sec is also kept
+for streaming).
+USAGE:
+python benchmark.py [--quick] [--save-baseline] [--recording=<video or folder>]
+- --quick: Skip the biggest (1M point) sizes
+- --save-baseline: Store the results as the baseline to compare against
+- --recording: Recording to also time scan_cookie on
+Results are written to benchmark_results.json. If benchmark_baseline.json
+exists, every result is compared to it and anything more than 20% slower is
+listed as a regression (exit code 1).
+"""
+# Import modules
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import numpy as np
+import cv2 as cv
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.g_code_classes as g
+import classes.vision_classes as v
+import classes.capture_classes as c
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FILE = os.path.join(HERE, 'benchmark_results.json')
+BASELINE_FILE = os.path.join(HERE, 'benchmark_baseline.json')
+REGRESSION = 0.20 # Slower than the baseline by more than this is a regression
+
+def best_time(function, repeat = 5, max_seconds = 10):
+    # Best of repeat runs (stops early once max_seconds have been spent)
+    times = []
+    start = time.perf_counter()
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+        if time.perf_counter() - start > max_seconds:
+            break
+    return min(times)
+
+def quiet(function, *args):
+    # The classes print progress: keep it out of the results
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def cookie_path(n):
+    theta = np.linspace(0, 2 * np.pi, n)
+    r = 30 + 2 * np.sin(7 * theta)
+    return np.column_stack((60 + r * np.cos(theta), 60 + r * np.sin(theta)))
+
+def platform_frame(width, height, cookie = True):
+    # Gray platform with the red calibration square, optionally with a cookie
+    frame = np.full((height, width, 3), 70, np.uint8)
+    side = width // 16
+    cv.rectangle(frame, (width // 10, height // 10), (width // 10 + side, height // 10 + side), (0,0,230), -1)
+    if cookie:
+        cv.ellipse(frame, (width // 2, height // 2), (width // 6, height // 6), 15, 0, 360, (150,190,220), -1)
+    return frame
+
+def bench_generation(results, sizes):
+    robot = g.GCode_EX(None)
+    image_file = os.path.join(HERE, 'scale_test.jpg')
+    for n in sizes:
+        path = cookie_path(n)
+        repeat = 5 if n <= 100000 else 1
+        results['gcode_ex_%d' % n] = best_time(lambda: quiet(robot.generate_gcode, path, 'Benchmark.txt'), repeat)
+        legacy = g.GCode(image_file, path, 100, 100)
+        legacy_file = os.path.join(tempfile.gettempdir(), 'benchmark_legacy.txt')
+        results['gcode_legacy_%d' % n] = best_time(lambda: quiet(legacy.generate_gcode, legacy_file), repeat)
+        os.remove(legacy_file)
+    generated = os.path.join(g.GENERATED_DIR, 'Benchmark.txt')
+    if os.path.exists(generated):
+        os.remove(generated)
+
+def bench_vision(results, resolutions, recording = None):
+    for width, height in resolutions:
+        Cookie_V = v.Cookie_Vision(display = c.Scripted_Display())
+        frame = platform_frame(width, height)
+        results['calibrate_%dx%d' % (width, height)] = best_time(lambda: quiet(Cookie_V.calibrate, frame.copy(), False))
+        for i in range(Cookie_V.background.learn_frames):
+            Cookie_V.background.learn(platform_frame(width, height, cookie = False))
+        results['scan_%dx%d' % (width, height)] = best_time(lambda: Cookie_V.scan_cookie(frame))
+        results['scan_fast_%dx%d' % (width, height)] = best_time(lambda: Cookie_V.scan_cookie(frame, 'fast'))
+        if (width, height) == (640, 480):
+            Cookie_V.contours = Cookie_V.scan_cookie(frame)
+            results['outline'] = best_time(lambda: quiet(Cookie_V.gen_g_code_outline))
+    if recording is not None:
+        source = c.open_source(recording, realtime = False)
+        Cookie_V = v.Cookie_Vision(display = c.Scripted_Display())
+        frames = 0
+        start = time.perf_counter()
+        while True:
+            ret, frame = source.read()
+            if not ret:
+                break
+            if not Cookie_V.background.ready():
+                Cookie_V.background.learn(frame)
+            else:
+                Cookie_V.scan_cookie(frame)
+            frames += 1
+        results['scan_replay'] = (time.perf_counter() - start) / max(frames, 1)
+        source.release()
+
+def bench_streaming(results, sizes):
+    import serial
+    from fake_grbl import Fake_Grbl
+    for n in sizes:
+        fake = Fake_Grbl(min_block_time = 0, speedup = 1000) # Measure the link, not the motion
+        fake.start()
+        ser = serial.Serial(fake.port, 115200, timeout = 0.1)
+        robot = g.GCode_EX(ser)
+        robot.streamer.wake_delay = 0.1
+        file_name = os.path.join(tempfile.gettempdir(), 'benchmark_stream.txt')
+        with open(file_name, 'w') as f:
+            f.write(''.join(robot.iter_gcode(cookie_path(n))))
+        start = time.perf_counter()
+        progress = quiet(robot.send_gcode, file_name).result()
+        results['stream_%d' % n] = time.perf_counter() - start
+        results['stream_%d_lines_per_sec' % n] = progress['lines_per_sec']
+        robot.streamer.stop()
+        ser.close()
+        fake.stop()
+        os.remove(file_name)
+
+def compare(results, baseline):
+    # Lines/sec gets bigger when things get better: every other result is a time
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline or not baseline[name]:
+            continue
+        change = value / baseline[name] - 1
+        if name.endswith('per_sec'):
+            change = -change
+        flag = ''
+        if change > REGRESSION:
+            flag = '  <-- REGRESSION'
+            regressions.append(name)
+        print("%-32s %12.6f  baseline %12.6f  %+6.1f%%%s" % (name, value, baseline[name], 100 * change, flag))
+    return regressions
+
+if __name__ == '__main__':
+    quick = '--quick' in sys.argv
+    recording = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('--recording='):
+            recording = arg.split('=', 1)[1]
+    sizes = [1000, 10000, 100000] + ([] if quick else [1000000])
+    results = {}
+    print("Benchmarking g-code generation...")
+    bench_generation(results, sizes)
+    print("Benchmarking vision...")
+    bench_vision(results, [(320, 240), (640, 480), (1280, 720), (1920, 1080)], recording)
+    print("Benchmarking streaming...")
+    bench_streaming(results, [1000])
+
+    report = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'machine': platform.node(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv.__version__,
+        'results': results,
+    }
+    with open(RESULTS_FILE, 'w') as f:
+        json.dump(report, f, indent = 2)
+    print("Results written to " + RESULTS_FILE)
+
+    if '--save-baseline' in sys.argv:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(report, f, indent = 2)
+        print("Baseline saved to " + BASELINE_FILE)
+    elif os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline)
+        if regressions:
+            print("%d regressions" % len(regressions))
+            sys.exit(1)
+    else:
+        for name, value in sorted(results.items()):
+            print("%-32s %12.6f" % (name, value))
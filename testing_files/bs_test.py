@@ -1,11 +1,14 @@
+import sys
 import cv2 as cv
 import numpy as np
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.capture_classes as c
 
 # KNN Subtractor (other is MOG2: it was found KNN works best)
 backSub = cv.createBackgroundSubtractorKNN()
 
 # Camera capture
-capture = cv.VideoCapture(0)
+capture = c.open_source(sys.argv[1] if len(sys.argv) > 1 else 0) # Camera index or a recording
 # Check if camera was opened
 if not capture.isOpened():
     print("Error opening camera: couldn't be opened")
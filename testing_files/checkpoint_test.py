@@ -0,0 +1,144 @@
+"""
+checkpoint_test.py
+GOAL: Check that a checkpointed job that is aborted halfway can be resumed
+from the last acknowledged line and ends where the full program would have
+MODULES USED:
+- numpy as np
+- serial
+CLASSES:
+stream_classes.Job_Checkpoint: records and resumes the job
+stream_classes.Status_Poller: planner reports (moves lost by the reset)
+g_code_classes.GCode_EX: stream_coordinates(checkpoint = ...) and resume
+fake_grbl.Fake_Grbl: grbl on a pty
+TEST CASES:
+A circle is streamed with a checkpoint and grbl is soft reset when about half
+of it was acknowledged. The job is then resumed from the checkpoint file.
+The final position has to be the end of the program (x, y and the syringe
+z), the G92 offset the resume set has to be cleared again, the resumed job
+has to start close to where the machine stopped, and the second run of the
+checkpoint has to be marked complete. A checkpointed job grbl rejects every
+line of (locked in an alarm) must leave its checkpoint at the start and not
+complete. A rollback after an arc (one line, many
+planner blocks) has to go back to the arc's start, and one further back than
+the history kept has to mark the checkpoint lost
+USAGE:
+python checkpoint_test.py [number of points] [abort fraction]
+- abort fraction: Part of the program acknowledged before the reset (default 0.5)
+"""
+# Import modules
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import serial
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.g_code_classes as g
+import classes.stream_classes as st
+from fake_grbl import Fake_Grbl
+
+def wait_idle(poller):
+    # Let the machine finish the moves grbl accepted
+    while poller.wait_update(1) is not None and poller.latest()['state'] != 'Idle':
+        pass
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+fraction = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+theta = np.linspace(0, 2 * np.pi, n)
+circle = np.column_stack((50 + 30 * np.cos(theta), 50 + 30 * np.sin(theta)))
+checkpoint_file = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+program = os.path.join(g.GENERATED_DIR, 'Checkpoint_test.txt')
+failures = 0
+
+fake = Fake_Grbl(speedup = 20)
+fake.start()
+ser = serial.Serial(fake.port, 115200, timeout = 0.1)
+robot = g.GCode_EX(ser)
+robot.streamer.wake_delay = 0.1
+robot.streamer.adaptive = True
+poller = st.Status_Poller(robot.streamer, rate = 20).start()
+
+# Where the whole program ends (the checkpoint's own parser run over every line)
+expected = st.Job_Checkpoint(checkpoint_file, interval = float('inf')) # Never saved
+lines = [st.clean_line(line) for line in robot.iter_gcode(circle) if st.clean_line(line)]
+for k, line in enumerate(lines):
+    expected.update(k, line)
+
+job = robot.stream_coordinates(circle, archive = 'Checkpoint_test.txt', wait = False, checkpoint = checkpoint_file)
+while job.acked < fraction * len(lines) and not job.done():
+    time.sleep(0.005)
+robot.streamer.soft_reset()
+try:
+    job.result()
+    print("Job finished before the reset: FAIL")
+    failures += 1
+except st.Job_Aborted:
+    pass
+wait_idle(poller)
+stopped_at = list(fake.position)
+checkpoint = st.Job_Checkpoint(checkpoint_file)
+checkpoint.load()
+print("---------Aborted---------")
+print("Acknowledged %d of %d lines, checkpoint at line %d" % (job.acked, len(lines), checkpoint.line))
+print("Machine stopped at X%.3f Y%.3f Z%.3f" % tuple(stopped_at))
+print("Checkpoint at      X%.3f Y%.3f Z%.3f" % tuple(checkpoint.position))
+# Positive z gap: the syringe pushes that much icing twice, negative: skipped
+z_gap = stopped_at[2] - checkpoint.position[2]
+xy_gap = np.hypot(stopped_at[0] - checkpoint.position[0], stopped_at[1] - checkpoint.position[1])
+
+resumed = robot.resume(checkpoint_file)
+wait_idle(poller)
+poller.stop()
+x, y, z = poller.position()
+checkpoint.load()
+# The resumed job ends with G92.1: the position is back in machine coordinates,
+# which are off from the work coordinates by the syringe gap
+end = (expected.position[0], expected.position[1], expected.position[2] + z_gap)
+at_end = np.allclose((x, y, z), end, atol = 0.01)
+offset_cleared = fake.offset == [0.0, 0.0, 0.0]
+failures += not at_end or not offset_cleared or not checkpoint.complete or abs(z_gap) > 0.1 or fake.stats['overflow'] > 0
+print("---------Resumed---------")
+print("Lines = %d in %.2f s" % (resumed.result()['acked'], resumed.result()['elapsed']))
+print("Final position = X%.3f Y%.3f Z%.3f, expected X%.3f Y%.3f Z%.3f (%s)" % (x, y, z, *end, 'ok' if at_end else 'FAIL'))
+print("G92 offset cleared =", offset_cleared)
+print("Resume gap = %.3f mm in xy, %.3f mm of syringe" % (xy_gap, z_gap))
+print("Checkpoint complete =", checkpoint.complete)
+print("RX overflows =", fake.stats['overflow'])
+
+# Every line rejected with 'error:9': nothing was done, so nothing to move past
+fake.alarm = True
+locked_file = os.path.join(tempfile.mkdtemp(), 'locked.json')
+locked = robot.stream_coordinates(circle[:20], archive = 'Checkpoint_test.txt', wait = False, checkpoint = locked_file).result()
+fake.alarm = False
+locked_checkpoint = st.Job_Checkpoint(locked_file)
+locked_checkpoint.load()
+locked_ok = locked['errors'] == locked['acked'] and locked_checkpoint.line == 0 and not locked_checkpoint.complete
+failures += not locked_ok
+print("---------Locked---------")
+print("%d of %d lines rejected, checkpoint at line %d, complete = %s (%s)" % (locked['errors'], locked['acked'],
+    locked_checkpoint.line, locked_checkpoint.complete, 'ok' if locked_ok else 'FAIL'))
+robot.streamer.stop()
+ser.close()
+fake.stop()
+os.remove(program)
+
+# Arcs: grbl cuts one G02 line into many planner blocks, so a full planner can
+# be part of a single line. Rolling back 15 blocks has to go back to the start
+# of the arc, and going back further than the history fails the checkpoint
+arc_lines = ['G90', 'G00 X21 Y0 Z0', 'G01 F500', 'G01 X21 Y0 Z0.1', 'G02 X-21 Y0 Z1 I-21 J0', 'G01 X-22 Y0 Z1.1']
+arc_checkpoint = st.Job_Checkpoint(os.path.join(tempfile.mkdtemp(), 'arcs.json'), interval = float('inf'))
+for k, line in enumerate(arc_lines):
+    arc_checkpoint.update(k, line)
+arc_ok = arc_checkpoint.rollback(15) and arc_checkpoint.line == 4 and arc_checkpoint.position == [21, 0, 0.1]
+short = st.Job_Checkpoint(os.path.join(tempfile.mkdtemp(), 'arcs.json'), interval = float('inf'), history = 2)
+for k, line in enumerate(arc_lines[:4]):
+    short.update(k, line)
+lost_ok = not short.rollback(15) and short.lost
+failures += not arc_ok or not lost_ok
+print("---------Arcs---------")
+print("Rollback of 15 blocks back to line %d at X%g Y%g Z%g (%s)" % (arc_checkpoint.line, *arc_checkpoint.position, 'ok' if arc_ok else 'FAIL'))
+print("Rollback past the history marks the checkpoint lost (%s)" % ('ok' if lost_ok else 'FAIL'))
+
+print("---------Results---------")
+print("%d failures" % failures)
+sys.exit(1 if failures else 0)
@@ -0,0 +1,304 @@
+"""
+fake_grbl.py
+GOAL: Pretend to be grbl on a pseudo-terminal (pty) so g-code streaming can be
+measured without the robot plugged in
+MODULES USED:
+- numpy as np
+- serial
+CLASSES:
+Fake_Grbl:
+Purpose: Opens a pty and answers like grbl 1.1 would. The host's bytes arrive
+at the emulated baud rate, are held in a 127 byte RX buffer, and every motion
+line is put into a 15 block planner that drains at the commanded feed rate.
+'ok' is only sent once a line made it into the planner, so a host that does
+not keep the RX buffer full will starve the planner. Arcs (G2/G3 with I/J)
+are cut into segments like grbl does ($12 arc tolerance), and their 'ok' comes
+once the last segment is in the planner. Real-time commands
+('?', '!', '~', ctrl-x) are handled as soon as they arrive. A soft reset while
+moving locks it in ALARM like grbl: every g-code line gets 'error:9' until '$X'
+unlocks it.
+USAGE:
+python fake_grbl.py [number of points]
+Streams a circle with that many points and prints the throughput
+"""
+import os
+import sys
+import pty
+import tty
+import re
+import math
+import time
+import select
+import threading
+from collections import deque
+
+WORD = re.compile(r'([A-Z])([-+]?[0-9]*\.?[0-9]*)')
+
+class Fake_Grbl:
+    def __init__(self, rx_buffer_size = 127, planner_size = 15, baud = 115200, min_block_time = 0.001, speedup = 1.0,
+                 arc_tolerance = 0.002):
+        self.rx_buffer_size = rx_buffer_size
+        self.speedup = speedup # Moves run this many times faster than the feed rate
+        self.planner_size = planner_size
+        self.baud = baud
+        self.min_block_time = min_block_time
+        self.arc_tolerance = arc_tolerance
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.position = [0.0, 0.0, 0.0]
+        self.feed_rate = 500.0
+        self.absolute = True
+        self.offset = [0.0, 0.0, 0.0] # G92 offset (machine position of work zero)
+        self.hold = False
+        self.alarm = False # Locked after a reset during a move (until '$X')
+        self.wire = deque() # Bytes still travelling down the emulated serial line
+        self.rx = bytearray() # grbl's serial RX buffer
+        self.planner = deque() # [time left, end position] of every planned block
+        self.segments = deque() # Arc segments waiting for room in the planner
+        self.arc_ok = False # 'ok' owed for the arc in self.segments
+        self.stats = {'lines': 0, 'overflow': 0, 'rx_time': 0.0, 'rx_byte_seconds': 0.0,
+                      'planner_idle': 0.0, 'run_time': 0.0, 'max_rx': 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target = self._serve, name = 'fake-grbl', daemon = True)
+        self._thread.start()
+        self._reply('Grbl 1.1h [\'$\' for help]')
+        return self.port
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def status_report(self):
+        if self.alarm:
+            state = 'Alarm'
+        elif self.hold:
+            state = 'Hold:0'
+        elif self.planner:
+            state = 'Run'
+        else:
+            state = 'Idle'
+        x, y, z = self.position
+        report = '<%s|MPos:%.3f,%.3f,%.3f|Bf:%d,%d|FS:%d,0' % (state, x, y, z,
+            self.planner_size - len(self.planner), self.rx_buffer_size - len(self.rx), self.feed_rate)
+        if any(self.offset):
+            report += '|WCO:%.3f,%.3f,%.3f' % tuple(self.offset)
+        return report + '>'
+
+    def _reply(self, text):
+        os.write(self.master, (text + '\r\n').encode('ascii'))
+
+    def _reset(self):
+        # Bytes still on the wire arrive after the reset (e.g. the next job)
+        if self.planner or self.segments:
+            # Steps may have been lost: grbl locks until it is unlocked or homed
+            self.alarm = True
+            self._reply('ALARM:3')
+        self.rx = bytearray()
+        self.planner.clear()
+        self.segments.clear()
+        self.arc_ok = False
+        self.hold = False
+        self._reply('Grbl 1.1h [\'$\' for help]')
+        if self.alarm:
+            self._reply("[MSG:'$H'|'$X' to unlock]")
+
+    def _serve(self):
+        last = time.time()
+        byte_time = 10.0 / self.baud # 8 data bits + start + stop bit
+        wire_credit = 0.0
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.0005)
+            if ready:
+                try:
+                    data = os.read(self.master, 4096)
+                except OSError:
+                    break
+                for c in data:
+                    self.wire.append(c)
+            now = time.time()
+            dt = now - last
+            last = now
+            # Move bytes from the wire into grbl at the baud rate
+            wire_credit = min(wire_credit + dt / byte_time, 4096)
+            while self.wire and wire_credit >= 1:
+                wire_credit -= 1
+                self._receive(self.wire.popleft())
+            if not self.wire:
+                wire_credit = 0.0
+            self._parse_lines()
+            self._execute(dt)
+            self.stats['rx_time'] += dt
+            self.stats['rx_byte_seconds'] += len(self.rx) * dt
+            self.stats['max_rx'] = max(self.stats['max_rx'], len(self.rx))
+
+    def _receive(self, c):
+        # Real-time commands never go into the RX buffer
+        if c == ord('?'):
+            self._reply(self.status_report())
+        elif c == ord('!'):
+            self.hold = True
+        elif c == ord('~'):
+            self.hold = False
+        elif c == 0x18:
+            self._reset()
+        elif len(self.rx) < self.rx_buffer_size:
+            self.rx.append(c)
+        else:
+            self.stats['overflow'] += 1
+
+    def _parse_lines(self):
+        while True:
+            # An arc blocks the next line until its last segment is planned
+            while self.segments and len(self.planner) < self.planner_size:
+                self.planner.append(self.segments.popleft())
+            if self.segments:
+                return
+            if self.arc_ok:
+                self.arc_ok = False
+                self._reply('ok')
+            if len(self.planner) >= self.planner_size:
+                return
+            ends = [i for i in (self.rx.find(b'\n'), self.rx.find(b'\r')) if i >= 0]
+            if not ends:
+                return
+            end = min(ends)
+            line = self.rx[:end].decode('ascii', 'ignore').strip().upper()
+            del self.rx[:end + 1]
+            reply = self._run_line(line)
+            if reply is None:
+                self.arc_ok = True
+            else:
+                self._reply(reply)
+            self.stats['lines'] += 1
+
+    def _run_line(self, line):
+        if line == '$X':
+            if self.alarm:
+                self.alarm = False
+                self._reply('[MSG:Caution: Unlocked]')
+            return 'ok'
+        if line.startswith('$'):
+            return 'ok' # Settings don't move anything
+        if self.alarm and line:
+            return 'error:9' # G-code is locked out in ALARM
+        words = WORD.findall(line.replace(' ', ''))
+        values = {}
+        g_codes = []
+        for letter, number in words:
+            if number in ('', '-', '+', '.'):
+                return 'error:2'
+            if letter == 'G':
+                g_codes.append(float(number))
+            else:
+                values[letter] = float(number)
+        for g in g_codes:
+            if g == 90:
+                self.absolute = True
+            elif g == 91:
+                self.absolute = False
+        if 92.1 in g_codes:
+            self.offset = [0.0, 0.0, 0.0] # Back to machine coordinates
+        if 'F' in values:
+            self.feed_rate = values['F']
+        if not any(axis in values for axis in 'XYZ'):
+            return 'ok'
+        start = self._planned_position()
+        if 92 in g_codes:
+            # The current position becomes the given work position
+            for i, axis in enumerate('XYZ'):
+                if axis in values:
+                    self.offset[i] = start[i] - values[axis]
+            return 'ok'
+        end = list(start)
+        for i, axis in enumerate('XYZ'):
+            if axis in values:
+                end[i] = values[axis] + self.offset[i] if self.absolute else start[i] + values[axis]
+        if 2 in g_codes or 3 in g_codes:
+            self._plan_arc(start, end, values.get('I', 0), values.get('J', 0), 2 in g_codes)
+            return None # 'ok' once every segment is planned (see _parse_lines)
+        length = math.hypot(math.dist(start[:2], end[:2]), end[2] - start[2])
+        self.planner.append([self._block_time(length), end])
+        return 'ok'
+
+    def _plan_arc(self, start, end, i, j, clockwise):
+        # Cut the arc into segments like grbl's mc_arc
+        cx, cy = start[0] + i, start[1] + j
+        r = math.hypot(i, j)
+        a0 = math.atan2(start[1] - cy, start[0] - cx)
+        a1 = math.atan2(end[1] - cy, end[0] - cx)
+        sweep = (a0 - a1) if clockwise else (a1 - a0)
+        sweep = sweep % (2 * math.pi) or 2 * math.pi
+        count = 1
+        if r > self.arc_tolerance:
+            count = max(int(0.5 * sweep * r / math.sqrt(self.arc_tolerance * (2 * r - self.arc_tolerance))), 1)
+        direction = -1 if clockwise else 1
+        length = math.hypot(r * sweep, end[2] - start[2]) / count
+        for k in range(1, count + 1):
+            a = a0 + direction * sweep * k / count
+            point = [cx + r * math.cos(a), cy + r * math.sin(a), start[2] + (end[2] - start[2]) * k / count]
+            self.segments.append([self._block_time(length), end if k == count else point])
+
+    def _block_time(self, length):
+        return max(length / self.feed_rate * 60 / self.speedup, self.min_block_time)
+
+    def _planned_position(self):
+        if self.segments:
+            return list(self.segments[-1][1])
+        return list(self.planner[-1][1]) if self.planner else list(self.position)
+
+    def _execute(self, dt):
+        if self.hold:
+            return
+        if not self.planner:
+            if self.stats['run_time'] > 0:
+                self.stats['planner_idle'] += dt
+            return
+        self.stats['run_time'] += dt
+        while self.planner and dt > 0:
+            block = self.planner[0]
+            used = min(dt, block[0])
+            block[0] -= used
+            dt -= used
+            if block[0] <= 0:
+                self.position = block[1]
+                self.planner.popleft()
+
+if __name__ == '__main__':
+    import numpy as np
+    import serial
+    sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+    import classes.g_code_classes as g
+    from classes.stream_classes import Grbl_Streamer
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    theta = np.linspace(0, 2 * np.pi, n)
+    circle = np.column_stack((50 + 30 * np.cos(theta), 50 + 30 * np.sin(theta)))
+    z = g.extrusion_profile(circle)
+    program = ['G90', 'G01 F500'] + g.format_moves(np.column_stack((circle, z))).splitlines()
+
+    fake = Fake_Grbl()
+    fake.start()
+    ser = serial.Serial(fake.port, 115200, timeout = 0.1)
+    streamer = Grbl_Streamer(ser, wake_delay = 0.1)
+    job = streamer.stream(program)
+    result = job.result()
+    while fake.planner:
+        time.sleep(0.01)
+    print("---------Results---------")
+    print("Lines streamed =", result['acked'])
+    print("Errors =", result['errors'])
+    print("Lines/sec = %.1f" % result['lines_per_sec'])
+    print("Host mean/max bytes in flight = %.1f / %d" % (result['mean_buffer'], result['max_buffer']))
+    print("grbl mean/max RX occupancy = %.1f / %d" % (fake.stats['rx_byte_seconds'] / fake.stats['rx_time'], fake.stats['max_rx']))
+    print("Planner idle time while running = %.3f s" % fake.stats['planner_idle'])
+    print("RX overflows =", fake.stats['overflow'])
+    streamer.stop()
+    ser.close()
+    fake.stop()
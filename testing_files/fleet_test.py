@@ -0,0 +1,143 @@
+"""
+fleet_test.py
+GOAL: Run several cookie robots from one process without any hardware: every
+robot is a fake_grbl on its own pty and every camera is a looping synthetic
+recording where a cookie is put down, frosted and taken off again
+MODULES USED:
+- asyncio
+- numpy as np
+- cv2 as cv
+CLASSES:
+fleet_classes.Fleet: one order queue and scheduler for every robot
+fleet_classes.Robot_Station: one robot and its camera
+capture_classes.Replay_Source: plays the recordings back in real time
+fake_grbl.Fake_Grbl: grbl on a pty
+TEST CASES:
+Every order has to be finished (full fill and outline only designs) and
+every robot has to take orders. An order for a fleet where no robot could be
+opened has to fail right away. A robot whose order failed (grbl locked) has
+to go offline: the orders after it fail instead of going to it
+USAGE:
+python fleet_test.py [robots] [orders]
+- robots: Number of robot/camera pairs (default 3)
+- orders: Number of cookie orders (default 6)
+"""
+# Import modules
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import numpy as np
+import cv2 as cv
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.fleet_classes as f
+import classes.capture_classes as c
+from fake_grbl import Fake_Grbl
+
+def make_recording(folder, seed, empty_frames = 40, cookie_frames = 60, size = (640, 480)):
+    # Empty platform, a cookie is put down, then taken off again (played in a loop)
+    rng = np.random.default_rng(seed)
+    width, height = size
+    platform = np.full((height, width, 3), 70, np.uint8)
+    # The printable area is centered on the red square (see platform_from_square)
+    side = width // 13
+    square = (width // 2 - side // 2, int(height * 0.46) - side // 2)
+    cv.rectangle(platform, square, (square[0] + side, square[1] + side), (0,0,230), -1)
+    cookie = platform.copy()
+    center = (int(width * rng.uniform(0.45, 0.55)), int(height * rng.uniform(0.65, 0.69)))
+    axes = (int(rng.uniform(35, 45)), int(rng.uniform(30, 40)))
+    cv.ellipse(cookie, center, axes, rng.uniform(0, 180), 0, 360, (150,190,220), -1)
+    for i in range(empty_frames + cookie_frames):
+        frame = platform if i < empty_frames else cookie
+        noise = rng.integers(0, 6, frame.shape, dtype = np.uint8)
+        cv.imwrite(os.path.join(folder, 'frame_%04d.png' % i), cv.add(frame, noise))
+
+async def run(robots, orders):
+    temp = tempfile.mkdtemp()
+    fakes = []
+    stations = []
+    for i in range(robots):
+        fake = Fake_Grbl(speedup = 20)
+        fake.start()
+        fakes.append(fake)
+        recording = os.path.join(temp, 'camera_%d' % i)
+        os.makedirs(recording)
+        make_recording(recording, i)
+        source = c.Replay_Source(recording, realtime = True, fps = 30, loop = True)
+        stations.append(f.Robot_Station('robot_%d' % i, fake.port, source, wake_delay = 0.1, cookie_timeout = 30,
+                                        calibration_dir = os.path.join(temp, 'calibration'), archive = False))
+    fleet = f.Fleet(stations)
+    start_time = time.time()
+    await fleet.start()
+    print("Fleet opened in %.1f s" % (time.time() - start_time))
+
+    start_time = time.time()
+    cookie_orders = [fleet.submit(None if k % 2 == 0 else 'outline') for k in range(orders)]
+    while not all(order.future.done() for order in cookie_orders):
+        await asyncio.sleep(1)
+        print(" | ".join("%s: %s (%d)" % (s['name'], s['state'], s['cookies']) for s in fleet.status()))
+    await fleet.join()
+    elapsed = time.time() - start_time
+    await fleet.stop()
+    for fake in fakes:
+        fake.stop()
+
+    failures = 0
+    print("---------Results---------")
+    for order in cookie_orders:
+        if order.future.cancelled() or order.future.exception() is not None:
+            failures += 1
+            print("%s on %s: FAIL %s" % (order.name, order.station, order.future.exception()))
+        else:
+            progress = order.future.result()
+            print("%s (%s) on %s: %d lines in %.1f s" % (order.name, order.design or 'full', order.station, progress['acked'], progress['elapsed']))
+    used = set(order.station for order in cookie_orders)
+    if len(used) < min(robots, orders):
+        failures += 1
+        print("Only %d of %d robots took orders: FAIL" % (len(used), robots))
+    print("%d cookies in %.1f s (%.1f cookies/min)" % (orders - failures, elapsed, 60 * orders / elapsed))
+
+    # No robot could be opened: orders have to fail instead of waiting forever
+    broken = f.Fleet([f.Robot_Station('broken', os.path.join(temp, 'no_port'), os.path.join(temp, 'no_camera'),
+                                      calibration_dir = os.path.join(temp, 'calibration'))])
+    await broken.start()
+    order = broken.submit()
+    try:
+        await asyncio.wait_for(broken.join(), 5)
+        failed = order.future.exception() is not None
+    except asyncio.TimeoutError:
+        failed = False
+    await broken.stop()
+    failures += not failed
+    print("Order without robots %s" % ('failed right away (ok)' if failed else 'waited: FAIL'))
+
+    # Robot locked after it opened: its order fails and it must not get the next one
+    fake = Fake_Grbl(speedup = 20)
+    fake.start()
+    recording = os.path.join(temp, 'camera_locked')
+    os.makedirs(recording)
+    make_recording(recording, robots)
+    source = c.Replay_Source(recording, realtime = True, fps = 30, loop = True)
+    locked = f.Fleet([f.Robot_Station('locked', fake.port, source, wake_delay = 0.1, cookie_timeout = 30,
+                                      calibration_dir = os.path.join(temp, 'calibration'), archive = False)])
+    await locked.start()
+    fake.alarm = True
+    locked_orders = [locked.submit(), locked.submit()]
+    try:
+        await asyncio.wait_for(locked.join(), 10)
+        failed = all(order.future.exception() is not None for order in locked_orders)
+    except asyncio.TimeoutError:
+        failed = False
+    offline = locked.status()[0]['state'] == 'offline'
+    await locked.stop()
+    fake.stop()
+    failures += not (failed and offline)
+    print("Locked robot %s" % ('went offline, orders failed (ok)' if failed and offline else 'kept taking orders: FAIL'))
+    print("%d failures" % failures)
+    return failures
+
+if __name__ == '__main__':
+    robots = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    orders = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    sys.exit(1 if asyncio.run(run(robots, orders)) else 0)
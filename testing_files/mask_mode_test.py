@@ -0,0 +1,136 @@
+"""
+mask_mode_test.py
+GOAL: Check that the 'fast' mask mode (pyramid-downscaled morphology with the
+contour refined at full resolution) finds the same contours as the 'exact'
+mode, and measure how much faster it is
+MODULES USED:
+- numpy as np
+- cv2 as cv
+- time
+FUNCTIONS:
+vision_classes.mask_contours: cleans up a mask and finds its contours
+vision_classes.Cookie_Vision.calibrate / scan_cookie / scan_cookies
+TEST CASES:
+Synthetic platforms (red square and noisy gray background) at several
+resolutions with a round cookie, a wavy cookie, a star cookie and a batch of
+four cookies. Every contour found by 'fast' has to be within the tolerance
+(pixels) of the 'exact' contour both ways, and the red square found by
+calibrate has to match. The fast contour follows the mask edge where the
+25 px open rounds off points (wavy/star crests), so it can be a few pixels
+outside the exact contour there. Below vision_classes.FAST_MIN_PIXELS (e.g.
+640x480) 'fast' falls back to 'exact', so those times are the same.
+USAGE:
+python mask_mode_test.py [tolerance]
+- tolerance: Largest allowed distance between the contours (default 4 px,
+the refinement band of mask_contours with 2 pyramid levels)
+Exits with code 1 if a case is out of tolerance.
+"""
+# Import modules
+import sys
+import time
+import numpy as np
+import cv2 as cv
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.vision_classes as v
+import classes.capture_classes as c
+
+def empty_platform(width, height, rng):
+    frame = np.full((height, width, 3), 70, np.uint8)
+    side = width // 16
+    cv.rectangle(frame, (width // 10, height // 10), (width // 10 + side, height // 10 + side), (0,0,230), -1)
+    return cv.add(frame, rng.integers(0, 6, frame.shape, dtype = np.uint8))
+
+def cookie_polygon(center, radius, lobes = 0, depth = 0.0, n = 360):
+    theta = np.linspace(0, 2 * np.pi, n, endpoint = False)
+    r = radius * (1 + depth * np.sin(lobes * theta))
+    points = np.column_stack((center[0] + r * np.cos(theta), center[1] + r * np.sin(theta)))
+    return np.intp(np.rint(points))
+
+def draw_cookies(frame, polygons, rng):
+    frame = frame.copy()
+    for polygon in polygons:
+        cv.fillPoly(frame, [polygon], (150,190,220))
+    # Crumbs: small specks the open has to remove
+    for i in range(30):
+        x, y = int(rng.integers(0, frame.shape[1])), int(rng.integers(0, frame.shape[0]))
+        cv.circle(frame, (x, y), int(rng.integers(1, 4)), (150,190,220), -1)
+    return frame
+
+def contour_distance(a, b):
+    # Largest distance of a point of contour a from contour b
+    b = b.reshape(-1, 1, 2).astype(np.float32)
+    return max(abs(cv.pointPolygonTest(b, (float(x), float(y)), True)) for x, y in a.reshape(-1, 2))
+
+def compare(name, exact, fast, tolerance):
+    if len(exact) != len(fast):
+        print("%-28s FAIL: %d contours exact, %d fast" % (name, len(exact), len(fast)))
+        return False
+    worst = 0
+    area_change = 0
+    for a in exact:
+        # Pair every exact contour with the fast contour closest to it
+        center = a.reshape(-1, 2).mean(axis = 0)
+        b = min(fast, key = lambda cnt: np.hypot(*(cnt.reshape(-1, 2).mean(axis = 0) - center)))
+        worst = max(worst, contour_distance(a, b), contour_distance(b, a))
+        area_change = max(area_change, abs(cv.contourArea(b) / cv.contourArea(a) - 1))
+    ok = worst <= tolerance
+    print("%-28s %s: max distance %.2f px, area %.2f%%" % (name, 'ok  ' if ok else 'FAIL', worst, 100 * area_change))
+    return ok
+
+def best_time(function, repeat = 10):
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+tolerance = float(sys.argv[1]) if len(sys.argv) > 1 else 4.0
+rng = np.random.default_rng(0)
+failures = 0
+for width, height in [(640, 480), (1280, 720), (1920, 1080)]:
+    k = width / 640 # Cookie sizes follow the resolution
+    center = (width // 2, height // 2)
+    cases = {
+        'round': [cookie_polygon(center, 100 * k)],
+        'wavy': [cookie_polygon(center, 100 * k, 7, 0.08)],
+        'star': [cookie_polygon(center, 110 * k, 5, 0.35)],
+        'batch': [cookie_polygon((int(width * x), int(height * y)), 55 * k, 6, 0.05)
+                  for x, y in [(0.35, 0.35), (0.65, 0.35), (0.35, 0.72), (0.65, 0.72)]],
+    }
+    Cookie_V = v.Cookie_Vision(display = c.Scripted_Display())
+    empty = empty_platform(width, height, rng)
+    for i in range(Cookie_V.background.learn_frames):
+        Cookie_V.background.learn(empty_platform(width, height, rng))
+
+    # Calibration: both modes have to find the same red square
+    Cookie_V.calibrate(empty.copy(), False, mask_mode = 'exact')
+    exact_rect = Cookie_V.square_rect
+    Cookie_V.calibrate(empty.copy(), False, mask_mode = 'fast')
+    fast_rect = Cookie_V.square_rect
+    drift = np.hypot(exact_rect[0][0] - fast_rect[0][0], exact_rect[0][1] - fast_rect[0][1])
+    size_change = abs(np.mean(exact_rect[1]) - np.mean(fast_rect[1]))
+    ok = drift <= tolerance and size_change <= tolerance
+    failures += not ok
+    print("%-28s %s: square moved %.2f px, size changed %.2f px" % ('calibrate %dx%d' % (width, height), 'ok  ' if ok else 'FAIL', drift, size_change))
+
+    for name, polygons in cases.items():
+        frame = draw_cookies(empty, polygons, rng)
+        label = '%s %dx%d' % (name, width, height)
+        if name == 'batch':
+            exact = Cookie_V.scan_cookies(frame, mask_mode = 'exact')
+            fast = Cookie_V.scan_cookies(frame, mask_mode = 'fast')
+        else:
+            exact = [Cookie_V.scan_cookie(frame, 'exact')]
+            fast = [Cookie_V.scan_cookie(frame, 'fast')]
+        failures += not compare(label, exact, fast, tolerance)
+
+    # Only the mask clean up is timed (background subtraction is the same)
+    mask = Cookie_V.background.foreground(draw_cookies(empty, cases['round'], rng))
+    exact_time = best_time(lambda: v.mask_contours(mask, 25, 'exact'))
+    fast_time = best_time(lambda: v.mask_contours(mask, 25, 'fast'))
+    print("%-28s exact %.2f ms, fast %.2f ms (%.1fx)" % ('time %dx%d' % (width, height), exact_time * 1000, fast_time * 1000, exact_time / fast_time))
+
+print("---------Results---------")
+print("%d failures (tolerance %.1f px)" % (failures, tolerance))
+sys.exit(1 if failures else 0)
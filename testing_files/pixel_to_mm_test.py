@@ -0,0 +1,167 @@
+"""
+pixel_to_mm_test.py
+GOAL: Check the calibrated pixel to mm transform (vision_classes.Pixel_To_MM)
+against platforms where the mm position of everything is known, and compare
+it with the old scaling (15/l_avg from the top left of the platform)
+MODULES USED:
+- numpy as np
+- cv2 as cv
+- time
+CLASSES:
+vision_classes.Cookie_Vision: calibrate, scan_cookie, outline_to_mm
+vision_classes.Pixel_To_MM / square_transform
+TEST CASES:
+- Camera straight above an unrotated platform: same origin and axes as the
+  old scaling (only the rounding of l_avg changes the scale)
+- Rotated platform, and a camera looking at the platform at a slight angle:
+  every point of the scanned cookie outline (mm from the red square's center)
+  has to be within the tolerance of where it really is. The perspective is
+  measured on the 15 mm square only, so a tenth of a pixel at its corners
+  already moves points 70 mm away by most of a mm: steep camera angles are
+  only partly corrected
+- Lens distortion (points only): a distorted square and cookie are corrected
+  with the camera matrix and distortion coefficients
+- to_pixels(to_mm(points)) gives the points back, and a saved calibration
+  loads the same transform
+- Time to transform a contour vs warping a whole frame
+USAGE:
+python pixel_to_mm_test.py [tolerance]
+- tolerance: Largest allowed error (default 0.5 mm)
+"""
+# Import modules
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import cv2 as cv
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.vision_classes as v
+import classes.capture_classes as c
+
+PX_PER_MM = 4 # Top-down view the test platforms are drawn in
+SIZE = (1280, 960)
+COOKIE = (0, 45, 25) # Cookie center x, y from the red square's center and radius (mm)
+
+def top_down(cookie, supersample = 4):
+    # Platform seen from straight above: red square in the middle, mm -> pixels is exact.
+    # Drawn supersample times bigger and shrunk, so the edges are anti-aliased like
+    # a camera's. Returns the frame and the square's center (pixel (i, j) covers
+    # i-0.5 to i+0.5)
+    k = supersample
+    frame = np.full((SIZE[1] * k, SIZE[0] * k, 3), 70, np.uint8)
+    corner = np.intp(np.array(SIZE) / 2 - (0, 100)) * k
+    side = int(v.SQUARE_MM * PX_PER_MM * k)
+    cv.rectangle(frame, tuple(corner), tuple(corner + side - 1), (0,0,230), -1)
+    if cookie:
+        cookie_center = corner + side / 2 + np.array(COOKIE[:2]) * PX_PER_MM * k
+        cv.circle(frame, tuple(np.intp(cookie_center)), COOKIE[2] * PX_PER_MM * k, (150,190,220), -1)
+    frame = cv.resize(frame, SIZE, interpolation = cv.INTER_AREA)
+    center = (corner + side / 2) / k - 0.5
+    return frame, center
+
+VIEWS = {} # Camera views are only warped once (noise is added to every frame)
+def camera_view(cookie, homography, rng):
+    key = (cookie, homography.tobytes())
+    if key not in VIEWS:
+        frame, center = top_down(cookie)
+        frame = cv.warpPerspective(frame, homography, SIZE, borderValue = (70,70,70))
+        VIEWS[key] = cv.GaussianBlur(frame, (5, 5), 0.8) # Camera optics never give one pixel wide edges
+    return cv.add(VIEWS[key], rng.integers(0, 6, VIEWS[key].shape, dtype = np.uint8))
+
+def transform_error(to_mm, contour, homography):
+    # Largest distance (mm) of the converted contour points from where they
+    # really are on the platform, both measured from the red square's center
+    square_center = top_down(False, 1)[1]
+    camera_center = cv.perspectiveTransform(square_center.reshape(1, 1, 2), homography)
+    platform = cv.perspectiveTransform(contour.reshape(-1, 1, 2).astype(float), np.linalg.inv(homography)).reshape(-1, 2)
+    truth = (platform - square_center) / PX_PER_MM
+    found = to_mm(contour) - to_mm(camera_center)
+    return np.linalg.norm(found - truth, axis = 1).max()
+
+def old_scaling(Cookie_V, points):
+    # What outline_to_mm did before the calibrated transform
+    return (np.asarray(points, dtype = float).reshape(-1, 2) - Cookie_V.box_platform[0]) * 15 / Cookie_V.l_avg
+
+tolerance = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+rng = np.random.default_rng(0)
+failures = 0
+turn = cv.getRotationMatrix2D((SIZE[0] / 2, SIZE[1] / 2), 20, 1.0)
+cameras = {
+    'straight above': np.eye(3),
+    'rotated 20 deg': np.vstack((turn, [0, 0, 1])),
+    'perspective': cv.getPerspectiveTransform(
+        np.float32([[0, 0], [SIZE[0], 0], [SIZE[0], SIZE[1]], [0, SIZE[1]]]),
+        np.float32([[40, 20], [1240, 0], [1280, 960], [0, 930]])),
+}
+for name, homography in cameras.items():
+    Cookie_V = v.Cookie_Vision(display = c.Scripted_Display())
+    for i in range(Cookie_V.background.learn_frames):
+        Cookie_V.background.learn(camera_view(False, homography, rng))
+    Cookie_V.calibrate(camera_view(False, homography, rng), False)
+    contour = Cookie_V.scan_cookie(camera_view(True, homography, rng))
+    error = transform_error(Cookie_V.pixel_to_mm.to_mm, contour, homography)
+    old_error = transform_error(lambda points: old_scaling(Cookie_V, points), contour, homography)
+    ok = error <= tolerance
+    if name == 'straight above':
+        # Same origin and axes as before: only the scale changes (l_avg was rounded to a pixel)
+        outline = Cookie_V.pixel_to_mm.to_mm(contour)
+        old = old_scaling(Cookie_V, contour)
+        scale = np.sum(old * outline) / np.sum(outline * outline)
+        same = np.abs(old - scale * outline).max()
+        ok = ok and same <= tolerance and abs(scale - 1) <= 2 / Cookie_V.l_avg
+        print("%-16s %s: old scaling = %.4f x new (l_avg %d px), then off by %.3f mm" % (name, 'ok  ' if ok else 'FAIL', scale, Cookie_V.l_avg, same))
+    failures += not ok
+    print("%-16s %s: cookie outline off by %.3f mm (old scaling %.3f mm)" % (name, 'ok  ' if ok else 'FAIL', error, old_error))
+
+# Lens distortion: only points go through the lens (barrel distortion)
+camera_matrix = np.array([[900, 0, SIZE[0] / 2], [0, 900, SIZE[1] / 2], [0, 0, 1]], dtype = float)
+dist_coeffs = np.array([-0.25, 0.08, 0, 0, 0])
+def through_lens(pixels):
+    rays = np.column_stack((pixels, np.ones(len(pixels)))) @ np.linalg.inv(camera_matrix).T
+    projected, jacobian = cv.projectPoints(rays, np.zeros(3), np.zeros(3), camera_matrix, dist_coeffs)
+    return projected.reshape(-1, 2)
+center = np.array([900.0, 300.0]) # Near the edge, where distortion is strongest
+half = v.SQUARE_MM / 2 * PX_PER_MM
+square = center + half * np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]])
+theta = np.linspace(0, 2 * np.pi, 360, endpoint = False)
+cookie = center + PX_PER_MM * (np.array(COOKIE[:2]) + COOKIE[2] * np.column_stack((np.cos(theta), np.sin(theta))))
+for name, K, D in [('lens ignored', None, None), ('lens corrected', camera_matrix, dist_coeffs)]:
+    transform = v.square_transform(through_lens(square), through_lens(square)[0], v.SQUARE_MM, K, D)
+    outline = transform.to_mm(through_lens(cookie))
+    origin = transform.to_mm(through_lens(center.reshape(1, 2)))[0]
+    truth = (cookie - center) / PX_PER_MM
+    error = np.abs(outline - origin - truth).max()
+    ok = error <= tolerance if K is not None else True # Only shows how much the lens moves things
+    failures += not ok
+    print("%-16s %s: largest error %.3f mm" % (name, 'ok  ' if ok else 'info', error))
+    back = np.abs(transform.to_pixels(transform.to_mm(cookie)) - cookie).max()
+    ok = back <= 0.01
+    failures += not ok
+    print("%-16s %s: to_pixels(to_mm()) off by %.4f px" % ('', 'ok  ' if ok else 'FAIL', back))
+
+# The transform is saved with the calibration
+temp = tempfile.mkdtemp()
+Cookie_V.save_calibration(os.path.join(temp, 'calibration.json'))
+loaded = v.Cookie_Vision(display = c.Scripted_Display())
+loaded.load_calibration(os.path.join(temp, 'calibration.json'))
+same = np.abs(loaded.pixel_to_mm.to_mm(contour) - Cookie_V.pixel_to_mm.to_mm(contour)).max()
+ok = same < 1e-9
+failures += not ok
+print("%-16s %s: loaded transform off by %.2g mm" % ('save/load', 'ok  ' if ok else 'FAIL', same))
+
+# Transforming the contour vs warping the whole frame
+frame = camera_view(True, cameras['perspective'], rng)
+start = time.perf_counter()
+for i in range(100):
+    Cookie_V.pixel_to_mm.to_mm(contour)
+points_time = (time.perf_counter() - start) / 100
+start = time.perf_counter()
+for i in range(20):
+    cv.warpPerspective(frame, Cookie_V.pixel_to_mm.homography, SIZE)
+frame_time = (time.perf_counter() - start) / 20
+print("%-16s %d contour points %.3f ms, %dx%d frame warp %.2f ms" % ('time', len(contour), points_time * 1000, SIZE[0], SIZE[1], frame_time * 1000))
+
+print("---------Results---------")
+print("%d failures (tolerance %.2f mm)" % (failures, tolerance))
+sys.exit(1 if failures else 0)
@@ -0,0 +1,97 @@
+"""
+replay_test.py
+GOAL: Time the cookie scanner on a recording instead of the camera, so the
+vision pipeline's FPS and scan latency can be measured the same way every time
+(also on a computer with no camera or display)
+MODULES USED:
+- numpy as np
+- cv2 as cv
+- time
+CLASSES:
+metrics_classes.METRICS: time of every vision stage
+capture_classes.Replay_Source: plays a video file or image directory back
+capture_classes.Scripted_Display: presses keys from a script, no windows
+TEST CASES:
+A cookie has to be found. On the synthetic recording its outline has to match
+the ellipse that was drawn (area within 3%, center within 2 px). The learned
+background is saved to a temporary directory, not the real calibration
+USAGE:
+python replay_test.py [recording] [keys] [--show] [--realtime]
+- recording: Video file or directory of images (a synthetic recording of a
+cookie being placed on the platform is made if left out)
+- keys: Key script, e.g. '40:s,41:y' presses s on the 40th frame and y on
+the 41st
+- --show: Show the frames in windows (default is no display)
+- --realtime: Play at the recording's frame rate instead of as fast as possible
+"""
+# Import modules
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import cv2 as cv
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.vision_classes as v
+import classes.capture_classes as c
+from classes.metrics_classes import METRICS
+
+COOKIE_CENTER = (320, 240) # Cookie drawn in the synthetic recording (pixels)
+COOKIE_AXES = (110, 90)
+
+def make_recording(folder, frames = 40, cookie_frame = 25, size = (640, 480)):
+    # Empty platform, then a cookie is put down in the middle
+    rng = np.random.default_rng(0)
+    for i in range(frames):
+        frame = np.full((size[1], size[0], 3), 70, np.uint8)
+        if i >= cookie_frame:
+            cv.ellipse(frame, COOKIE_CENTER, COOKIE_AXES, 15, 0, 360, (150,190,220), -1)
+        noise = rng.integers(0, 6, frame.shape, dtype = np.uint8)
+        cv.imwrite(os.path.join(folder, 'frame_%04d.png' % i), cv.add(frame, noise))
+
+args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+show = '--show' in sys.argv
+realtime = '--realtime' in sys.argv
+synthetic = not args
+if args:
+    recording = args[0]
+    keys = c.parse_keys(args[1]) if len(args) > 1 else []
+else:
+    recording = tempfile.mkdtemp()
+    make_recording(recording)
+    keys = [(30, 's'), (31, 'y')]
+
+source = c.open_source(recording, realtime = realtime)
+Display = c.Scripted_Display(keys, show = show)
+Cookie_V = v.Cookie_Vision(display = Display)
+# The learned background must not overwrite the real one in calibration/
+Cookie_V.background_file = os.path.join(tempfile.mkdtemp(), 'background.png')
+
+start_time = time.time()
+Cookie_V.find_cookie(source, 'Replay')
+elapsed = time.time() - start_time
+
+print("---------Results---------")
+print("Frames = %d in %.2f s (%.1f FPS)" % (source.frames_played, elapsed, source.frames_played / elapsed))
+print("Scan latency = %.2f ms" % (Cookie_V.scan_time * 1000))
+print("Cookie contour points =", len(Cookie_V.contours))
+for name, stats in sorted(METRICS.snapshot()['histograms'].items()):
+    print("%-14s mean %.2f ms  max %.2f ms  (%d runs)" % (name, stats['mean'] * 1000, stats['max'] * 1000, stats['count']))
+source.release()
+Display.destroyAllWindows()
+
+failures = 0
+if len(Cookie_V.contours) == 0:
+    print("No cookie found: FAIL")
+    failures += 1
+elif synthetic:
+    area = cv.contourArea(Cookie_V.contours)
+    expected_area = np.pi * COOKIE_AXES[0] * COOKIE_AXES[1]
+    moments = cv.moments(Cookie_V.contours)
+    center = (moments['m10'] / moments['m00'], moments['m01'] / moments['m00'])
+    offset = np.hypot(center[0] - COOKIE_CENTER[0], center[1] - COOKIE_CENTER[1])
+    ok = abs(area / expected_area - 1) <= 0.03 and offset <= 2
+    failures += not ok
+    print("Cookie area %.0f px (expected %.0f), center off by %.2f px: %s" % (area, expected_area, offset, 'ok' if ok else 'FAIL'))
+print("%d failures" % failures)
+sys.exit(1 if failures else 0)
@@ -0,0 +1,117 @@
+"""
+status_test.py
+GOAL: Check grbl status polling and adaptive streaming against fake_grbl:
+the poller's '?' must not take RX buffer space, reports must be read
+correctly, and the adaptive fill limit must not starve the planner
+MODULES USED:
+- numpy as np
+- serial
+CLASSES:
+stream_classes.Status_Poller: sends '?' at a fixed rate
+stream_classes.Grbl_Streamer: reads the reports and adapts its fill limit
+fake_grbl.Fake_Grbl: grbl on a pty
+TEST CASES:
+parse_status on example reports, then the same program streamed with the
+fill limit fixed and adaptive. For each run: reports read, final position
+(must be the end of the program), planner idle time and mean RX occupancy.
+Then four quarter arcs (each one line, but over a hundred planner blocks):
+the job's 'executed' lines must never be more than the acknowledged ones,
+must follow the machine through the arcs instead of staying at 0, and must
+reach every line once the machine is idle
+USAGE:
+python status_test.py [number of points] [speedup]
+- speedup: Moves run this many times faster than their feed rate (default 20)
+"""
+# Import modules
+import sys
+import numpy as np
+import serial
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.g_code_classes as g
+import classes.stream_classes as st
+from fake_grbl import Fake_Grbl
+
+examples = {
+    '<Idle|MPos:0.000,0.000,0.000|FS:0,0>': ('Idle', (0, 0, 0), None),
+    '<Run|MPos:10.000,5.000,1.250|Bf:12,98|FS:500,0>': ('Run', (10, 5, 1.25), 12),
+    '<Hold:0|WPos:1.000,2.000,3.000|Bf:0,127|FS:0,0|WCO:1.000,1.000,0.000>': ('Hold', (2, 3, 3), 0),
+}
+failures = 0
+for report, (state, mpos, planner_free) in examples.items():
+    status = st.parse_status(report)
+    ok = status['state'] == state and np.allclose(status['mpos'], mpos) and status['planner_free'] == planner_free
+    failures += not ok
+    print("%-72s %s" % (report, 'ok' if ok else 'FAIL ' + str(status)))
+if st.parse_status('ok') is not None or st.parse_status('<Run|MPos:1,x,3>') is not None:
+    print("Non-reports were read as status reports: FAIL")
+    failures += 1
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+speedup = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+theta = np.linspace(0, 2 * np.pi, n)
+circle = np.column_stack((50 + 30 * np.cos(theta), 50 + 30 * np.sin(theta)))
+for adaptive in (False, True):
+    fake = Fake_Grbl(speedup = speedup)
+    fake.start()
+    ser = serial.Serial(fake.port, 115200, timeout = 0.1)
+    robot = g.GCode_EX(ser)
+    robot.streamer.wake_delay = 0.1
+    robot.streamer.adaptive = adaptive
+    poller = st.Status_Poller(robot.streamer, rate = 10).start()
+    reports = []
+    limits = []
+    robot.streamer.status_listeners.append(lambda status: (reports.append(status), limits.append(robot.streamer.fill_limit)))
+
+    job = robot.streamer.stream(robot.iter_gcode(circle))
+    progress = job.result()
+    # Let the machine finish the moves grbl accepted
+    while poller.wait_update(1) is not None and poller.latest()['state'] != 'Idle':
+        pass
+    poller.stop()
+    x, y, z = poller.position()
+    # The program ends with a rapid back to (0, -42)
+    at_end = np.allclose((x, y), (0, -42), atol = 0.01)
+    failures += not at_end or fake.stats['overflow'] > 0
+    print("---------%s fill limit---------" % ('Adaptive' if adaptive else 'Fixed'))
+    print("Lines = %d in %.2f s, %d status reports" % (progress['acked'], progress['elapsed'], len(reports)))
+    print("Final position = X%.3f Y%.3f Z%.3f (%s)" % (x, y, z, 'ok' if at_end else 'FAIL'))
+    print("Fill limit min/mean = %d / %.1f bytes" % (min(limits), np.mean(limits)))
+    print("grbl mean RX occupancy = %.1f bytes" % (fake.stats['rx_byte_seconds'] / fake.stats['rx_time']))
+    print("Planner idle time while running = %.3f s" % fake.stats['planner_idle'])
+    print("RX overflows =", fake.stats['overflow'])
+    robot.streamer.stop()
+    ser.close()
+    fake.stop()
+
+# One arc line fills grbl's planner many times over: lines in the planner aren't planner blocks
+fake = Fake_Grbl(speedup = speedup)
+fake.start()
+ser = serial.Serial(fake.port, 115200, timeout = 0.1)
+robot = g.GCode_EX(ser)
+robot.streamer.wake_delay = 0.1
+poller = st.Status_Poller(robot.streamer, rate = 20).start()
+arcs = ['G90', 'G00 X30 Y0 Z0', 'G01 F500', 'G02 X0 Y-30 Z1 I-30 J0', 'G02 X-30 Y0 Z2 I0 J30',
+        'G02 X0 Y30 Z3 I30 J0', 'G02 X30 Y0 Z4 I0 J-30', 'G00 X0 Y0']
+job = robot.streamer.stream(arcs)
+samples = [] # (acked, executed, state) at every report
+while poller.wait_update(1) is not None:
+    progress = job.progress()
+    samples.append((progress['acked'], progress['executed'], poller.latest()['state']))
+    if job.done() and samples[-1][2] == 'Idle':
+        break
+poller.stop()
+never_ahead = all(executed <= acked for acked, executed, state in samples)
+# Once the first arc is accepted the lines before it are done, whatever the planner holds
+following = all(executed >= 3 for acked, executed, state in samples if state == 'Run' and acked >= 4)
+finished = samples[-1] == (len(arcs), len(arcs), 'Idle')
+failures += not never_ahead or not following or not finished
+print("---------Arcs---------")
+print("Executed/acknowledged lines while running: %s" % ' '.join('%d/%d' % (executed, acked) for acked, executed, state in samples))
+print("Never ahead of grbl: %s, follows the arcs: %s, all executed at the end: %s" % (never_ahead, following, finished))
+robot.streamer.stop()
+ser.close()
+fake.stop()
+
+print("---------Results---------")
+print("%d failures" % failures)
+sys.exit(1 if failures else 0)
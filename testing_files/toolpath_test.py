@@ -0,0 +1,103 @@
+"""
+toolpath_test.py
+GOAL: Check that design strokes reused from design_classes.Toolpath_Cache stay
+inside the design and the cookie, like a fresh Design_Fill does, when the
+cookie's size is between the cache's reference scales
+MODULES USED:
+- numpy as np
+- cv2 as cv
+- tempfile
+CLASSES:
+design_classes.Design_Fill: fresh fill of every cookie
+design_classes.Toolpath_Cache: cached fill (in memory and from .npz files)
+TEST CASES:
+A ring design with a triangle through it, on oval cookies from 20 to 30 mm
+with a notch in their top edge, at hatch angles 0, 30 and 90 degrees. Points
+along every cached stroke have to be inside the placed design (within
+float32 rounding), no closer to the cookie's edge than the fresh fill's
+strokes get (less one hatch spacing, the lines fall in other places), and the
+total stroke length has to be within 5% of the fresh fill's. The image may
+only be vectorized once: new sizes hatch the cached polygons, and a new cache
+on the same folder (a restart) reads them from the .npz files.
+USAGE:
+python toolpath_test.py
+Exits with code 1 if a case fails.
+"""
+# Import modules
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import cv2 as cv
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.design_classes as d
+
+def along(strokes):
+    # Points spread along every stroke
+    return np.vstack([stroke[0] + (stroke[1] - stroke[0]) * k for stroke in strokes for k in np.linspace(0, 1, 21)])
+
+def outside(points, polygons):
+    # How far the points get outside the polygons (even-odd, holes included)
+    contours = [polygon.astype(np.float32).reshape(-1, 1, 2) for polygon in polygons]
+    worst = 0
+    for x, y in points:
+        distances = [cv.pointPolygonTest(contour, (float(x), float(y)), True) for contour in contours]
+        if sum(distance > 0 for distance in distances) % 2 == 0:
+            worst = max(worst, min(abs(distance) for distance in distances))
+    return worst
+
+def edge_distance(points, outline):
+    contour = outline.astype(np.float32).reshape(-1, 1, 2)
+    return min(cv.pointPolygonTest(contour, (float(x), float(y)), True) for x, y in points)
+
+def length(strokes):
+    return sum(np.linalg.norm(stroke[1] - stroke[0]) for stroke in strokes)
+
+folder = tempfile.mkdtemp()
+design_file = os.path.join(folder, 'ring.png')
+image = np.full((200, 200), 255, np.uint8)
+cv.circle(image, (100, 100), 80, 0, -1)
+cv.circle(image, (100, 100), 30, 255, -1)
+cv.fillPoly(image, [np.array([[20, 20], [180, 40], [100, 190]])], 0)
+cv.imwrite(design_file, image)
+failures = 0
+
+for angle in (0, 30, 90):
+    print("---------Hatch angle %d---------" % angle)
+    fill = d.Design_Fill(spacing = 0.7, angle = angle)
+    polygons = fill.load_design(design_file)
+    for cache_dir in (None, os.path.join(folder, 'cache_%d' % angle)):
+        if cache_dir is not None:
+            # Fill the .npz files, then read them back with an empty memory
+            os.makedirs(cache_dir)
+            warm = d.Toolpath_Cache(fill, cache_dir = cache_dir)
+        cache = d.Toolpath_Cache(fill, cache_dir = cache_dir)
+        for radius in np.linspace(20, 30, 11):
+            theta = np.linspace(0, 2 * np.pi, 720, endpoint = False)
+            r = radius * (1 - 0.25 * np.exp(-((theta - np.pi / 2) / 0.3) ** 2))
+            outline = np.column_stack((r * np.cos(theta), 0.9 * r * np.sin(theta)))
+            if cache_dir is not None:
+                warm.fill_cookie(outline, design_file)
+                cache.clear()
+            fresh = fill.fill_cookie(outline, design_file)
+            cached = cache.fill_cookie(outline, design_file)
+            out = outside(along(cached), fill.place_design(polygons, outline))
+            edge = edge_distance(along(cached), outline)
+            fresh_edge = edge_distance(along(fresh), outline)
+            ratio = length(cached) / length(fresh)
+            ok = out < 1e-4 and edge > fresh_edge - fill.spacing and abs(ratio - 1) < 0.05
+            failures += not ok
+            print("%-6s r = %4.1f mm %s: %.1g mm outside design, %.2f mm from edge (fresh %.2f), length x%.3f" % \
+                ('disk' if cache_dir else 'memory', radius, 'ok  ' if ok else 'FAIL', out, edge, fresh_edge, ratio))
+        # The memory cache vectorizes the image once, the disk cache reads the warm cache's polygons
+        vectorized = cache.stats['vectorized'] + (warm.stats['vectorized'] if cache_dir else 0)
+        ok = vectorized == 1
+        failures += not ok
+        print("%-6s %s: image vectorized %d time(s) %s" % ('disk' if cache_dir else 'memory', 'ok  ' if ok else 'FAIL', vectorized, cache.stats))
+
+shutil.rmtree(folder)
+
+print("---------Results---------")
+print("%d failures" % failures)
+sys.exit(1 if failures else 0)
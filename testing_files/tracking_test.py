@@ -4,24 +4,42 @@ GOAL: Track the red square on the platform using the web camera
 MODULES USED:
 - numpy as np
 - cv2 as cv
+- time
 FUNCTIONS:
-Function:
-Purpose:
+Function: Cookie_Vision.track_square
+Purpose: After the first full frame search only a padded ROI around the last
+square is searched (optionally downscaled), falling back to the full frame when
+tracking is lost. Prints the frames per second and how often the ROI was used.
+USAGE:
+python tracking_test.py [camera index or recording]
+A video file or directory of images is played back instead of the camera
+(see capture_classes.Replay_Source)
 
 
 
 """
 # Import modules
+import sys
+import time
 import numpy as np
 import cv2 as cv
+sys.path.insert(0,"..") # Makes the program look into parent directory, Cookie_Bot_ver1.1
+import classes.vision_classes as v
+import classes.capture_classes as c
+
+Cookie_V = v.Cookie_Vision()
+scale = 0.5 # Scale the search region down to save time (1.0 = full resolution)
 
 # Start the web camera
-cap = cv.VideoCapture(1) # Define camera object (0 = Main Camera, 1 = Web Camera)
+source = sys.argv[1] if len(sys.argv) > 1 else 1 # 0 = Main Camera, 1 = Web Camera
+cap = c.open_source(source, realtime = False) # Define camera object
 # If the camera couldn't be opened, exit program and print error message
 if not cap.isOpened():
     print("Can't open camera")
     exit()
 
+frame_count = 0
+start_time = time.time()
 while True:
     # Capture the video frame by frame
     ret, frame = cap.read()
@@ -30,52 +48,23 @@ while True:
     if not ret:
         print("Frame read incorrectly, exiting program")
         break
-    # Convert image from BGR to HSV (easier to detect color ranges)
-    hsv = cv.cvtColor(frame, cv.COLOR_BGR2HSV)
-
-    # Define the upper and lower threshold of the filter (H-0-180)
-    red_lower = np.array([0,150,50])
-    red_upper = np.array([180,255,255])
-
-    # Apply mask with the upper and lower bounds
-    mask = cv.inRange(hsv, red_lower, red_upper)
-
-    # Remove noise by eroding and dilating image
-    kernel = np.ones((25,25),np.uint8)
-    opening = cv.morphologyEx(mask, cv.MORPH_OPEN, kernel)
 
-    # Find and draw contours on binary image
-    contours, hirarchy = cv.findContours(opening, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-    # print(contours)
-    # cv.drawContours(frame, contours, -1, (0,255,0), 3)
-    # If there are contours, draw contours
-    if contours != ():
-        bounding_rect = cv.minAreaRect(contours[0])
-        # print(bounding_rect)
-        box = cv.boxPoints(bounding_rect)
-        print(box)
-        box = np.int0(box) # Convert box into integer values
-        # print(box)
+    # Find the red square, only searching near where it was last frame
+    bounding_rect = Cookie_V.track_square(frame, pad = 0.5, scale = scale)
+    if bounding_rect is not None:
+        box = np.intp(cv.boxPoints(bounding_rect)) # Convert box into integer values
         cv.drawContours(frame, [box],0,(0,0,255),2)
+        cv.drawContours(frame, [Cookie_V.box_platform],0,(0,255,0),2)
 
-        # Take the calibration square and scale-up to printable area
-        rsq_l = np.int0(bounding_rect[1]) # Red SQuare length
-        l_avg = int((rsq_l[0] + rsq_l[1])/2)
-        l_platform = int(8.8 * l_avg)
-        w_platform = int(7.3 * l_avg)
-        # Draw this on the frame
-        bounding_platform = (bounding_rect[0], (w_platform, l_platform), bounding_rect[2])
-        box_platform = cv.boxPoints(bounding_platform)
-        box_platform = np.int0(box_platform)
-
-        cv.drawContours(frame, [box_platform],0,(0,255,0),2)
-
-
+    # Frames per second over the last second
+    frame_count += 1
+    if time.time() - start_time >= 1:
+        print("FPS: %.1f" % (frame_count / (time.time() - start_time)), Cookie_V.track_stats)
+        frame_count = 0
+        start_time = time.time()
 
     # Display the resulting frame
     cv.imshow('frame', frame)
-    # cv.imshow('mask',mask) # Mask display
-    # cv.imshow('opening',opening) # Dialation display
 
     # Quit image capture by pressing 'q'
     if cv.waitKey(1) == ord('q'):